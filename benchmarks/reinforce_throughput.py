@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+"""
+Throughput benchmark of the REINFORCE implementations in the different frameworks.
+
+Every implementation is run in its own process (so peak memory and startup /
+compile time are its own) for a fixed number of env steps with a fixed seed,
+using the profiling flags that all of the agent scripts take (see
+numpy/utils/profiling.py).  The final summary record of each run is collected
+and turned into:
+
+    action_latency_us   mean time to pick an action (forward + sampling)
+    update_latency_us   mean time per parameter update (returns, backward, optimizer)
+    steps_per_sec       env steps per second of wall clock, env included
+    peak_rss_mb         peak resident memory of the run
+    time_to_threshold   seconds until the average reward reached --reward_threshold
+
+and written as JSON, so regressions and the gaps between backends show up when
+comparing result files.
+
+    ./benchmarks/reinforce_throughput.py --steps 20000 --out results.json
+
+With --env_id NumpyCartPole-v0 (numpy/envs) the env step is almost free, so
+the numbers are the cost of the agents themselves.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+IMPLEMENTATIONS = OrderedDict([
+    ('numpy', 'numpy/rl/reinforce.py'),
+    ('tensorflow', 'tensorflow/reinforce.py'),
+    ('tensorflow2', 'tensorflow/reinforce_tf2.py'),
+    ('jax', 'jax/reinforce.py'),
+])
+
+# profiler phases that make up picking an action and doing an update
+ACTION_PHASES = ('forward', 'sample', 'forward_sample')
+UPDATE_PHASES = ('returns', 'update_forward', 'backward', 'optimizer', 'train_op', 'update')
+
+parser = argparse.ArgumentParser(description='REINFORCE throughput benchmark')
+parser.add_argument('--impls', type=str, nargs='+', default=list(IMPLEMENTATIONS),
+                    choices=list(IMPLEMENTATIONS), help='implementations to run (default: all)')
+parser.add_argument('--env_id', type=str, default='LunarLander-v2',
+                    help='env to run, e.g. NumpyCartPole-v0 to leave out the simulator cost (default: LunarLander-v2)')
+parser.add_argument('--steps', type=int, default=20000, metavar='N',
+                    help='env steps per run (default: 20000)')
+parser.add_argument('--seed', type=int, default=42, metavar='N',
+                    help='random seed passed to every run (default: 42)')
+parser.add_argument('--repeats', type=int, default=1, metavar='N',
+                    help='runs per implementation (default: 1)')
+parser.add_argument('--reward_threshold', type=float, default=None, metavar='R',
+                    help='average reward to measure the time to (default: none)')
+parser.add_argument('--log_interval', type=int, default=20, metavar='N',
+                    help='episodes the average reward is taken over (default: 20)')
+parser.add_argument('--timeout', type=float, default=3600, metavar='S',
+                    help='seconds before a run is killed (default: 3600)')
+parser.add_argument('--out', type=str, default='reinforce_throughput.json',
+                    help='file to write the JSON results to')
+
+
+def phase_sec(phases, names):
+    return sum(phases[name]['sec'] for name in names if name in phases)
+
+
+def run_one(impl, script, args):
+    """Run one implementation in a subprocess and summarize its final profiling record"""
+    with tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False) as f:
+        records_file = f.name
+    cmd = [sys.executable, os.path.join(ROOT, script),
+           '--env_id', args.env_id, '--seed', str(args.seed), '--max_steps', str(args.steps),
+           '--log_interval', str(args.log_interval),
+           '--profile_phases', '--profile_out', records_file]
+    if args.reward_threshold is not None:
+        cmd += ['--reward_threshold', str(args.reward_threshold)]
+
+    result = OrderedDict(impl=impl, script=script, cmd=' '.join(cmd))
+    start = time.time()
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True, timeout=args.timeout)
+        result['returncode'] = proc.returncode
+        stderr = proc.stderr
+    except subprocess.TimeoutExpired:
+        result['returncode'] = None
+        stderr = 'timed out after {}s'.format(args.timeout)
+    result['process_sec'] = time.time() - start
+
+    with open(records_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    os.remove(records_file)
+    final = [r for r in records if r.get('final')]
+    if not final:
+        result['ok'] = False
+        result['error'] = stderr[-2000:]
+        return result
+
+    rec = final[-1]
+    phases = rec['phases']
+    result.update(
+        ok=True,
+        steps=rec['steps'],
+        updates=rec['updates'],
+        episodes=rec['episodes'],
+        wall_sec=rec['wall_sec'],
+        steps_per_sec=rec['steps_per_sec'],
+        updates_per_sec=rec['updates_per_sec'],
+        action_latency_us=1e6 * phase_sec(phases, ACTION_PHASES) / max(rec['steps'], 1),
+        update_latency_us=1e6 * phase_sec(phases, UPDATE_PHASES) / max(rec['updates'], 1),
+        env_step_us=1e6 * phase_sec(phases, ('env_step',)) / max(rec['steps'], 1),
+        peak_rss_mb=rec['peak_rss_mb'],
+        time_to_threshold=rec['time_to_threshold'],
+        steps_to_threshold=rec['steps_to_threshold'],
+        phases=phases,
+    )
+    return result
+
+
+def print_table(results):
+    cols = ['impl', 'steps_per_sec', 'action_latency_us', 'update_latency_us', 'peak_rss_mb', 'time_to_threshold']
+    print(' '.join('{:>18}'.format(c) for c in cols))
+    for r in results:
+        if not r['ok']:
+            print('{:>18} FAILED (returncode {})'.format(r['impl'], r['returncode']))
+            continue
+        row = []
+        for c in cols:
+            v = r[c]
+            row.append('{:>18.1f}'.format(v) if isinstance(v, float) else '{:>18}'.format(str(v)))
+        print(' '.join(row))
+
+
+def main():
+    args = parser.parse_args()
+    results = []
+    for impl in args.impls:
+        for repeat in range(args.repeats):
+            print('running {} ({}/{})'.format(impl, repeat + 1, args.repeats), file=sys.stderr)
+            result = run_one(impl, IMPLEMENTATIONS[impl], args)
+            result['repeat'] = repeat
+            results.append(result)
+
+    meta = OrderedDict(time=time.time(), python=sys.version, platform=platform.platform(),
+                       env_id=args.env_id, steps=args.steps, seed=args.seed, reward_threshold=args.reward_threshold,
+                       log_interval=args.log_interval)
+    with open(args.out, 'w') as f:
+        json.dump(OrderedDict(meta=meta, results=results), f, indent=2)
+    print_table(results)
+
+if __name__ == '__main__':
+    main()
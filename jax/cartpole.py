@@ -0,0 +1,122 @@
+import math
+from collections import namedtuple
+
+import numpy as onp
+import jax.numpy as np
+import jax.random as random
+
+# make it possible to import from ../numpy/envs/
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'numpy'))
+from envs.spaces import Box, Discrete
+
+"""
+Cart-pole written in jax.numpy, with the same dynamics, constants and
+termination as gym's CartPole (and numpy/envs/cartpole.py), so that whole
+rollouts can run on device inside lax.scan and be vmapped over many envs.
+
+The env is a set of pure functions of an explicit state:
+
+    env = CartPole(max_episode_steps=200)
+    state = env.reset(key)                         # one env
+    state, reward, done, ep_return = env.step(state, action, key)
+
+step() resets the env itself when the episode ends (auto-reset), so it can be
+called in a scan without any python control flow.  jax.vmap(env.step) steps
+a batch of envs.
+"""
+
+# physics is (x, x_dot, theta, theta_dot); steps and ep_return are for the
+# time limit and for reporting episode returns
+CartPoleState = namedtuple('CartPoleState', ['physics', 'steps', 'ep_return'])
+
+# max_episode_steps of the cart-pole env ids, so --env_id means the same thing
+# for the gym, numpy and jax versions
+ENV_IDS = {
+    'CartPole-v0': 200,
+    'CartPole-v1': 500,
+    'NumpyCartPole-v0': 200,
+    'NumpyCartPole-v1': 500,
+}
+
+
+class CartPole(object):
+    ob_n = 4
+    ac_n = 2
+
+    gravity = 9.8
+    masscart = 1.0
+    masspole = 0.1
+    total_mass = masspole + masscart
+    length = 0.5  # actually half the pole's length
+    polemass_length = masspole * length
+    force_mag = 10.0
+    tau = 0.02  # seconds between state updates
+    theta_threshold_radians = 12 * 2 * math.pi / 360
+    x_threshold = 2.4
+
+    def __init__(self, max_episode_steps=200):
+        self.max_episode_steps = max_episode_steps
+        high = onp.array([self.x_threshold * 2, onp.finfo(onp.float32).max,
+                          self.theta_threshold_radians * 2, onp.finfo(onp.float32).max], dtype=onp.float32)
+        self.observation_space = Box(-high, high)
+        self.action_space = Discrete(self.ac_n)
+
+    def reset(self, key):
+        physics = random.uniform(key, (4,), minval=-0.05, maxval=0.05)
+        return CartPoleState(physics, np.zeros((), np.int32), np.zeros(()))
+
+    def observe(self, state):
+        return state.physics
+
+    def step(self, state, action, key):
+        """
+        Advance one env by one step, resetting it if the episode ends.
+
+        Inputs:
+        - state: CartPoleState of the env
+        - action: 0 (push left) or 1 (push right)
+        - key: PRNGKey, used for the reset
+
+        Returns a tuple of:
+        - state: next state (the first state of a new episode if done)
+        - reward: 1.0, the step that ends the episode gets it too (like gym)
+        - done: whether the episode ended on this step (failure or time limit)
+        - ep_return: return of the episode up to and including this step
+        """
+        x, x_dot, theta, theta_dot = state.physics
+        force = np.where(action == 1, self.force_mag, -self.force_mag)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+
+        temp = (force + self.polemass_length * theta_dot**2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / \
+            (self.length * (4.0/3.0 - self.masspole * costheta**2 / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+
+        # euler integration
+        physics = np.stack([x + self.tau * x_dot,
+                            x_dot + self.tau * xacc,
+                            theta + self.tau * theta_dot,
+                            theta_dot + self.tau * thetaacc])
+        steps = state.steps + 1
+        reward = np.ones(())
+        ep_return = state.ep_return + reward
+
+        done = (np.abs(physics[0]) > self.x_threshold) | \
+               (np.abs(physics[2]) > self.theta_threshold_radians) | \
+               (steps >= self.max_episode_steps)
+
+        # auto-reset: pick the fresh state where the episode ended
+        fresh = self.reset(key)
+        next_state = CartPoleState(np.where(done, fresh.physics, physics),
+                                   np.where(done, fresh.steps, steps),
+                                   np.where(done, fresh.ep_return, ep_return))
+        return next_state, reward, done, ep_return
+
+
+def make_cartpole(env_id):
+    """JAX cart-pole with the time limit of a cart-pole env id"""
+    if env_id not in ENV_IDS:
+        raise ValueError('no JAX version of {}, the scan rollouts support {}'.format(env_id, sorted(ENV_IDS)))
+    return CartPole(ENV_IDS[env_id])
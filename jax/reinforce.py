@@ -1,85 +1,304 @@
 #!/usr/bin/env python3
-import gym
+import argparse
 import scipy.stats
 import numpy as onp
 import jax.numpy as np
 from itertools import count
-from jax.experimental import stax
-from jax.experimental.stax import Conv, Dense, MaxPool, Relu, Flatten, LogSoftmax, Softmax, softmax
+try:
+    from jax.experimental import stax, optimizers
+except ImportError:
+    # newer jax moved these to example_libraries
+    from jax.example_libraries import stax, optimizers
+Conv, Dense, MaxPool, Relu, Flatten, LogSoftmax, Softmax = \
+    stax.Conv, stax.Dense, stax.MaxPool, stax.Relu, stax.Flatten, stax.LogSoftmax, stax.Softmax
 import jax.random as random
-from jax.experimental import optimizers
-from jax import jit, grad
+from jax import jit, grad, lax
 import jax
 
-"""Something is wrong with this to make it run so slow, but I didn't really want to figure out what at the time so I moved on"""
+# make it possible to import from ../numpy/utils/
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'numpy'))
+from utils.profiling import add_profiling_args, make_profiler
+from envs import make_env
+from cartpole import make_cartpole
+
+parser = argparse.ArgumentParser(description='JAX REINFORCE')
+parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
+                    help='discount factor (default: 0.99)')
+parser.add_argument('--seed', type=int, default=0, metavar='N',
+                    help='random seed (default: 0)')
+parser.add_argument('--log_interval', type=int, default=100, metavar='N',
+                    help='interval between training status logs (default: 100)')
+parser.add_argument('--env_id', type=str, default='LunarLander-v2',
+                    help='gym (or numpy/envs) environment to load')
+parser.add_argument('--scan_rollouts', action='store_true',
+                    help='run batched rollouts on device with lax.scan on a JAX cart-pole, fused with the update')
+parser.add_argument('--num_envs', type=int, default=1024, metavar='N',
+                    help='parallel envs for --scan_rollouts (default: 1024)')
+parser.add_argument('--rollout_len', type=int, default=128, metavar='N',
+                    help='steps per env in each --scan_rollouts update (default: 128)')
+parser.add_argument('--num_devices', type=int, default=0, metavar='N',
+                    help='if > 0, shard the --scan_rollouts envs over N devices with pmap; on CPU this '
+                         'many host devices are created (default: 0, no pmap)')
+add_profiling_args(parser)
+args = parser.parse_args()
+
+if args.num_devices > 0 and 'xla_force_host_platform_device_count' not in os.environ.get('XLA_FLAGS', ''):
+    # XLA reads this when the backend is first used (not at import), so setting
+    # it here is enough to split the CPU into num_devices host devices
+    os.environ['XLA_FLAGS'] = (os.environ.get('XLA_FLAGS', '') +
+                               ' --xla_force_host_platform_device_count={}'.format(args.num_devices)).strip()
+profiler = make_profiler(args, 'jax/reinforce.py')
+
+"""
+The update used to be slow because _step was jitted on arrays as long as the
+episode, so it was retraced and recompiled for almost every episode.  Now
+episodes are padded up to a power of two length (with a validity mask) and the
+returns are calculated inside the jitted function, so there is one compile per
+bucket length and only a handful of compiles in a whole run.
+"""
+
+EPS = onp.finfo(onp.float32).eps
 
 def one_hot(x, k, dtype=np.float32):
   """Create a one-hot encoding of x of size k."""
   return np.array(x[:, None] == np.arange(k), dtype)
 
-def calculate_discounted_returns(rewards):
-    returns = onp.zeros(len(rewards))
-    next_return = 0 # 0 because we start at the last timestep
-    for t in reversed(range(0, len(rewards))):
-        next_return = rewards[t] + 0.99 * next_return
-        returns[t] = next_return
-    # normalize for better statistical properties
-    returns = (returns - returns.mean()) / (returns.std() + np.finfo(np.float32).eps)
-    return returns
+def bucket_length(T, min_len=32):
+    """Smallest power of two >= T (and min_len), so episodes of similar lengths share a compiled update"""
+    L = min_len
+    while L < T:
+        L *= 2
+    return L
+
+def discounted_returns(rewards, mask, gamma):
+    """
+    Normalized discounted returns of a padded episode, on device.
+    (padded steps have 0 reward and come after the real ones, so they don't
+    change the returns of the real steps, and they are left out of the mean/std)
+    """
+    def body(running, r):
+        running = r + gamma * running
+        return running, running
+    _, returns = lax.scan(body, 0.0, rewards, reverse=True)
+    n = np.sum(mask)
+    mean = np.sum(returns * mask) / n
+    std = np.sqrt(np.sum(mask * (returns - mean)**2) / n)
+    return mask * (returns - mean) / (std + EPS)
+
+def batch_discounted_returns(rewards, dones, gamma, axis_name=None):
+    """
+    Normalized discounted returns of a (T, N) batch of rollouts, where done[t]
+    ends the episode after step t.  Episodes still running at the end of the
+    rollout are cut off there (no bootstrapping, like the episode version).
+    Under pmap, pass its axis_name to normalize over the envs of all devices
+    """
+    def body(running, rd):
+        r, d = rd
+        running = r + gamma * running * (1.0 - d)
+        return running, running
+    _, returns = lax.scan(body, np.zeros(rewards.shape[1]), (rewards, dones.astype(np.float32)), reverse=True)
+    mean, sq_mean = returns.mean(), np.mean(returns**2)
+    if axis_name is not None:
+        # every device has the same number of envs, so the mean of means is the global mean
+        mean, sq_mean = lax.pmean((mean, sq_mean), axis_name)
+    std = np.sqrt(np.maximum(sq_mean - mean**2, 0.0))
+    return (returns - mean) / (std + EPS)
+
+def sample_actions(key, probs):
+    """Inverse cdf sample of one action per row of probs (N, ac_n), one uniform per row"""
+    u = random.uniform(key, (probs.shape[0], 1))
+    cdf = np.cumsum(probs, axis=1)
+    actions = np.sum(u * cdf[:, -1:] >= cdf, axis=1)
+    return np.minimum(actions, probs.shape[1] - 1)
 
 class REINFORCE(object):
     """
     Object to handle running the algorithm. Uses a PolicyNetwork
     """
     def __init__(self, env):
+        self.ob_n = env.observation_space.shape[0]
+        self.ac_n = env.action_space.n
         net_init, net_apply = stax.serial(
             Dense(128), Relu,
             Dense(128), Relu,
-            Dense(4),
+            Dense(self.ac_n),
             Softmax
         )
-        self.key = random.PRNGKey(0)
-        self.in_shape = (-1, 8)
+        self.key = random.PRNGKey(args.seed)
+        self.in_shape = (-1, self.ob_n)
         self.out_shape, self.net_params = net_init(self.key, self.in_shape)
+        self.net_apply = net_apply
         self.apply = lambda inputs: net_apply(self.net_params, inputs)
 
+        @jit
+        def _act(params, key, obs):
+            """
+            Sample actions for a batch of observations in one dispatch.
+
+            Inputs:
+            - params: network params
+            - key: PRNGKey, consumed
+            - obs: observations, shape (N, ob_n)
+
+            Returns a tuple of:
+            - actions: sampled actions, shape (N,)
+            - key: new PRNGKey to use for the next call
+            """
+            key, subkey = random.split(key)
+            return sample_actions(subkey, net_apply(params, obs)), key
+
+        self.act = _act
+
         self.opt_init, self.opt_update, self.get_params = optimizers.adam(step_size=1e-3)
         self.opt_state = self.opt_init(self.net_params)
         self.opt_t = 1
 
         def pg_loss(params, sar):
-            one_hot_actions = one_hot(sar['a'], 4)
+            returns = discounted_returns(sar['r'], sar['mask'], args.gamma)
+            one_hot_actions = one_hot(sar['a'], self.ac_n)
             out = net_apply(params, sar['s'])
-            return np.sum(-one_hot_actions * np.log(out))
+            # log prob of the taken actions, weighted by their return (0 for padding)
+            return np.sum(-returns * np.sum(one_hot_actions * np.log(out), axis=1))
+
+        # number of times _step has been traced and compiled (should stay at the
+        # number of different bucket lengths seen)
+        self.compile_count = 0
 
         @jit
         def _step(i, opt_state, sar):
+            # python side effects only run while tracing, so this counts compiles
+            self.compile_count += 1
             params = self.get_params(opt_state)
             g = grad(pg_loss)(params, sar)
             return self.opt_update(i, g, opt_state)
 
         self.step = _step
 
-     
-    def _update_key(self):
-        self.key, _ = random.split(self.key)
-        return self.key
+    @staticmethod
+    def replicate(tree, num_devices):
+        """Stack num_devices copies of every array in tree, for the replicated args of a pmapped function"""
+        return jax.tree_util.tree_map(lambda x: np.stack([x] * num_devices), tree)
+
+    def make_scan_step(self, env, num_envs, rollout_len, num_devices=0):
+        """
+        Build one compiled training step that runs rollout_len steps of
+        num_envs copies of a JAX env (e.g. cartpole.CartPole) with lax.scan,
+        computes the returns and does the policy gradient update, without
+        going back to python in between.
+
+        Inputs:
+        - env: JAX env with reset(key), observe(state) and step(state, action, key)
+        - num_envs: number of envs stepped in parallel (vmapped)
+        - rollout_len: steps per env in each update
+        - num_devices: if > 0, split the envs over this many devices with pmap.
+          Every device runs num_envs / num_devices envs, the gradients are
+          averaged with lax.pmean and the optimizer state is replicated, so
+          opt_state, env_state and key all get a leading (num_devices,) axis
+          (see replicate())
+
+        Returns a tuple of:
+        - reset: function key -> batched env state
+        - train_step: compiled function (i, opt_state, env_state, key) ->
+          (opt_state, env_state, key, (episodes, episode_return_sum)), where the
+          last two count the episodes that finished in the rollout (over all devices)
+        """
+        axis_name = 'devices' if num_devices else None
+        if num_devices:
+            assert num_envs % num_devices == 0, 'num_envs has to split evenly over the devices'
+            assert jax.local_device_count() >= num_devices, \
+                'only {} devices, see --num_devices'.format(jax.local_device_count())
+            num_envs //= num_devices
+        net_apply = self.net_apply
+        vreset = jax.vmap(env.reset)
+        vstep = jax.vmap(env.step)
+        vobserve = jax.vmap(env.observe)
+
+        def _reset(key):
+            return vreset(random.split(key, num_envs))
+
+        def rollout(params, env_state, key):
+            def body(carry, _):
+                env_state, key = carry
+                key, act_key, env_key = random.split(key, 3)
+                obs = vobserve(env_state)
+                actions = sample_actions(act_key, net_apply(params, obs))
+                env_state, rewards, dones, ep_returns = vstep(env_state, actions, random.split(env_key, num_envs))
+                return (env_state, key), (obs, actions, rewards, dones, ep_returns)
+            (env_state, key), traj = lax.scan(body, (env_state, key), None, length=rollout_len)
+            return env_state, key, traj
+
+        def loss(params, obs, actions, returns):
+            probs = net_apply(params, np.reshape(obs, (-1, self.ob_n)))
+            logp = np.log(np.sum(probs * one_hot(np.reshape(actions, (-1,)), self.ac_n), axis=1))
+            return -np.mean(np.reshape(returns, (-1,)) * logp)
+
+        def _train_step(i, opt_state, env_state, key):
+            self.compile_count += 1
+            params = self.get_params(opt_state)
+            env_state, key, (obs, actions, rewards, dones, ep_returns) = rollout(params, env_state, key)
+            returns = batch_discounted_returns(rewards, dones, args.gamma, axis_name)
+            g = grad(loss)(params, obs, actions, returns)
+            stats = (np.sum(dones), np.sum(ep_returns * dones))
+            if axis_name is not None:
+                # same averaged gradient on every device keeps the replicas identical
+                g = lax.pmean(g, axis_name)
+                stats = lax.psum(stats, axis_name)
+            opt_state = self.opt_update(i, g, opt_state)
+            return opt_state, env_state, key, stats
+
+        if not num_devices:
+            return _reset, jit(_train_step)
+
+        pmapped_reset = jax.pmap(_reset)
+        # (this gets traced once more on the second call, when its args come
+        # back laid out over the devices, and then stays compiled)
+        pmapped_step = jax.pmap(_train_step, axis_name=axis_name, in_axes=(None, 0, 0, 0))
+
+        def reset(key):
+            return pmapped_reset(random.split(key, num_devices))
+
+        def train_step(i, opt_state, env_state, key):
+            opt_state, env_state, key, stats = pmapped_step(i, opt_state, env_state, key)
+            # the psum'd stats are the same on every device
+            return opt_state, env_state, key, (stats[0][0], stats[1][0])
+
+        return reset, train_step
+
+    def select_actions(self, obs):
+        """Sample an action for every row of obs (N, ob_n), with a single jitted call"""
+        actions, self.key = self.act(self.net_params, self.key, obs)
+        return actions
 
     def select_action(self, obs):
-        obs = np.reshape(obs, [1, -1])
-        probs = self.apply(obs)[0]
-        uf = random.uniform(self._update_key(), (1,), minval=0.0, maxval=1.0)[0]
-        action = np.argmax(uf < np.cumsum(probs))
-        return action.item()
+        with profiler.phase('forward_sample'):
+            actions = self.select_actions(onp.reshape(obs, (1, -1)).astype(onp.float32))
+            # int() waits for the result, so the async dispatch is included
+            return int(actions[0])
+
+    def pad(self, sar):
+        """Pad the episode up to its bucket length, with a mask of the real steps"""
+        T = len(sar['r'])
+        L = bucket_length(T)
+        batch = dict(s=onp.zeros((L, self.ob_n), onp.float32), a=onp.zeros(L, onp.int32),
+                     r=onp.zeros(L, onp.float32), mask=onp.zeros(L, onp.float32))
+        batch['s'][:T] = sar['s']
+        batch['a'][:T] = sar['a']
+        batch['r'][:T] = sar['r']
+        batch['mask'][:T] = 1
+        return batch
 
     def update(self, sar):
-        sar['r'] = calculate_discounted_returns(sar['r'])
-        sar['s'] = np.array(sar['s'])
-        sar['a'] = np.array(sar['a'])
+        with profiler.phase('pad'):
+            batch = self.pad(sar)
 
-        self.opt_state = self.step(self.opt_t, self.opt_state, sar)
-        self.opt_t += 1
-        self.params = self.get_params(self.opt_state)
+        # (jax dispatches asynchronously, so part of the update time can land
+        # in the next forward pass instead)
+        with profiler.phase('update'):
+            self.opt_state = self.step(self.opt_t, self.opt_state, batch)
+            self.opt_t += 1
+            self.net_params = self.get_params(self.opt_state)
+        profiler.update()
         
 
 
@@ -95,7 +314,9 @@ def main():
             action = reinforce.select_action(obs)
             sar['s'].append(obs)
             sar['a'].append(action)
-            obs, reward, done, _ = env.step(action)
+            with profiler.phase('env_step'):
+                obs, reward, done, _ = env.step(action)
+            profiler.step()
             sar['r'].append(reward)
 
             #env.render()
@@ -103,17 +324,55 @@ def main():
             if done:
                 break
 
-        print('1')
         reinforce.update(sar)
+        profiler.end_episode()
 
-        if i_episode % 100 == 0:
+        if i_episode % args.log_interval == 0:
             print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+            profiler.report(ave_reward=sum(avg_reward)/len(avg_reward), compiles=reinforce.compile_count)
             avg_reward = []
         else:
             avg_reward.append(sum(sar['r']))
     
+def main_scan():
+    """Run REINFORCE with the rollouts and updates fused into one compiled step"""
+    reset, train_step = reinforce.make_scan_step(env, args.num_envs, args.rollout_len, args.num_devices)
+    key, reset_key = random.split(random.PRNGKey(args.seed + 1))
+    env_state = reset(reset_key)
+    if args.num_devices:
+        # one copy of the optimizer state and a different key per device
+        reinforce.opt_state = reinforce.replicate(reinforce.opt_state, args.num_devices)
+        key = random.split(key, args.num_devices)
+    steps_per_update = args.num_envs * args.rollout_len
+
+    episodes, return_sum = 0, 0.0
+    for i_update in count(1):
+        with profiler.phase('train_step'):
+            reinforce.opt_state, env_state, key, (n, ret) = \
+                train_step(reinforce.opt_t, reinforce.opt_state, env_state, key)
+            # waits for the step to finish, so the phase time is the real cost
+            n, ret = int(n), float(ret)
+        reinforce.opt_t += 1
+        episodes += n
+        return_sum += ret
+        profiler.update()
+        profiler.end_episode(n)
+
+        if i_update % args.log_interval == 0:
+            ave_reward = return_sum / max(episodes, 1)
+            print("Ave reward: {}".format(ave_reward))
+            profiler.report(ave_reward=ave_reward, compiles=reinforce.compile_count)
+            episodes, return_sum = 0, 0.0
+        profiler.step(steps_per_update)
+
 if __name__ == '__main__':
-    env = gym.make('LunarLander-v2')
-    reinforce = REINFORCE(env)
-    main()
+    if args.scan_rollouts:
+        env = make_cartpole(args.env_id)
+        reinforce = REINFORCE(env)
+        profiler.run(main_scan)
+    else:
+        env = make_env(args.env_id)
+        env.seed(args.seed)
+        reinforce = REINFORCE(env)
+        profiler.run(main)
 
@@ -0,0 +1,40 @@
+from functools import partial
+
+from .bandit import VecContextualBandit
+from .cartpole import VecCartPole
+from .pendulum import VecPendulum
+from .vec_env import GymFacade, VecEnv
+
+"""
+Small pure numpy environments, so the agents can be run and benchmarked
+without gym / Box2D, and so agent throughput can be measured apart from the
+simulator cost.
+
+    make_vec_env('NumpyCartPole-v0', num_envs=64)   # batched, auto-reset
+    make_env('NumpyCartPole-v0')                    # gym style single env
+    make_env('LunarLander-v2')                      # anything else goes to gym.make
+"""
+
+REGISTRY = {
+    'NumpyCartPole-v0': partial(VecCartPole, max_episode_steps=200),
+    'NumpyCartPole-v1': partial(VecCartPole, max_episode_steps=500),
+    'NumpyBandit-v0': partial(VecContextualBandit, episode_len=1),
+    'NumpyBandit-v1': partial(VecContextualBandit, episode_len=10),
+    'NumpyPendulum-v0': partial(VecPendulum, max_episode_steps=200),
+}
+
+
+def make_vec_env(env_id, num_envs=1, seed=None):
+    """Batch of num_envs of a registered numpy env"""
+    env = REGISTRY[env_id](num_envs=num_envs)
+    if seed is not None:
+        env.seed(seed)
+    return env
+
+
+def make_env(env_id):
+    """Single env with the gym interface: a numpy env if registered, else gym.make(env_id)"""
+    if env_id in REGISTRY:
+        return GymFacade(make_vec_env(env_id))
+    import gym
+    return gym.make(env_id)
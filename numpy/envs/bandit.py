@@ -0,0 +1,47 @@
+import numpy as np
+
+from .spaces import Box, Discrete
+from .vec_env import VecEnv
+
+"""
+Vectorized linear contextual bandit.  Every step shows a random context
+vector, and the reward of pulling arm a is a noisy linear function of it,
+context . W[:, a].  The arm weights W are drawn from the seed (the one passed
+to the constructor, and again by every seed() call, so runs with a different
+--seed see a different bandit) and shared by all of the envs, so the best arm
+depends on the context and the policy has to actually read its observation.
+Episodes are episode_len pulls long.
+"""
+
+
+class VecContextualBandit(VecEnv):
+    def __init__(self, num_envs=1, ob_n=4, ac_n=4, episode_len=1, noise=0.1, seed=0):
+        super(VecContextualBandit, self).__init__(num_envs, episode_len, seed)
+        self.noise = noise
+        self.observation_space = Box(-np.inf, np.inf, shape=(ob_n,))
+        self.action_space = Discrete(ac_n)
+        self.arm_weights = np.random.default_rng(seed).standard_normal((ob_n, ac_n))
+        self.context = np.zeros((num_envs, ob_n))
+
+    def seed(self, seed=None):
+        # the arm weights are part of the task, so they come from the seed too
+        self.arm_weights = np.random.default_rng(seed).standard_normal(self.arm_weights.shape)
+        return super(VecContextualBandit, self).seed(seed)
+
+    def _reset(self, mask):
+        self.context[mask] = self.rng.standard_normal((int(mask.sum()), self.context.shape[1]))
+
+    def expected_rewards(self):
+        """Mean reward of every arm for the current contexts, shape (num_envs, ac_n)"""
+        return self.context.dot(self.arm_weights)
+
+    def _step(self, actions):
+        # context . W[:, a] for every env, without building the full (num_envs, ac_n) table
+        rewards = np.einsum('ij,ji->i', self.context, self.arm_weights[:, actions])
+        rewards += self.noise * self.rng.standard_normal(self.num_envs)
+        self.context[...] = self.rng.standard_normal(self.context.shape)
+        terminal = np.zeros(self.num_envs, dtype=bool)
+        return rewards, terminal
+
+    def _obs(self):
+        return self.context.astype(np.float32)
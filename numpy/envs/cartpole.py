@@ -0,0 +1,63 @@
+import math
+import numpy as np
+
+from .spaces import Box, Discrete
+from .vec_env import VecEnv
+
+"""
+Vectorized version of the classic cart-pole system (same dynamics, constants
+and termination as gym's CartPole-v0/v1, which follow Barto, Sutton and
+Anderson 1983).  A pole is attached to a cart moving along a track, the agent
+pushes the cart left (0) or right (1), and gets +1 for every step the pole
+stays up and the cart stays on the track.
+"""
+
+
+class VecCartPole(VecEnv):
+    gravity = 9.8
+    masscart = 1.0
+    masspole = 0.1
+    total_mass = masspole + masscart
+    length = 0.5  # actually half the pole's length
+    polemass_length = masspole * length
+    force_mag = 10.0
+    tau = 0.02  # seconds between state updates
+    theta_threshold_radians = 12 * 2 * math.pi / 360
+    x_threshold = 2.4
+
+    def __init__(self, num_envs=1, max_episode_steps=200, seed=None):
+        super(VecCartPole, self).__init__(num_envs, max_episode_steps, seed)
+        high = np.array([self.x_threshold * 2, np.finfo(np.float32).max,
+                         self.theta_threshold_radians * 2, np.finfo(np.float32).max], dtype=np.float32)
+        self.observation_space = Box(-high, high)
+        self.action_space = Discrete(2)
+        # x, x_dot, theta, theta_dot of every env
+        self.state = np.zeros((num_envs, 4))
+
+    def _reset(self, mask):
+        self.state[mask] = self.rng.uniform(-0.05, 0.05, size=(int(mask.sum()), 4))
+
+    def _step(self, actions):
+        x, x_dot, theta, theta_dot = self.state.T
+        force = np.where(actions == 1, self.force_mag, -self.force_mag)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+
+        temp = (force + self.polemass_length * theta_dot**2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / \
+            (self.length * (4.0/3.0 - self.masspole * costheta**2 / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+
+        # euler integration (x, x_dot, ... are views, so this updates the state in place)
+        x += self.tau * x_dot
+        x_dot += self.tau * xacc
+        theta += self.tau * theta_dot
+        theta_dot += self.tau * thetaacc
+
+        terminal = (np.abs(x) > self.x_threshold) | (np.abs(theta) > self.theta_threshold_radians)
+        # the step that ends the episode still gets its reward (like gym)
+        rewards = np.ones(self.num_envs)
+        return rewards, terminal
+
+    def _obs(self):
+        return self.state.astype(np.float32)
@@ -0,0 +1,54 @@
+import numpy as np
+
+from .spaces import Box
+from .vec_env import VecEnv
+
+"""
+Vectorized inverted pendulum swing-up (same dynamics, constants and reward as
+gym's Pendulum).  The pendulum starts at a random angle and the agent applies
+a continuous torque in [-2, 2] to swing it up and keep it upright.  The reward
+is minus the cost angle**2 + 0.1*speed**2 + 0.001*torque**2, and the episode
+only ends at the time limit.
+"""
+
+
+def angle_normalize(x):
+    return ((x + np.pi) % (2 * np.pi)) - np.pi
+
+
+class VecPendulum(VecEnv):
+    max_speed = 8.0
+    max_torque = 2.0
+    dt = 0.05
+    g = 10.0
+    m = 1.0
+    l = 1.0
+
+    def __init__(self, num_envs=1, max_episode_steps=200, seed=None):
+        super(VecPendulum, self).__init__(num_envs, max_episode_steps, seed)
+        high = np.array([1.0, 1.0, self.max_speed], dtype=np.float32)
+        self.observation_space = Box(-high, high)
+        self.action_space = Box(-self.max_torque, self.max_torque, shape=(1,))
+        # theta, theta_dot of every env
+        self.state = np.zeros((num_envs, 2))
+
+    def _reset(self, mask):
+        n = int(mask.sum())
+        self.state[mask] = self.rng.uniform([-np.pi, -1.0], [np.pi, 1.0], size=(n, 2))
+
+    def _step(self, actions):
+        th, thdot = self.state.T
+        u = np.clip(np.reshape(actions, (self.num_envs,)), -self.max_torque, self.max_torque)
+        costs = angle_normalize(th)**2 + 0.1 * thdot**2 + 0.001 * u**2
+
+        # th, thdot are views, so this updates the state in place
+        thdot += (3 * self.g / (2 * self.l) * np.sin(th) + 3.0 / (self.m * self.l**2) * u) * self.dt
+        np.clip(thdot, -self.max_speed, self.max_speed, out=thdot)
+        th += thdot * self.dt
+
+        terminal = np.zeros(self.num_envs, dtype=bool)
+        return -costs, terminal
+
+    def _obs(self):
+        th, thdot = self.state.T
+        return np.stack([np.cos(th), np.sin(th), thdot], axis=1).astype(np.float32)
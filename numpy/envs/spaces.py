@@ -0,0 +1,41 @@
+import numpy as np
+
+"""
+Minimal stand-ins for gym.spaces, with the attributes the agents read
+(action_space.n, observation_space.shape, ...)
+"""
+
+
+class Discrete(object):
+    def __init__(self, n):
+        self.n = n
+        self.shape = ()
+        self.dtype = np.int64
+
+    def sample(self):
+        return np.random.randint(self.n)
+
+    def contains(self, x):
+        return 0 <= int(x) < self.n
+
+    def __repr__(self):
+        return 'Discrete({})'.format(self.n)
+
+
+class Box(object):
+    def __init__(self, low, high, shape=None, dtype=np.float32):
+        shape = shape if shape is not None else np.shape(low)
+        self.low = np.broadcast_to(np.asarray(low, dtype=dtype), shape)
+        self.high = np.broadcast_to(np.asarray(high, dtype=dtype), shape)
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+    def sample(self):
+        return np.random.uniform(self.low, self.high).astype(self.dtype)
+
+    def contains(self, x):
+        x = np.asarray(x)
+        return x.shape == self.shape and np.all(x >= self.low) and np.all(x <= self.high)
+
+    def __repr__(self):
+        return 'Box{}'.format(self.shape)
@@ -0,0 +1,118 @@
+import numpy as np
+
+"""
+Batched environments: num_envs copies of an environment whose state lives in
+numpy arrays with a leading (num_envs,) axis, so one call to step() advances
+all of them with vectorized math instead of a python loop over envs.
+"""
+
+
+class VecEnv(object):
+    """
+    Base class for the vectorized environments.
+
+    step(actions) takes one action per env and returns (obs, rewards, dones,
+    info) with a leading (num_envs,) axis.  Envs whose episode ended are reset
+    right away (auto-reset), so the returned obs for them is already the first
+    observation of their next episode.  For the envs that finished, info has
+    the last observation of the old episode ('terminal_obs'), its return and
+    length, and whether it was cut off by the time limit ('truncated').
+
+    Subclasses keep their state in arrays and implement:
+    - _reset(mask): reset the state of the envs where mask is True
+    - _step(actions): advance every env, returning (rewards, terminal)
+    - _obs(): current observations, shape (num_envs,) + observation_space.shape
+    """
+    observation_space = None
+    action_space = None
+
+    def __init__(self, num_envs=1, max_episode_steps=None, seed=None):
+        self.num_envs = num_envs
+        self.max_episode_steps = max_episode_steps
+        self.rng = np.random.default_rng(seed)
+        self.episode_steps = np.zeros(num_envs, dtype=np.int64)
+        self.episode_returns = np.zeros(num_envs)
+
+    def seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        return [seed]
+
+    def reset(self):
+        """Reset all of the envs and return their observations"""
+        self._reset(np.ones(self.num_envs, dtype=bool))
+        self.episode_steps[:] = 0
+        self.episode_returns[:] = 0
+        return self._obs()
+
+    def step(self, actions):
+        rewards, terminal = self._step(np.asarray(actions))
+        self.episode_steps += 1
+        self.episode_returns += rewards
+        dones = terminal
+        if self.max_episode_steps is not None:
+            dones = terminal | (self.episode_steps >= self.max_episode_steps)
+
+        info = {}
+        if dones.any():
+            info['terminal_obs'] = self._obs()[dones]
+            info['episode_returns'] = self.episode_returns[dones]
+            info['episode_lengths'] = self.episode_steps[dones]
+            info['truncated'] = (dones & ~terminal)[dones]
+            self._reset(dones)
+            self.episode_steps[dones] = 0
+            self.episode_returns[dones] = 0
+        return self._obs(), rewards, dones, info
+
+    def render(self, mode='human'):
+        pass
+
+    def close(self):
+        pass
+
+    def _reset(self, mask):
+        raise NotImplementedError
+
+    def _step(self, actions):
+        raise NotImplementedError
+
+    def _obs(self):
+        raise NotImplementedError
+
+
+class GymFacade(object):
+    """
+    gym.Env style interface (one env, reset() / step(action) -> obs, reward,
+    done, info) on top of a VecEnv with num_envs=1, so the agent scripts can
+    use the numpy envs in place of gym ones without changes.
+    """
+    def __init__(self, vec_env):
+        assert vec_env.num_envs == 1, 'GymFacade wraps a single env'
+        self.vec_env = vec_env
+        self.observation_space = vec_env.observation_space
+        self.action_space = vec_env.action_space
+        self._next_obs = None
+
+    def seed(self, seed=None):
+        return self.vec_env.seed(seed)
+
+    def reset(self):
+        # the vec env already reset itself at the end of the last episode
+        if self._next_obs is None:
+            return self.vec_env.reset()[0]
+        obs, self._next_obs = self._next_obs, None
+        return obs
+
+    def step(self, action):
+        obs, rewards, dones, info = self.vec_env.step(np.reshape(action, (1,) + np.shape(action)))
+        done = bool(dones[0])
+        if done:
+            self._next_obs = obs[0]
+            obs = info['terminal_obs']
+            info = {'truncated': bool(info['truncated'][0])}
+        return obs[0], float(rewards[0]), done, info
+
+    def render(self, mode='human'):
+        return self.vec_env.render(mode)
+
+    def close(self):
+        self.vec_env.close()
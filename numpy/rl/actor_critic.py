@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import argparse
-import gym
 import numpy as np
 import scipy.stats
 from itertools import count
@@ -8,7 +7,11 @@ from itertools import count
 # make it possible to import from ../../utils/
 import os.path, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
-from utils.optim import adam
+from utils.common import ParamStore, softmax
+from utils.optim import FusedAdam
+from utils.sampling import sample_categorical
+from utils.profiling import add_profiling_args, make_profiler
+from envs import make_env
 
 parser = argparse.ArgumentParser(description='Numpy ActorCritic')
 parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
@@ -20,15 +23,40 @@ parser.add_argument('--log_interval', type=int, default=100, metavar='N',
 parser.add_argument('--render_interval', type=int, default=-1, metavar='N',
                     help='interval between rendering (default: -1)')
 parser.add_argument('--env_id', type=str, default='LunarLander-v2',
-                    help='gym environment to load')
+                    help='gym (or numpy/envs) environment to load')
+parser.add_argument('--lam', type=float, default=0.0, metavar='L',
+                    help='eligibility trace decay rate (default: 0.0, no traces)')
+add_profiling_args(parser)
 args = parser.parse_args()
+profiler = make_profiler(args, 'numpy/rl/actor_critic.py')
 
 # TODO: add weight saving and loading?
 
 """
+This file implements the online (one-step) Actor-Critic algorithm. Unlike the
+batched version in batch_actor_critic.py, nothing is saved for the end of the
+episode: as soon as the value of the next state is known, the TD error for the
+last action is computed and the gradient and optimizer step are done right
+away.  So learning starts on the first step and memory use does not depend on
+the episode length.
+
+With --lam > 0, eligibility traces are used (Sutton book section 13.6), which
+spread each TD error back over the recently visited states and taken actions.
+The actor and the critic share one trace over all of the network parameters on
+purpose: both traces would decay with the same gamma*lam and be scaled by the
+same TD error into the same gradient buffer, so by linearity one summed trace
+gives exactly the same update (separate traces only matter with a different
+lambda for each, which we don't have).
+
+    Resources:
+        Sutton and Barto: http://incompleteideas.net/book/the-book-2nd.html
+        chapter 13 (One-step Actor-Critic and Actor-Critic with Eligibility Traces)
+
+
     Glossary:
         (w.r.t.) = with respect to (as in taking gradient with respect to a variable)
         (h or logits) = numerical policy preferences, or unnormalized probailities of actions
+        (td error, delta) = r + gamma*V(s') - V(s), how much better things went than expected
 """
 
 class PolicyNetwork(object):
@@ -57,39 +85,31 @@ class PolicyNetwork(object):
         self.hidden_dim = H = hidden_dim
         self.dtype = dtype
 
+        # All parameters and their gradients are preallocated (zeroed) in one
+        # array backed store of the correct datatype
+        self.params = ParamStore([('W1', (ob_n, H)), ('b1', (H,)),
+                                  ('W2a', (H, ac_n)), ('b2a', (ac_n,)),
+                                  ('W2b', (H, 1)), ('b2b', (1,))], dtype=self.dtype)
+
         # Initialize all weights (model params) with "Xavier Initialization" 
         # weight matrix init = uniform(-1, 1) / sqrt(layer_input)
         # bias init = zeros()
-        self.params = {}
         self.params['W1'] = (-1 + 2*np.random.rand(ob_n, H)) / np.sqrt(ob_n)
-        self.params['b1'] = np.zeros(H)
         # action head (produce probabilities of taking all actions)
         self.params['W2a'] = (-1 + 2*np.random.rand(H, ac_n)) / np.sqrt(H)
-        self.params['b2a'] = np.zeros(ac_n)
         # state-value head (numerical *value* of the state)
         self.params['W2b'] = (-1 + 2*np.random.rand(H, 1)) / np.sqrt(H)
-        self.params['b2b'] = np.zeros(1)
-
-        # Cast all parameters to the correct datatype
-        for k, v in self.params.items():
-            self.params[k] = v.astype(self.dtype)
 
         # Neural net bookkeeping 
         self.cache = {}
-        self.grads = {}
-        # Configuration for Adam optimization
-        self.optimization_config = {'learning_rate': 1e-3}
-        self.adam_configs = {}
-        for p in self.params:
-            d = {k: v for k, v in self.optimization_config.items()}
-            self.adam_configs[p] = d
+        # Adam optimization fused over the whole flat parameter buffer
+        self.optimizer = FusedAdam(self.params.data, self.params.grad, learning_rate=1e-3)
 
 
     ### HELPER FUNCTIONS
     def _zero_grads(self):
-        """Reset gradients to 0. This should be called during optimization steps"""
-        for g in self.grads:
-            self.grads[g] = np.zeros_like(self.grads[g])
+        """Reset gradients to 0 (in place). This should be called during optimization steps"""
+        self.params.zero_grad()
 
     def _add_to_cache(self, name, val):
         """Helper function to add a parameter to the cache without having to do checks"""
@@ -99,18 +119,8 @@ class PolicyNetwork(object):
             self.cache[name] = [val]
 
     def _update_grad(self, name, val):
-        """Helper fucntion to set gradient without having to do checks"""
-        if name in self.grads:
-            self.grads[name] += val
-        else:
-            self.grads[name] = val
-
-    def _softmax(self, x):
-        shifted_logits = x - np.max(x, axis=1, keepdims=True)
-        Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-        log_probs = shifted_logits - np.log(Z)
-        probs = np.exp(log_probs)
-        return probs
+        """Helper function to accumulate a gradient in place"""
+        self.params.accumulate(name, val)
 
     ### MAIN NEURAL NETWORK STUFF 
     def forward(self, x):
@@ -130,7 +140,7 @@ class PolicyNetwork(object):
 
         logits = affine2a # layer right before softmax (i also call this h)
         # pass through a softmax to get probabilities 
-        probs = self._softmax(logits)
+        probs = softmax(logits, out=logits)
 
         # cache values for backward (based on what is needed for analytic gradient calc)
         self._add_to_cache('affine1', x) 
@@ -141,29 +151,33 @@ class PolicyNetwork(object):
     def backward(self, dact, dvalue):
         """
         Backwards pass of the network.
+
+        Params:
+            dact: gradient signal for the action logits, shape (N, ac_n)
+            dvalue: gradient signal for the state value, shape (N, 1)
         """
         p = self.params
-        W1, b1, W2a, b2a, W2b, b2b = p['W1'], p['b1'], p['W2a'], p['b2a'], p['W2b'], p['W2b']
+        W1, b1, W2a, b2a, W2b, b2b = p['W1'], p['b1'], p['W2a'], p['b2a'], p['W2b'], p['b2b']
 
         # get values from network forward passes (for analytic gradient computations)
         fwd_relu1 = np.concatenate(self.cache['affine2'])
         fwd_affine1 = np.concatenate(self.cache['relu1'])
         fwd_x = np.concatenate(self.cache['affine1'])
 
-        drelu1 = dact.dot(W2a.T) + (dvalue*W2b).T
+        drelu1 = dact.dot(W2a.T) + dvalue.dot(W2b.T)
         # action gradient
         dW2a = fwd_relu1.T.dot(dact)
         db2a = np.sum(dact, axis=0)
         # state value gradient
-        dW2b = fwd_relu1.T.dot(dvalue).sum(axis=0) 
-        db2b = np.sum(dvalue, axis=0) # note: may be just a scalar
+        dW2b = fwd_relu1.T.dot(dvalue)
+        db2b = np.sum(dvalue, axis=0)
 
         # gradient of relu (non-negative for values that were above 0 in forward)
         daffine1 = np.where(fwd_affine1 > 0, drelu1, 0)
 
         # gradient of first affine
         dW1 = fwd_x.T.dot(daffine1)
-        db1 = np.sum(daffine1)
+        db1 = np.sum(daffine1, axis=0)
 
         # update gradients 
         self._update_grad('W1', dW1)
@@ -176,6 +190,12 @@ class PolicyNetwork(object):
         # reset cache for next backward pass
         self.cache = {}
 
+    def value(self, x):
+        """State value only, for a TD target. Nothing is cached for backward"""
+        p = self.params
+        relu1 = np.maximum(0, x.dot(p['W1']) + p['b1'])
+        return relu1.dot(p['W2b']) + p['b2b']
+
 class ActorCritic(object):
     """
     Object to handle running the algorithm. Uses a PolicyNetwork
@@ -184,89 +204,76 @@ class ActorCritic(object):
         ob_n = env.observation_space.shape[0]
         ac_n = env.action_space.n
         self.policy = PolicyNetwork(ob_n, ac_n)
+        # eligibility trace, one entry for every network parameter
+        self.trace = np.zeros_like(self.policy.params.grad)
+        # separate generator for action sampling
+        self.rng = np.random.default_rng(args.seed)
         self.reset()
 
     def reset(self):
-        # RL bookkeeping
-        self.last_value = None
+        """RL bookkeeping. Call at the start of every episode"""
+        self.I = 1 # gamma^t, discounts the actor update (see Sutton book)
+        self.trace.fill(0)
+        self.action_gradient = None
         self.value = None
-        self.last_reward = None
-        self.discount = 1
+        self.policy.cache = {}
 
     def act(self, obs):
         """
         Pass observations through network and sample an action to take. Keep track
-        of dh to use to update weights
+        of dh and the state value for the update at the next step.
+        (the forward cache is kept for the backward pass of that update)
         """
         obs = np.reshape(obs, [1, -1])
-        netout, value = self.policy.forward(obs)
-        netout = netout[0]
-        value = value[0]
-
-        std = 0.05 
-        probs = netout
-        # randomly sample action based on probabilities
-        action = np.random.choice(self.policy.ac_n, p=probs)
-        # derivative that pulls in direction to make actions taken more probable
-        # this will be fed backwards later
+        with profiler.phase('forward'):
+            probs, value = self.policy.forward(obs)
+
+        # randomly sample action based on probabilities, and get the derivative
+        # that pulls in direction to make actions taken more probable
         # (see README.md for derivation)
-        dh = -1*probs
-        dh[action] += 1
-        self.policy.saved_action_gradients.append(dh)
-        # we save these and we have to wait to calculate the gradient
-        # till we have the value of the next state
-        # TODO: we could also do this incrementally
-        self.policy.saved_values.append(value)
-        return action
-
-    def step(self):
-        self.discount *= args.gamma # what is the motivation for this?
-        td_error = self.last_reward + (args.gamma*self.value) - self.last_value
-        value_grad = discount * td_error
-        act_grad = discount * td_error
-
-    def calculate_grads(self, rewards):
-        """
-        update all at once
-        """
-        act_grads = np.zeros_like(rewards)
-        value_grads = np.zeros_like(rewards)
-
-        discount = 1
-        values = self.policy.saved_values
-
-        for t in range(len(rewards)-1):
-            td_error = rewards[t] + args.gamma*values[t+1] - values[t]
-            value_grads[t] = discount * td_error
-            act_grads[t] = discount * td_error
-            discount *= args.gamma 
-
-        # why does discount decrease throughout the episode?
-        
-        last_td = rewards[-1] - values[-1]
-        act_grads[-1] = discount * td_error
-        value_grads[-1] = discount * td_error
-        return act_grads, value_grads
-    
-    def finish_episode(self):
+        with profiler.phase('sample'):
+            actions, self.action_gradient = sample_categorical(probs, self.rng)
+        self.value = value[0, 0]
+        return actions[0]
+
+    def step(self, reward, next_obs, done):
         """
-        At the end of the episode, calculate the discounted return for each time step
+        Do the update for the last action, now that the reward and the next
+        state are known, and then pick the next action with the updated weights.
+        Returns the next action to take (None if done).
+
+        V(s') for the TD error has to come from the same weights as V(s), and
+        the forward pass of s' that the next update backpropagates has to come
+        from the weights after this update, so s' goes through the network
+        twice: a value-only pass before the update and a full one after it.
         """
-        action_gradient = np.array(self.policy.saved_action_gradients)
-        act_td_grads, value_td_grads = self.calculate_grads(self.policy.rewards)
-        self.policy_gradient = np.zeros(action_gradient.shape)
-        self.value_gradient = np.array(value_td_grads)
-        for t in range(0, len(act_td_grads)):
-            self.policy_gradient[t] = action_gradient[t] * act_td_grads[t]
-    
-        # negate because we want gradient ascent, not descent
-        self.policy.backward(-self.policy_gradient, -self.value_gradient)
-    
-        # run an optimization step on all of the model parameters
-        for p in self.policy.params:
-            next_w, self.policy.adam_configs[p] = adam(self.policy.params[p], self.policy.grads[p], config=self.policy.adam_configs[p])
-            self.policy.params[p] = next_w
-        self.policy._zero_grads() # required every call to adam
+        if done:
+            next_value = 0
+        else:
+            with profiler.phase('forward'):
+                next_value = self.policy.value(np.reshape(next_obs, [1, -1]))[0, 0]
+        td_error = reward + args.gamma*next_value - self.value
+
+        with profiler.phase('backward'):
+            # gradient of I * log(pi(a|s)) + V(s) w.r.t. all network weights
+            # (uses the forward cache of s from act())
+            self.policy.backward(self.I*self.action_gradient, np.ones((1, 1)))
+            # fold it into the trace (with lam = 0 the trace is just this gradient)
+            grad = self.policy.params.grad
+            self.trace *= args.gamma*args.lam
+            self.trace += grad
+            # step in the direction of the trace scaled by the TD error
+            # (negate because we want gradient ascent, not descent)
+            np.multiply(self.trace, -td_error, out=grad)
+        with profiler.phase('optimizer'):
+            self.policy.optimizer.step()
+            self.policy._zero_grads() # required every call to adam
+        profiler.update()
+
+        self.I *= args.gamma
+        if done:
+            return None
+        return self.act(next_obs)
 
 def main():
     """Run ActorCritic algorithm to train on the environment"""
@@ -275,14 +282,14 @@ def main():
         ep_reward = 0
         actor_critic.reset()
         obs = env.reset()
+        action = actor_critic.act(obs)
         for t in range(10000):  # Don't infinite loop while learning
-            action = actor_critic.act(obs)
-            # step here because you have now computed the state value and
-            # it makes it easier to deal with reward
-            actor_critic.step()
             # take action
-            obs, reward, done, _ = env.step(action)
-            actor_critic.last_reward = reward
+            with profiler.phase('env_step'):
+                obs, reward, done, _ = env.step(action)
+            profiler.step()
+            # learn from it right away. this also picks the next action
+            action = actor_critic.step(reward, obs, done)
 
             ep_reward += reward
 
@@ -292,21 +299,22 @@ def main():
             if done:
                 break
 
-        actor_critic.finish_episode()
+        profiler.end_episode()
 
         if i_episode % args.log_interval == 0:
             print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+            profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
             avg_reward = []
 
         else:
             avg_reward.append(ep_reward)
 
 if __name__ == '__main__':
-    env = gym.make(args.env_id)
+    env = make_env(args.env_id)
     env.seed(args.seed)
     np.random.seed(args.seed)
     actor_critic = ActorCritic(env)
-    main()
+    profiler.run(main)
 
 
 
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 import argparse
-import gym
 import numpy as np
 import scipy.stats
+import multiprocessing as mp
+import time
 from itertools import count
 
 # make it possible to import from ../../utils/
 import os.path, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
-from utils.optim import adam
+from utils.buffers import TrajectoryBuffer
+from utils.common import ParamStore, softmax, shared_zeros
+from utils.optim import FusedAdam
+from utils.rl_common import calculate_gae, episode_steps
+from utils.sampling import sample_categorical
+from utils.profiling import add_profiling_args, make_profiler
+from envs import make_env
 
 parser = argparse.ArgumentParser(description='Numpy ActorCritic')
 parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
@@ -20,8 +27,18 @@ parser.add_argument('--log_interval', type=int, default=100, metavar='N',
 parser.add_argument('--render_interval', type=int, default=-1, metavar='N',
                     help='interval between rendering (default: -1)')
 parser.add_argument('--env_id', type=str, default='LunarLander-v2',
-                    help='gym environment to load')
+                    help='gym (or numpy/envs) environment to load')
+parser.add_argument('--lam', type=float, default=0.0, metavar='L',
+                    help='GAE lambda. 0 uses the one-step TD error as the advantage (default: 0.0)')
+parser.add_argument('--episodes_per_update', type=int, default=1, metavar='N',
+                    help='number of episodes to collect for each batched update (default: 1)')
+parser.add_argument('--num_workers', type=int, default=0, metavar='N',
+                    help='if > 0, train asynchronously (A3C style) with this many worker processes (default: 0)')
+parser.add_argument('--stats_interval', type=float, default=5.0, metavar='S',
+                    help='seconds between training status logs in asynchronous mode (default: 5.0)')
+add_profiling_args(parser)
 args = parser.parse_args()
+profiler = make_profiler(args, 'numpy/rl/batch_actor_critic.py')
 
 # TODO: add weight saving and loading?
 # TODO: compare the performance of AC vs. reinforce to see if AC is 
@@ -37,6 +54,12 @@ of the REINFORCE algorithm and waits til the end of the episode to do the
 updates. If you meditated on the code long enough (or checked out the
 Sutton book), you would see that it could be doing the update continuously, which is what is done in the other file.
 
+With --num_workers N, it instead trains asynchronously like A3C: N forked worker
+processes each run their own env and compute their own gradients, then apply
+them without any locks (Hogwild) to a single parameter vector in shared
+memory.  The Adam moments live in shared memory too, so there is one central
+optimizer state.  The main process just watches the throughput.
+
     Resources:
         Sutton and Barto: http://incompleteideas.net/book/the-book-2nd.html
         chapter 13 (read chapters 5 and 6 first on the differences between MC and TD methods. Actor-Critic is the TD equivalent of REINFORCE)
@@ -56,7 +79,7 @@ class PolicyNetwork(object):
     {affine - relu } x (L - 1) - affine - softmax  
 
     """
-    def __init__(self, ob_n, ac_n, hidden_dim=500, dtype=np.float32):
+    def __init__(self, ob_n, ac_n, hidden_dim=500, dtype=np.float32, shared=False):
         """
         Initialize a neural network to choose actions
 
@@ -67,49 +90,38 @@ class PolicyNetwork(object):
         - dtype: A numpy datatype object; all computations will be performed using
           this datatype. float32 is faster but less accurate, so you should use
           float64 for numeric gradient checking.
+        - shared: keep the parameters and the Adam state in shared memory
+          (for asynchronous training with forked worker processes)
         """
         self.ob_n = ob_n
         self.ac_n = ac_n
         self.hidden_dim = H = hidden_dim
         self.dtype = dtype
 
+        # All parameters and their gradients are preallocated (zeroed) in one
+        # array backed store of the correct datatype
+        self.params = ParamStore([('W1', (ob_n, H)), ('b1', (H,)),
+                                  ('W2a', (H, ac_n)), ('b2a', (ac_n,)),
+                                  ('W2b', (H, 1)), ('b2b', (1,))], dtype=self.dtype, shared=shared)
+
         # Initialize all weights (model params) with "Xavier Initialization" 
         # weight matrix init = uniform(-1, 1) / sqrt(layer_input)
         # bias init = zeros()
-        self.params = {}
         self.params['W1'] = (-1 + 2*np.random.rand(ob_n, H)) / np.sqrt(ob_n)
-        self.params['b1'] = np.zeros(H)
         # action head (produce probabilities of taking all actions)
         self.params['W2a'] = (-1 + 2*np.random.rand(H, ac_n)) / np.sqrt(H)
-        self.params['b2a'] = np.zeros(ac_n)
         # state-value head (numerical *value* of the state)
         self.params['W2b'] = (-1 + 2*np.random.rand(H, 1)) / np.sqrt(H)
-        self.params['b2b'] = np.zeros(1)
-
-        # Cast all parameters to the correct datatype
-        for k, v in self.params.items():
-            self.params[k] = v.astype(self.dtype)
 
         # Neural net bookkeeping 
         self.cache = {}
-        self.grads = {}
-        # Configuration for Adam optimization
-        self.optimization_config = {'learning_rate': 1e-3}
-        self.adam_configs = {}
-        for p in self.params:
-            d = {k: v for k, v in self.optimization_config.items()}
-            self.adam_configs[p] = d
-
-        # RL specific bookkeeping
-        self.saved_action_gradients = []
-        self.saved_values = []
-        self.rewards = []
+        # Adam optimization fused over the whole flat parameter buffer
+        self.optimizer = FusedAdam(self.params.data, self.params.grad, shared=shared, learning_rate=1e-3)
 
     ### HELPER FUNCTIONS
     def _zero_grads(self):
-        """Reset gradients to 0. This should be called during optimization steps"""
-        for g in self.grads:
-            self.grads[g] = np.zeros_like(self.grads[g])
+        """Reset gradients to 0 (in place). This should be called during optimization steps"""
+        self.params.zero_grad()
 
     def _add_to_cache(self, name, val):
         """Helper function to add a parameter to the cache without having to do checks"""
@@ -119,18 +131,8 @@ class PolicyNetwork(object):
             self.cache[name] = [val]
 
     def _update_grad(self, name, val):
-        """Helper fucntion to set gradient without having to do checks"""
-        if name in self.grads:
-            self.grads[name] += val
-        else:
-            self.grads[name] = val
-
-    def _softmax(self, x):
-        shifted_logits = x - np.max(x, axis=1, keepdims=True)
-        Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-        log_probs = shifted_logits - np.log(Z)
-        probs = np.exp(log_probs)
-        return probs
+        """Helper function to accumulate a gradient in place"""
+        self.params.accumulate(name, val)
 
     ### MAIN NEURAL NETWORK STUFF 
     def forward(self, x):
@@ -150,7 +152,7 @@ class PolicyNetwork(object):
 
         logits = affine2a # layer right before softmax (i also call this h)
         # pass through a softmax to get probabilities 
-        probs = self._softmax(logits)
+        probs = softmax(logits, out=logits)
 
         # cache values for backward (based on what is needed for analytic gradient calc)
         self._add_to_cache('affine1', x) 
@@ -161,29 +163,33 @@ class PolicyNetwork(object):
     def backward(self, dact, dvalue):
         """
         Backwards pass of the network.
+
+        Params:
+            dact: gradient signal for the action logits, shape (N, ac_n)
+            dvalue: gradient signal for the state value, shape (N, 1)
         """
         p = self.params
-        W1, b1, W2a, b2a, W2b, b2b = p['W1'], p['b1'], p['W2a'], p['b2a'], p['W2b'], p['W2b']
+        W1, b1, W2a, b2a, W2b, b2b = p['W1'], p['b1'], p['W2a'], p['b2a'], p['W2b'], p['b2b']
 
         # get values from network forward passes (for analytic gradient computations)
         fwd_relu1 = np.concatenate(self.cache['affine2'])
         fwd_affine1 = np.concatenate(self.cache['relu1'])
         fwd_x = np.concatenate(self.cache['affine1'])
 
-        drelu1 = dact.dot(W2a.T) + (dvalue*W2b).T
+        drelu1 = dact.dot(W2a.T) + dvalue.dot(W2b.T)
         # action gradient
         dW2a = fwd_relu1.T.dot(dact)
         db2a = np.sum(dact, axis=0)
         # state value gradient
-        dW2b = fwd_relu1.T.dot(dvalue).sum(axis=0) 
-        db2b = np.sum(dvalue, axis=0) # note: may be just a scalar
+        dW2b = fwd_relu1.T.dot(dvalue)
+        db2b = np.sum(dvalue, axis=0)
 
         # gradient of relu (non-negative for values that were above 0 in forward)
         daffine1 = np.where(fwd_affine1 > 0, drelu1, 0)
 
         # gradient of first affine
         dW1 = fwd_x.T.dot(daffine1)
-        db1 = np.sum(daffine1)
+        db1 = np.sum(daffine1, axis=0)
 
         # update gradients 
         self._update_grad('W1', dW1)
@@ -200,11 +206,15 @@ class ActorCritic(object):
     """
     Object to handle running the algorithm. Uses a PolicyNetwork
     """
-    def __init__(self, env):
+    def __init__(self, env, shared=False):
         ob_n = env.observation_space.shape[0]
         ac_n = env.action_space.n
 
-        self.policy = PolicyNetwork(ob_n, ac_n)
+        self.policy = PolicyNetwork(ob_n, ac_n, shared=shared)
+        # RL specific bookkeeping
+        self.buffer = TrajectoryBuffer(action_gradients=(ac_n,), values=(), rewards=())
+        # separate generator for action sampling
+        self.rng = np.random.default_rng(args.seed)
 
     def select_action(self, obs):
         """
@@ -212,74 +222,89 @@ class ActorCritic(object):
         of dh to use to update weights
         """
         obs = np.reshape(obs, [1, -1])
-        netout, value = self.policy.forward(obs)
-        netout = netout[0]
-        value = value[0]
-
-        std = 0.05 
-        probs = netout
-        # randomly sample action based on probabilities
-        action = np.random.choice(self.policy.ac_n, p=probs)
-        # derivative that pulls in direction to make actions taken more probable
+        with profiler.phase('forward'):
+            probs, value = self.policy.forward(obs)
+
+        # randomly sample action based on probabilities, and get the derivative
+        # that pulls in direction to make actions taken more probable
         # this will be fed backwards later
         # (see README.md for derivation)
-        dh = -1*probs
-        dh[action] += 1
-        self.policy.saved_action_gradients.append(dh)
-        # we save these and we have to wait to calculate the gradient
-        # till we have the value of the next state
-        # TODO: we could also do this incrementally
-        self.policy.saved_values.append(value)
-        return action
+        with profiler.phase('sample'):
+            actions, dh = sample_categorical(probs, self.rng)
+            # we save these and we have to wait to calculate the gradient
+            # till we have the value of the next state
+            # TODO: we could also do this incrementally
+            self.buffer.add(action_gradients=dh[0], values=value[0, 0])
+        return actions[0]
 
 
-    def calculate_grads(self, rewards):
+    def calculate_grads(self, rewards, values, dones=None, last_values=0.0):
         """
-        update all at once
+        Compute the gradient signals for all timesteps at once (no python loop).
+
+        Works on a single trajectory of shape (T,) or on a batch of trajectories
+        from parallel envs of shape (num_envs, T).  Several episodes can be
+        concatenated along the time axis if dones marks where each one ends.
+
+        Params:
+            rewards: rewards for every step
+            values: critic values V(s_t) saved for every step
+            dones: episode end mask (next state is terminal, so V(s') = 0)
+            last_values: V of the state after the last step, for trajectories
+                that were cut off before their episode ended
+
+        Returns:
+            act_grads, value_grads: the scaling for the action gradients and the
+            value gradients of every step
         """
-        act_grads = np.zeros_like(rewards)
-        value_grads = np.zeros_like(rewards)
-
-        discount = 1
-        values = self.policy.saved_values
-
-        for t in range(len(rewards)-1):
-            td_error = rewards[t] + args.gamma*values[t+1] - values[t]
-            value_grads[t] = discount * td_error
-            act_grads[t] = discount * td_error
-            discount *= args.gamma 
+        # TD errors, delta[t] = r[t] + gamma*V[t+1] - V[t], summed with (gamma*lam)^k
+        # weights into GAE advantages.  lam = 0 gives back the one-step TD errors.
+        advantages, _ = calculate_gae(rewards, values, args.gamma, args.lam, dones=dones, last_value=last_values)
 
+        # gamma^t weighting, where t restarts at every episode
         # why does discount decrease throughout the episode?
-        
-        last_td = rewards[-1] - values[-1]
-        act_grads[-1] = discount * td_error
-        value_grads[-1] = discount * td_error
+        discount = args.gamma ** episode_steps(dones, advantages.shape)
+
+        act_grads = discount * advantages
+        value_grads = discount * advantages
         return act_grads, value_grads
     
     def finish_episode(self):
         """
-        At the end of the episode, calculate the discounted return for each time step
+        At the end of the episode, update the model parameters if enough
+        episodes have been collected for a batched update.
+        Returns True if an update was run.
+        """
+        self.buffer.end_episode()
+        if self.buffer.num_episodes >= args.episodes_per_update:
+            self.update()
+            return True
+        return False
+
+    def update(self):
+        """
+        Calculate the gradient signals for every collected time step and run
+        one batched update of the model parameters
         """
-        action_gradient = np.array(self.policy.saved_action_gradients)
-        act_td_grads, value_td_grads = self.calculate_grads(self.policy.rewards)
-        self.policy_gradient = np.zeros(action_gradient.shape)
-        self.value_gradient = np.array(value_td_grads)
-        for t in range(0, len(act_td_grads)):
-            self.policy_gradient[t] = action_gradient[t] * act_td_grads[t]
+        action_gradient = self.buffer.action_gradients
+        with profiler.phase('returns'):
+            act_td_grads, value_td_grads = self.calculate_grads(self.buffer.rewards, self.buffer.values, self.buffer.dones)
+        # one broadcast scales the action gradient of every time step
+        self.policy_gradient = action_gradient * act_td_grads[..., None]
+        self.value_gradient = value_td_grads[..., None]
     
-        # negate because we want gradient ascent, not descent
-        self.policy.backward(-self.policy_gradient, -self.value_gradient)
+        with profiler.phase('backward'):
+            # negate because we want gradient ascent, not descent
+            self.policy.backward(-self.policy_gradient.reshape(-1, self.policy.ac_n), -self.value_gradient.reshape(-1, 1))
     
-        # run an optimization step on all of the model parameters
-        for p in self.policy.params:
-            next_w, self.policy.adam_configs[p] = adam(self.policy.params[p], self.policy.grads[p], config=self.policy.adam_configs[p])
-            self.policy.params[p] = next_w
-        self.policy._zero_grads() # required every call to adam
+        with profiler.phase('optimizer'):
+            # run an optimization step on all of the model parameters
+            self.policy.optimizer.step()
+            self.policy._zero_grads() # required every call to adam
+        profiler.update()
     
         # reset stuff
-        del self.policy.rewards[:]
-        del self.policy.saved_action_gradients[:]
-        del self.policy.saved_values[:]
+        self.buffer.clear()
 
 
 def main():
@@ -290,9 +315,11 @@ def main():
         obs = env.reset()
         for t in range(10000):  # Don't infinite loop while learning
             action = actor_critic.select_action(obs)
-            obs, reward, done, _ = env.step(action)
+            with profiler.phase('env_step'):
+                obs, reward, done, _ = env.step(action)
+            profiler.step()
             ep_reward += reward
-            actor_critic.policy.rewards.append(reward)
+            actor_critic.buffer.set_last(rewards=reward)
 
             if args.render_interval != -1 and i_episode % args.render_interval == 0:
                 env.render()
@@ -301,20 +328,100 @@ def main():
                 break
 
         actor_critic.finish_episode()
+        profiler.end_episode()
 
         if i_episode % args.log_interval == 0:
             print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+            profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
             avg_reward = []
 
         else:
             avg_reward.append(ep_reward)
 
+def run_worker(rank, stats, stop):
+    """
+    Asynchronous worker loop.  Runs in a forked process, so actor_critic is this
+    process's own copy, except for the parameters and Adam state which are
+    shared with every other worker.
+
+    stats: this worker's row of the shared [steps, updates, episodes, reward sum] counters
+    stop: event the learner sets to end training (the episode in progress is dropped)
+    """
+    env = make_env(args.env_id)
+    env.seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
+    actor_critic.rng = np.random.default_rng(args.seed + rank)
+    while not stop.is_set():
+        ep_reward = 0
+        obs = env.reset()
+        for t in range(10000):  # Don't infinite loop while learning
+            action = actor_critic.select_action(obs)
+            obs, reward, done, _ = env.step(action)
+            ep_reward += reward
+            actor_critic.buffer.set_last(rewards=reward)
+            if done or stop.is_set():
+                break
+        if stop.is_set():
+            return
+
+        # steps are counted before the update so the learner sees them right away
+        stats[0] += t + 1
+        stats[1] += actor_critic.finish_episode()
+        stats[2] += 1
+        stats[3] += ep_reward
+
+def main_async():
+    """
+    Run ActorCritic with args.num_workers asynchronous workers.  This process
+    is the learner: it only watches the workers' counters and feeds them to the
+    profiler, so throughput logs and the --max_steps / --profile budgets work
+    like in the synchronous loop.  When a budget is used up (or the learner is
+    interrupted) the workers are told to stop and joined
+    """
+    ctx = mp.get_context('fork')
+    # one row of counters per worker, so nobody has to lock to update them
+    stats = shared_zeros(args.num_workers * 4, np.float64).reshape(args.num_workers, 4)
+    stop = ctx.Event()
+    workers = [ctx.Process(target=run_worker, args=(rank, stats[rank], stop), daemon=True)
+               for rank in range(args.num_workers)]
+    for w in workers:
+        w.start()
+
+    try:
+        counted = np.zeros(4)
+        interval_stats, last_report = np.zeros(4), time.time()
+        while any(w.is_alive() for w in workers):
+            # poll often so the budgets are not overshot by a whole log interval
+            time.sleep(min(args.stats_interval, 0.1))
+            totals = stats.sum(axis=0)
+            steps, updates, episodes, reward = new = totals - counted
+            counted = totals
+            interval_stats += new
+            # the workers only keep the counters (no phase timers across processes)
+            profiler.update(int(updates))
+            profiler.end_episode(int(episodes))
+
+            if time.time() - last_report >= args.stats_interval:
+                n, reward_sum = interval_stats[2], interval_stats[3]
+                ave_reward = reward_sum / n if n else None
+                print("Ave reward: {}".format(ave_reward))
+                profiler.report(ave_reward=ave_reward, num_workers=args.num_workers)
+                interval_stats, last_report = np.zeros(4), time.time()
+            profiler.step(int(steps))
+    finally:
+        stop.set()
+        for w in workers:
+            w.join()
+
 if __name__ == '__main__':
-    env = gym.make(args.env_id)
+    env = make_env(args.env_id)
     env.seed(args.seed)
     np.random.seed(args.seed)
-    actor_critic = ActorCritic(env)
-    main()
+    actor_critic = ActorCritic(env, shared=args.num_workers > 0)
+    if args.num_workers > 0:
+        profiler.run(main_async)
+    else:
+        profiler.run(main)
 
 
 
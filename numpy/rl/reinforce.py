@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import argparse
-import gym
 import numpy as np
 import scipy.stats
 from itertools import count
@@ -8,7 +7,13 @@ from itertools import count
 # make it possible to import from ../../utils/
 import os.path, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
-from utils.optim import adam
+from utils.common import ParamStore, policy_gradient_logits, softmax
+from utils.buffers import make_trajectory_buffer, iterate_minibatches
+from utils.optim import FusedAdam
+from utils.rl_common import calculate_discounted_returns
+from utils.sampling import sample_categorical
+from utils.profiling import add_profiling_args, make_profiler
+from envs import make_env
 
 parser = argparse.ArgumentParser(description='Numpy REINFORCE')
 parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
@@ -20,11 +25,23 @@ parser.add_argument('--log_interval', type=int, default=100, metavar='N',
 parser.add_argument('--render_interval', type=int, default=-1, metavar='N',
                     help='interval between rendering (default: -1)')
 parser.add_argument('--env_id', type=str, default='LunarLander-v2',
-                    help='gym environment to load')
+                    help='gym (or numpy/envs) environment to load')
+parser.add_argument('--episodes_per_update', type=int, default=1, metavar='N',
+                    help='number of episodes to collect for each batched update (default: 1)')
+parser.add_argument('--steps_per_update', type=int, default=0, metavar='N',
+                    help='if > 0, update once at least this many steps are collected instead (default: 0)')
 parser.add_argument('--lr', type=float, default=1e-3, 
                     help='learning rate')
+parser.add_argument('--epochs', type=int, default=1, metavar='N',
+                    help='epochs of minibatch updates on each collected batch, > 1 uses the clipped (PPO) objective (default: 1)')
+parser.add_argument('--minibatch_size', type=int, default=0, metavar='N',
+                    help='steps per minibatch for the multi-epoch updates, 0 for the whole batch (default: 0)')
+parser.add_argument('--clip', type=float, default=0.2, metavar='E',
+                    help='probability ratio clipping for the multi-epoch updates (default: 0.2)')
+add_profiling_args(parser)
 
 args = parser.parse_args()
+profiler = make_profiler(args, 'numpy/rl/reinforce.py')
 
 # TODO: add weight saving and loading?
 
@@ -74,35 +91,27 @@ class PolicyNetwork(object):
         self.hidden_dim = H = hidden_dim
         self.dtype = dtype
 
+        # All parameters and their gradients are preallocated (zeroed) in one
+        # array backed store of the correct datatype
+        self.params = ParamStore([('W1', (ob_n, H)), ('b1', (H,)),
+                                  ('W2', (H, ac_n)), ('b2', (ac_n,))], dtype=self.dtype)
+
         # Initialize all weights (model params) with "Xavier Initialization" 
         # weight matrix init = uniform(-1, 1) / sqrt(layer_input)
         # bias init = zeros()
-        self.params = {}
         self.params['W1'] = (-1 + 2*np.random.rand(ob_n, H)) / np.sqrt(ob_n)
-        self.params['b1'] = np.zeros(H)
         self.params['W2'] = (-1 + 2*np.random.rand(H, ac_n)) / np.sqrt(H)
-        self.params['b2'] = np.zeros(ac_n)
-
-        # Cast all parameters to the correct datatype
-        for k, v in self.params.items():
-            self.params[k] = v.astype(self.dtype)
 
         # Neural net bookkeeping 
         self.cache = {}
-        self.grads = {}
-        # Configuration for Adam optimization
-        self.optimization_config = {'learning_rate': args.lr}
-        self.adam_configs = {}
-        for p in self.params:
-            d = {k: v for k, v in self.optimization_config.items()}
-            self.adam_configs[p] = d
+        # Adam optimization fused over the whole flat parameter buffer
+        self.optimizer = FusedAdam(self.params.data, self.params.grad, learning_rate=args.lr)
 
 
     ### HELPER FUNCTIONS
     def _zero_grads(self):
-        """Reset gradients to 0. This should be called during optimization steps"""
-        for g in self.grads:
-            self.grads[g] = np.zeros_like(self.grads[g])
+        """Reset gradients to 0 (in place). This should be called during optimization steps"""
+        self.params.zero_grad()
 
     def _add_to_cache(self, name, val):
         """Helper function to add a parameter to the cache without having to do checks"""
@@ -112,18 +121,8 @@ class PolicyNetwork(object):
             self.cache[name] = [val]
 
     def _update_grad(self, name, val):
-        """Helper fucntion to set gradient without having to do checks"""
-        if name in self.grads:
-            self.grads[name] += val
-        else:
-            self.grads[name] = val
-
-    def _softmax(self, x):
-        shifted_logits = x - np.max(x, axis=1, keepdims=True)
-        Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-        log_probs = shifted_logits - np.log(Z)
-        probs = np.exp(log_probs)
-        return probs
+        """Helper function to accumulate a gradient in place"""
+        self.params.accumulate(name, val)
 
     ### MAIN NEURAL NETWORK STUFF 
     def forward(self, x):
@@ -144,7 +143,7 @@ class PolicyNetwork(object):
 
         logits = affine2 # layer right before softmax (i also call this h)
         # pass through a softmax to get probabilities 
-        probs = self._softmax(logits)
+        probs = softmax(logits, out=logits)
 
         # cache values for backward (based on what is needed for analytic gradient calc)
         self._add_to_cache('fwd_x', x) 
@@ -189,7 +188,7 @@ class PolicyNetwork(object):
         # affine1 = W1*x + b1
         # dx
         dW1 = fwd_x.T.dot(daffine1)
-        db1 = np.sum(daffine1)
+        db1 = np.sum(daffine1, axis=0)
 
         # update gradients 
         self._update_grad('W1', dW1)
@@ -209,9 +208,13 @@ class REINFORCE(object):
         ac_n = env.action_space.n
 
         self.policy = PolicyNetwork(ob_n, ac_n)
-        # RL specific bookkeeping
-        self.saved_action_gradients = []
-        self.rewards = []
+        # RL specific bookkeeping (steps of all episodes since the last update)
+        self.buffer = make_trajectory_buffer(ob_n, action_gradients=(ac_n,))
+        # shuffled copies of the batch for the multi-epoch updates
+        self._scratch = {}
+        self.multi_epoch = args.epochs > 1 or args.minibatch_size > 0
+        # separate generator for action sampling
+        self.rng = np.random.default_rng(args.seed)
 
     def select_action(self, obs):
         """
@@ -219,63 +222,108 @@ class REINFORCE(object):
         of dh to use to update weights
         """
         obs = np.reshape(obs, [1, -1])
-        netout = self.policy.forward(obs)[0]
+        with profiler.phase('forward'):
+            probs = self.policy.forward(obs)
 
-        probs = netout
-        # randomly sample action based on probabilities
-        action = np.random.choice(self.policy.ac_n, p=probs)
-        # derivative that pulls in direction to make actions taken more probable
+        # randomly sample action based on probabilities, and get the derivative
+        # that pulls in direction to make actions taken more probable
         # this will be fed backwards later
         # (see README.md for derivation)
-        dh = -1*probs
-        dh[action] += 1
-        self.saved_action_gradients.append(dh)
+        with profiler.phase('sample'):
+            actions, dh = sample_categorical(probs, self.rng)
+            action = actions[0]
+            if self.multi_epoch:
+                # obs, action and its log-prob are only needed for multi-epoch updates
+                self.buffer.add(action_gradients=dh[0], obs=obs[0], actions=action, logps=np.log(probs[0, action]))
+            else:
+                self.buffer.add(action_gradients=dh[0])
     
         return action
 
 
-    def calculate_discounted_returns(self, rewards):
+    def finish_episode(self):
         """
-        Calculate discounted reward and then normalize it
-        (see Sutton book for definition)
-        Params:
-            rewards: list of rewards for every episode
+        At the end of the episode, update the model parameters if enough
+        episodes (or steps) have been collected for a batched update
         """
-        returns = np.zeros(len(rewards))
-    
-        next_return = 0 # 0 because we start at the last timestep
-        for t in reversed(range(0, len(rewards))):
-            next_return = rewards[t] + args.gamma * next_return
-            returns[t] = next_return
-        # normalize for better statistical properties
-        returns = (returns - returns.mean()) / (returns.std() + np.finfo(np.float32).eps)
-        return returns
-    
-    def finish_episode(self):
+        self.buffer.end_episode()
+        if args.steps_per_update > 0:
+            ready = len(self.buffer) >= args.steps_per_update
+        else:
+            ready = self.buffer.num_episodes >= args.episodes_per_update
+        if ready:
+            if self.multi_epoch:
+                self.update_epochs()
+            else:
+                self.update()
+
+    def update(self):
         """
-        At the end of the episode, calculate the discounted return for each time step and update the model parameters
+        Calculate the discounted return for each time step of every collected
+        episode and run one batched update of the model parameters
         """
-        action_gradient = np.array(self.saved_action_gradients)
-        returns = self.calculate_discounted_returns(self.rewards)
+        action_gradient = self.buffer.action_gradients
+        with profiler.phase('returns'):
+            # one vectorized call for all episodes (dones keeps them separate)
+            returns = calculate_discounted_returns(self.buffer.rewards, args.gamma, dones=self.buffer.dones)
         # Multiply the signal that makes actions taken more probable by the discounted
         # return of that action.  This will pull the weights in the direction that
         # makes *better* actions more probable.
-        self.policy_gradient = np.zeros(action_gradient.shape)
-        for t in range(0, len(returns)):
-            self.policy_gradient[t] = action_gradient[t] * returns[t]
+        self.policy_gradient = action_gradient * returns[:, None]
     
-        # negate because we want gradient ascent, not descent
-        self.policy.backward(-self.policy_gradient)
+        with profiler.phase('backward'):
+            # negate because we want gradient ascent, not descent
+            self.policy.backward(-self.policy_gradient)
     
-        # run an optimization step on all of the model parameters
-        for p in self.policy.params:
-            next_w, self.policy.adam_configs[p] = adam(self.policy.params[p], self.policy.grads[p], config=self.policy.adam_configs[p])
-            self.policy.params[p] = next_w
-        self.policy._zero_grads() # required every call to adam
+        with profiler.phase('optimizer'):
+            # run an optimization step on all of the model parameters
+            self.policy.optimizer.step()
+            self.policy._zero_grads() # required every call to adam
+        profiler.update()
     
         # reset stuff
-        del self.rewards[:]
-        del self.saved_action_gradients[:]
+        self.buffer.clear()
+
+    def update_epochs(self):
+        """
+        Reuse the collected batch for several epochs of shuffled minibatch updates.
+
+        After the first update, the policy that collected the data is not the
+        current policy any more, so the objective is the clipped surrogate from
+        PPO: ratio = pi(a|s) / pi_old(a|s), maximize min(ratio*A, clip(ratio)*A).
+        Its gradient w.r.t. the logits is ratio*A*(onehot - probs), or 0 where
+        the clipped term is the smaller one (the ratio has moved far enough in
+        the direction the advantage wants).  (see https://arxiv.org/abs/1707.06347)
+        """
+        with profiler.phase('returns'):
+            advantages = calculate_discounted_returns(self.buffer.rewards, args.gamma, dones=self.buffer.dones)
+        columns = dict(obs=self.buffer.obs, actions=self.buffer.actions,
+                       logps=self.buffer.logps, advantages=advantages)
+        # the cached forward passes from acting are not used here
+        self.policy.cache = {}
+
+        for epoch in range(args.epochs):
+            for mb in iterate_minibatches(columns, args.minibatch_size, self.rng, self._scratch):
+                with profiler.phase('update_forward'):
+                    probs = self.policy.forward(mb['obs'])
+                rows = np.arange(len(probs))
+                ratio = probs[rows, mb['actions']] / np.exp(mb['logps'])
+                adv = mb['advantages']
+                # only the unclipped side of the min has a gradient
+                unclipped = np.where(adv >= 0, ratio < 1 + args.clip, ratio > 1 - args.clip)
+                # (probs isn't needed after this, so the gradient is written over it)
+                self.policy_gradient = policy_gradient_logits(probs, mb['actions'],
+                                                              np.where(unclipped, ratio * adv, 0.0), out=probs)
+
+                with profiler.phase('backward'):
+                    # negate because we want gradient ascent, not descent
+                    self.policy.backward(-self.policy_gradient)
+                with profiler.phase('optimizer'):
+                    self.policy.optimizer.step()
+                    self.policy._zero_grads()
+                profiler.update()
+
+        self.buffer.clear()
 
 
 def main():
@@ -286,9 +334,11 @@ def main():
         obs = env.reset()
         for t in range(10000):  # Don't infinite loop while learning
             action = reinforce.select_action(obs)
-            obs, reward, done, _ = env.step(action)
+            with profiler.phase('env_step'):
+                obs, reward, done, _ = env.step(action)
+            profiler.step()
             ep_reward += reward
-            reinforce.rewards.append(reward)
+            reinforce.buffer.set_last(rewards=reward)
 
             if args.render_interval != -1 and i_episode % args.render_interval == 0:
                 env.render()
@@ -297,20 +347,22 @@ def main():
                 break
 
         reinforce.finish_episode()
+        profiler.end_episode()
 
         if i_episode % args.log_interval == 0:
             print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+            profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
             avg_reward = []
 
         else:
             avg_reward.append(ep_reward)
 
 if __name__ == '__main__':
-    env = gym.make(args.env_id)
+    env = make_env(args.env_id)
     env.seed(args.seed)
     np.random.seed(args.seed)
     reinforce = REINFORCE(env)
-    main()
+    profiler.run(main)
 
 
 
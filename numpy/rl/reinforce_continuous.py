@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 import argparse
-import gym
 import numpy as np
-import scipy.stats
 from itertools import count
 
 # make it possible to import from ../../utils/
 import os.path, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
-from utils.optim import adam
+from utils.common import ParamStore
+from utils.buffers import TrajectoryBuffer
+from utils.optim import FusedAdam
+from utils.rl_common import calculate_discounted_returns
+from utils.sampling import sample_gaussian
+from utils.profiling import add_profiling_args, make_profiler
+from envs import REGISTRY, make_env, make_vec_env
 
 parser = argparse.ArgumentParser(description='Numpy REINFORCE')
 parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
@@ -19,9 +23,17 @@ parser.add_argument('--log_interval', type=int, default=100, metavar='N',
                     help='interval between training status logs (default: 100)')
 parser.add_argument('--render_interval', type=int, default=-1, metavar='N',
                     help='interval between rendering (default: -1)')
-parser.add_argument('--env_id', type=str, default='LunarLander-v2',
-                    help='gym environment to load')
+parser.add_argument('--env_id', type=str, default='LunarLanderContinuous-v2',
+                    help='gym (or numpy/envs) environment to load, e.g. NumpyPendulum-v0')
+parser.add_argument('--episodes_per_update', type=int, default=1, metavar='N',
+                    help='number of episodes to collect for each batched update (default: 1)')
+parser.add_argument('--steps_per_update', type=int, default=0, metavar='N',
+                    help='if > 0, update once at least this many steps are collected instead (default: 0)')
+parser.add_argument('--num_envs', type=int, default=1, metavar='N',
+                    help='number of envs to run in lockstep, one batched forward pass for all (default: 1)')
+add_profiling_args(parser)
 args = parser.parse_args()
+profiler = make_profiler(args, 'numpy/rl/reinforce_continuous.py')
 
 """
     Glossary:
@@ -55,38 +67,26 @@ class PolicyNetworkContinuous(object):
         self.dtype = dtype
         self.out_n = ac_n * 2 # for mean and standard deviation
 
+        # All parameters and their gradients are preallocated (zeroed) in one
+        # array backed store of the correct datatype
+        self.params = ParamStore([('W1', (ob_n, H)), ('b1', (H,)),
+                                  ('W2', (H, self.out_n)), ('b2', (self.out_n,))], dtype=self.dtype)
+
         # Initialize all weights (model params) with "Xavier Initialization" 
         # weight matrix init = uniform(-1, 1) / sqrt(layer_input)
         # bias init = zeros()
-        self.params = {}
         self.params['W1'] = (-1 + 2*np.random.rand(ob_n, H)) / np.sqrt(ob_n)
-        self.params['b1'] = np.zeros(H)
         self.params['W2'] = (-1 + 2*np.random.rand(H, self.out_n)) / np.sqrt(H)
-        self.params['b2'] = np.zeros(self.out_n)
-
-        # Cast all parameters to the correct datatype
-        for k, v in self.params.items():
-            self.params[k] = v.astype(self.dtype)
 
         # Neural net bookkeeping 
         self.cache = {}
-        self.grads = {}
-        # Configuration for Adam optimization
-        self.optimization_config = {'learning_rate': 1e-3}
-        self.adam_configs = {}
-        for p in self.params:
-            d = {k: v for k, v in self.optimization_config.items()}
-            self.adam_configs[p] = d
-
-        # RL specific bookkeeping
-        self.saved_action_gradients = []
-        self.rewards = []
+        # Adam optimization fused over the whole flat parameter buffer
+        self.optimizer = FusedAdam(self.params.data, self.params.grad, learning_rate=1e-3)
 
     ### HELPER FUNCTIONS
     def _zero_grads(self):
-        """Reset gradients to 0. This should be called during optimization steps"""
-        for g in self.grads:
-            self.grads[g] = np.zeros_like(self.grads[g])
+        """Reset gradients to 0 (in place). This should be called during optimization steps"""
+        self.params.zero_grad()
 
     def _add_to_cache(self, name, val):
         """Helper function to add a parameter to the cache without having to do checks"""
@@ -96,27 +96,18 @@ class PolicyNetworkContinuous(object):
             self.cache[name] = [val]
 
     def _update_grad(self, name, val):
-        """Helper fucntion to set gradient without having to do checks"""
-        if name in self.grads:
-            self.grads[name] += val
-        else:
-            self.grads[name] = val
-
-    def _softmax(self, x):
-        shifted_logits = x - np.max(x, axis=1, keepdims=True)
-        Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-        log_probs = shifted_logits - np.log(Z)
-        probs = np.exp(log_probs)
-        return probs
+        """Helper function to accumulate a gradient in place"""
+        self.params.accumulate(name, val)
 
     ### MAIN NEURAL NETWORK STUFF 
     def forward(self, x):
         """
-        Forward pass observations (x) through network to get probabilities 
-        of taking each action 
+        Forward pass a batch of observations (x) of shape (N, ob_n) through
+        network to get the mean and standard deviation of each action dimension
 
-        [input] --> affine --> relu --> affine --> softmax/output
+        [input] --> affine --> relu --> affine --> means, relu(stds)
 
+        Returns means, stds each of shape (N, ac_n)
         """
         p = self.params
         W1, b1, W2, b2 = p['W1'], p['b1'], p['W2'], p['b2']
@@ -138,7 +129,7 @@ class PolicyNetworkContinuous(object):
         self._add_to_cache('relu1', affine1) 
         self._add_to_cache('affine2', relu1) 
         self._add_to_cache('relu_stds', stds) 
-        return means.squeeze(), relu_stds.squeeze()
+        return means, relu_stds
     
     def backward(self, dout):
         """
@@ -163,7 +154,8 @@ class PolicyNetworkContinuous(object):
         fwd_x = np.concatenate(self.cache['affine1'])
         fwd_relu_stds = np.concatenate(self.cache['relu_stds'])
 
-        dout[:,2:] = np.where(fwd_relu_stds > 0, dout[:,2:], 0)
+        # gradient of the relu on the std half of the output
+        dout[:, self.ac_n:] = np.where(fwd_relu_stds > 0, dout[:, self.ac_n:], 0)
 
         # Analytic gradient of last layer for backprop 
         # affine2 = W2*relu1 + b2
@@ -179,7 +171,7 @@ class PolicyNetworkContinuous(object):
 
         # affine1 = W1*x + b1
         dW1 = fwd_x.T.dot(daffine1)
-        db1 = np.sum(daffine1)
+        db1 = np.sum(daffine1, axis=0)
 
         # update gradients 
         self._update_grad('W1', dW1)
@@ -193,123 +185,173 @@ class PolicyNetworkContinuous(object):
 class REINFORCE(object):
     """
     Object to handle running the algorithm. Uses a PolicyNetwork
+
+    Runs num_envs envs in lockstep.  Every buffer row holds one timestep of all
+    of the envs, so the columns are (T, num_envs, ...).  An env that finishes
+    its episode early is masked out for the rest of the round: it is not passed
+    through the network any more, its rows stay zero with mask False, and
+    they are left out of the backward pass.  The (num_envs, T) mask is what the
+    padded batch of episodes looks like for the return calculation.
     """
-    def __init__(self, env):
+    def __init__(self, env, num_envs=1):
         ob_n = env.observation_space.shape[0]
-        if type(env.action_space) == gym.spaces.box.Box:
+        if len(env.action_space.shape) == 1:
             ac_n = env.action_space.shape[0]
         else:
             raise Exception("this only supports continuous envs")
+        self.num_envs = N = num_envs
+        self.ac_low, self.ac_high = env.action_space.low, env.action_space.high
 
         self.policy = PolicyNetworkContinuous(ob_n, ac_n)
+        # RL specific bookkeeping (steps of all episodes since the last update)
+        self.buffer = TrajectoryBuffer(action_gradients=(N, self.policy.out_n), rewards=(N,),
+                                       dones=((N,), bool), mask=((N,), bool))
+        # separate generator for action sampling
+        self.rng = np.random.default_rng(args.seed)
 
-    def select_action(self, obs):
+    def select_action(self, obs, active):
         """
-        Pass observations through network and sample an action to take. Keep track
-        of dh to use to update weights
+        Pass the observations of the active envs (obs has one row per env, active
+        is a (num_envs,) bool mask) through network and sample an action for each
+        of them. Keep track of dh to use to update weights
+
+        Returns actions of shape (num_envs, ac_n), clipped to the action space
+        (rows of the envs that are done are 0)
         """
-        obs = np.reshape(obs, [1, -1])
-        means, stds = self.policy.forward(obs)
+        obs = np.reshape(obs, [self.num_envs, -1])[active]
+        with profiler.phase('forward'):
+            means, stds = self.policy.forward(obs)
         stds += 1e-5
 
-        action = np.random.normal(means, stds)
-        action = action.clip(-1,1)
-
-        dmeans = (action - means)/stds**2
-        dstds = (-1/stds + ((action - means)**2 / (np.power(stds, 3))))
-        print(means, stds)
-
-        # I think the analytic gradient is undefined because we are clipping.  It should be
-        #dh = (action - netout)/std**2
-        # Instead, we have to compute it numerically
-        #normal_dist = scipy.stats.norm(means, stds)
-        #dmeans = normal_dist.logpdf(action) # TODO: does this need scaling by std?
-        #dstds = 1e-1 * normal_dist.entropy() # Add cross entropy cost to encourage exploration
-        dh = np.hstack([dmeans, dstds])
-
-        #dh = (1 - netout**2) * dnetout
-        self.policy.saved_action_gradients.append(dh)
-    
-        return action
-
-
-    def calculate_discounted_returns(self, rewards):
+        # The gradient of log(pi) is taken for the unclipped sample (that is what
+        # the policy actually drew from), clipping is left up to the env side
+        with profiler.phase('sample'):
+            sampled, dh = sample_gaussian(means, stds, self.rng)
+            action_gradients = np.zeros((self.num_envs, self.policy.out_n), dtype=dh.dtype)
+            action_gradients[active] = dh
+            self.buffer.add(action_gradients=action_gradients, mask=active)
+        actions = np.zeros((self.num_envs, self.policy.ac_n))
+        actions[active] = sampled.clip(self.ac_low, self.ac_high)
+        return actions
+
+    def finish_round(self):
         """
-        Calculate discounted reward and then normalize it
-        See Sutton book for definition 
-        Params:
-            rewards: list of rewards for every episode
+        After all envs are done with their episodes, update the model parameters
+        if enough episodes (or steps) have been collected for a batched update
         """
-        returns = np.zeros(len(rewards))
-    
-        next_return = 0 # 0 because we start at the last timestep
-        for t in reversed(range(0, len(rewards))):
-            next_return = rewards[t] + args.gamma * next_return
-            returns[t] = next_return
-        # normalize for better statistical properties
-        returns = (returns - returns.mean()) / (returns.std() + np.finfo(np.float32).eps)
-        return returns
-    
-    def finish_episode(self):
+        # envs that ran out of time still end their episode here
+        self.buffer.dones[-1] |= self.buffer.mask[-1]
+        if args.steps_per_update > 0:
+            ready = self.buffer.mask.sum() >= args.steps_per_update
+        else:
+            ready = self.buffer.dones.sum() >= args.episodes_per_update
+        if ready:
+            self.update()
+
+    def update(self):
         """
-        At the end of the episode, calculate the discounted return for each time step
+        Calculate the discounted return for each time step of every collected
+        episode and run one batched update of the model parameters
         """
-        action_gradient = np.array(self.policy.saved_action_gradients)
-        returns = self.calculate_discounted_returns(self.policy.rewards)
+        T, N = len(self.buffer), self.num_envs
+        # the forward cache only has the rows of the active envs, in the same
+        # (time major) order as the mask
+        live = self.buffer.mask.reshape(T*N)
+        action_gradient = self.buffer.action_gradients.reshape(T*N, -1)[live]
+        # one vectorized call for all episodes of all envs (time on the last axis,
+        # dones keeps episodes separate, mask drops the steps after an env was done)
+        with profiler.phase('returns'):
+            returns = calculate_discounted_returns(self.buffer.rewards.T, args.gamma,
+                                                   dones=self.buffer.dones.T, mask=self.buffer.mask.T)
         # Multiply the signal that makes actions taken more probable by the discounted
         # return of that action.  This will pull the weights in the direction that
         # makes *better* actions more probable.
-        self.policy_gradient = np.zeros(action_gradient.shape)
-        for t in range(0, len(returns)):
-            self.policy_gradient[t] = action_gradient[t] * returns[t]
+        self.policy_gradient = action_gradient * returns.T.reshape(T*N, 1)[live]
     
-        # negate because we want gradient ascent, not descent
-        self.policy.backward(-self.policy_gradient)
+        with profiler.phase('backward'):
+            # negate because we want gradient ascent, not descent
+            self.policy.backward(-self.policy_gradient)
     
-        # run an optimization step on all of the model parameters
-        for p in self.policy.params:
-            next_w, self.policy.adam_configs[p] = adam(self.policy.params[p], self.policy.grads[p], config=self.policy.adam_configs[p])
-            self.policy.params[p] = next_w
-        self.policy._zero_grads() # required every call to adam
+        with profiler.phase('optimizer'):
+            # run an optimization step on all of the model parameters
+            self.policy.optimizer.step()
+            self.policy._zero_grads() # required every call to adam
+        profiler.update()
     
         # reset stuff
-        del self.policy.rewards[:]
-        del self.policy.saved_action_gradients[:]
+        self.buffer.clear()
+
+
+def reset_envs():
+    """Reset all of the envs and return their observations, one row per env"""
+    if vec_env is not None:
+        return vec_env.reset()
+    return np.stack([env.reset() for env in envs])
+
+def step_envs(obs, actions, active):
+    """
+    Step the envs that are still in their episode.  A numpy vec env steps all of
+    them in one vectorized call (envs that are already done have auto-reset,
+    their results are dropped), gym envs are stepped one at a time.
 
+    Returns rewards and dones, with 0 / False for the envs that are not active
+    (obs is updated in place for the active ones)
+    """
+    if vec_env is not None:
+        next_obs, rewards, dones, _ = vec_env.step(actions)
+        obs[active] = next_obs[active]
+        return np.where(active, rewards, 0), dones & active
+    rewards = np.zeros(len(envs))
+    dones = np.zeros(len(envs), dtype=bool)
+    for i in np.flatnonzero(active):
+        obs[i], rewards[i], dones[i], _ = envs[i].step(actions[i])
+    return rewards, dones
 
 def main():
-    """Run REINFORCE algorithm to train on the environment"""
+    """Run REINFORCE algorithm to train on the environments"""
     avg_reward = []
-    for i_episode in count(1):
-        ep_reward = 0
-        obs = env.reset()
+    N = args.num_envs
+    i_episode = 0
+    for i_round in count(1):
+        obs = reset_envs()
+        active = np.ones(N, dtype=bool)
+        ep_rewards = np.zeros(N)
         for t in range(10000):  # Don't infinite loop while learning
-            action = reinforce.select_action(obs)
-            obs, reward, done, _ = env.step(action)
-            ep_reward += reward
-            reinforce.policy.rewards.append(reward)
-
-            if args.render_interval != -1 and i_episode % args.render_interval == 0:
-                env.render()
-
-            if done:
+            actions = reinforce.select_action(obs, active)
+            with profiler.phase('env_step'):
+                rewards, dones = step_envs(obs, actions, active)
+            profiler.step(active.sum())
+            ep_rewards += rewards
+            reinforce.buffer.set_last(rewards=rewards, dones=dones)
+
+            if args.render_interval != -1 and i_round % args.render_interval == 0:
+                (vec_env or envs[0]).render()
+
+            active = active & ~dones
+            if not active.any():
                 break
 
-        reinforce.finish_episode()
+        reinforce.finish_round()
 
-        if i_episode % args.log_interval == 0:
-            print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
-            avg_reward = []
+        for ep_reward in ep_rewards:
+            i_episode += 1
+            if i_episode % args.log_interval == 0:
+                print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+                profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
+                avg_reward = []
 
-        else:
-            avg_reward.append(ep_reward)
+            else:
+                avg_reward.append(ep_reward)
+        profiler.end_episode(N)
 
 if __name__ == '__main__':
-    env = gym.make(args.env_id)
-    env.seed(args.seed)
+    if args.env_id in REGISTRY:
+        # numpy env: all of the envs are stepped with one vectorized call
+        vec_env, envs = make_vec_env(args.env_id, args.num_envs, args.seed), None
+    else:
+        vec_env, envs = None, [make_env(args.env_id) for _ in range(args.num_envs)]
+        for i, env in enumerate(envs):
+            env.seed(args.seed + i)
     np.random.seed(args.seed)
-    reinforce = REINFORCE(env)
-    main()
-
-
-
+    reinforce = REINFORCE(vec_env or envs[0], args.num_envs)
+    profiler.run(main)
@@ -1,11 +1,19 @@
 import argparse
-import gym
 import numpy as np
 from itertools import count
-from cs231n.layers import affine_forward, affine_backward, softmax_forward, softmax_backward
-from cs231n.layer_utils import affine_relu_forward, affine_relu_backward 
-from cs231n.optim import adam, sgd
-from cs231n.gradient_check import eval_numerical_gradient_array, rel_error
+
+# make it possible to import from ../../utils/
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from utils.buffers import TrajectoryBuffer
+from utils.common import ParamStore
+from utils.layers import (affine_forward, affine_backward, affine_relu_forward, affine_relu_backward,
+                          softmax_forward, value_head_forward, value_head_backward)
+from utils.optim import FusedAdam
+from utils.rl_common import calculate_discounted_returns
+from utils.sampling import sample_categorical
+from utils.profiling import add_profiling_args, make_profiler
+from envs import make_env
 
 parser = argparse.ArgumentParser(description='Numpy REINFORCE')
 parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
@@ -16,12 +24,17 @@ parser.add_argument('--log_interval', type=int, default=100, metavar='N',
                     help='interval between training status logs (default: 100)')
 parser.add_argument('--render_interval', type=int, default=100, metavar='N',
                     help='interval between rendering (default: 100)')
+parser.add_argument('--env_id', type=str, default='LunarLander-v2',
+                    help='gym (or numpy/envs) environment to load')
+add_profiling_args(parser)
 args = parser.parse_args()
+profiler = make_profiler(args, 'numpy/rl/reinforce_with_baseline.py')
 
-env = gym.make('LunarLander-v2')
-#env = gym.make('CartPole-v0')
+env = make_env(args.env_id)
 env.seed(args.seed)
 np.random.seed(args.seed)
+# separate generator for action sampling
+rng = np.random.default_rng(args.seed)
 
 # TODO: add support for continuous actions
 
@@ -52,87 +65,63 @@ class Policy(object):
 
         self.num_layers = len(self.hidden_dims)  
 
-        # Initialize all weights (model params) with "Xavier Initialization" 
-        # weight matrix init = uniform(-1, 1) / sqrt(layer_input)
-        # bias init = zeros()
-        self.params = {}
+        # All parameters and their gradients are preallocated (zeroed) in one
+        # array backed store of the correct datatype
+        shapes = []
         layer_input_dim = ob_n
         for i, H in enumerate(self.hidden_dims):
-            self.params['shared.W{}'.format(i)] = (-1 + 2*np.random.rand(layer_input_dim, H)) / np.sqrt(layer_input_dim)
+            shapes += [('shared.W%d'%i, (layer_input_dim, H)), ('shared.b%d'%i, (H,))]
             layer_input_dim = H
-            self.params['shared.b{}'.format(i)] = np.zeros(layer_input_dim)
-        self.params['policy.W'] = (-1 + 2*np.random.rand(layer_input_dim, ac_n)) / np.sqrt(hidden_dims[-1])
-        self.params['policy.b'] = np.zeros(ac_n)
-
+        shapes += [('policy.W', (layer_input_dim, ac_n)), ('policy.b', (ac_n,))]
         # Value estimation 
-        self.params['value.W'] = (-1 + 2*np.random.rand(layer_input_dim, 1)) / np.sqrt(hidden_dims[-1])
-        self.params['value.b'.format(i+1)] = np.zeros(1)
-
-        # Cast all parameters to the correct datatype
-        for k, v in self.params.items():
-            self.params[k] = v.astype(self.dtype) 
-        # Neural net bookkeeping 
-        self.cache = {}
-        self.grads = {}
-        # Configuration for Adam optimization
-        self.optimization_config = {'learning_rate': 1e-3}
-        self.adam_configs = {}
-        for p in self.params:
-            d = {k: v for k, v in self.optimization_config.items()}
-            self.adam_configs[p] = d
+        shapes += [('value.W', (layer_input_dim, 1)), ('value.b', (1,))]
+        self.params = ParamStore(shapes, dtype=self.dtype)
+
+        # Initialize all weights (model params) with "Xavier Initialization" 
+        # weight matrix init = uniform(-1, 1) / sqrt(layer_input)
+        # bias init = zeros()
+        for name, W in self.params.items():
+            if '.W' in name:
+                W[...] = (-1 + 2*np.random.rand(*W.shape)) / np.sqrt(W.shape[0])
+
+        # Neural net bookkeeping. Only the activations are kept for the backward
+        # pass, and the forward pass writes them straight into these columns
+        # (one row per forward pass input, until the next backward)
+        self.activations = TrajectoryBuffer(dtype=self.dtype, x=(ob_n,),
+                                            **{'h%d'%i: (H,) for i, H in enumerate(self.hidden_dims)})
+        # Adam optimization fused over the whole flat parameter buffer
+        self.optimizer = FusedAdam(self.params.data, self.params.grad, learning_rate=1e-3)
 
         # RL specific bookkeeping
-        self.rewards = []
-        self.saved_values = []
-        self.saved_neg_log_probs = []
+        self.buffer = TrajectoryBuffer(neg_log_probs=(ac_n,), values=(), rewards=())
 
     def zero_grads(self):
-        """Reset gradients to 0. This should be called during optimization steps"""
-        for g in self.grads:
-            self.grads[g] = np.zeros_like(self.grads[g])
-
-    def _add_to_cache(self, name, val):
-        """Helper function to add a parameter to the cache without having to do checks"""
-        if name in self.cache:
-            self.cache[name].append(val)
-        else:
-            self.cache[name] = [val]
-
-    def _set_grad(self, name, val):
-        """Helper fucntion to set gradient without having to do checks"""
-
-            self.grads[name] += val
-        else:
-            self.grads[name] = val
-
-    def _cache_to_list(self, cache):
-        """Helper function to convert cache to list"""
-        cx, cw, cb = zip(*cache)
-        cache = (np.concatenate(cx), cw[0], cb[0])
-        return cache
+        """Reset gradients to 0 (in place). This should be called during optimization steps"""
+        self.params.zero_grad()
 
     def forward(self, x):
         """
         Forward pass observations (x) through network to get probabilities (scores) 
-        of taking each action 
+        of taking each action and the baseline value estimate
         """
-        layer_input = x
+        p = self.params
+        x = np.reshape(x, [-1, self.ob_n])
+        rows = self.activations.reserve(len(x))
+        layer_input = self.activations.x[rows]
+        layer_input[...] = x
         # run input through all hidden layers
         for layer in range(self.num_layers):
-            layer_input, layer_cache = affine_relu_forward(layer_input, self.params['shared.W%d'%layer], self.params['shared.b%d'%layer])
-            self._add_to_cache(layer, layer_cache) # todo: don't save w and b because they are constant
+            out = getattr(self.activations, 'h%d'%layer)[rows]
+            layer_input = affine_relu_forward(layer_input, p['shared.W%d'%layer], p['shared.b%d'%layer], out=out)
 
         # run it through polilcy last layer to get activations
-        logits, last_cache = affine_forward(layer_input, self.params['policy.W'], self.params['policy.b'])
-        self._add_to_cache(self.num_layers, last_cache)
+        logits = affine_forward(layer_input, p['policy.W'], p['policy.b'])
 
         # run it through value last layer to get baseline value
-        value_est, value_est_cache = affine_forward(layer_input, self.params['value.W'], self.params['value.b'])
-        self._add_to_cache('value_est', value_est_cache)
+        value_est = value_head_forward(layer_input, p['value.W'], p['value.b'])
 
         # pass through a softmax to get probabilities 
-        scores = softmax_forward(logits)
-        self._add_to_cache('soft', scores)
+        scores = softmax_forward(logits, out=logits)
 
         return scores, value_est
 
@@ -140,30 +129,29 @@ class Policy(object):
     def backward(self, dpolicy, dbaseline):
         """
         Chain rule the derivatives backward through all network computations, 
-        and set self.grads for each of the weights (to be used in stochastic gradient descent optimization (adam))
-        """
-        dout, dw, db = affine_backward(dpolicy, self._cache_to_list(self.cache[self.num_layers]))
-        self._set_grad('policy.W', dw)
-        self._set_grad('policy.b', db)
+        and write the gradients of each of the weights into self.params.grads (to be used in stochastic gradient descent optimization (adam))
 
-#        import ipdb; ipdb.set_trace()
-        dval, dvalw, dvalb = affine_backward(dbaseline, self._cache_to_list(self.cache['value_est']))
-        self._set_grad('value.W', dvalw)
-        self._set_grad('value.b', dvalb)
+        Params:
+            dpolicy: gradient signal w.r.t. the policy logits, one row per forward pass input
+            dbaseline: gradient signal w.r.t. the value estimates, of shape (N, 1)
+        """
+        p, grads, acts = self.params, self.params.grads, self.activations
+        hidden = [acts.x] + [getattr(acts, 'h%d'%i) for i in range(self.num_layers)]
+        dpolicy = np.asarray(dpolicy, dtype=self.dtype)
+        dbaseline = np.asarray(dbaseline, dtype=self.dtype)
 
-        assert(dval.shape == dout.shape)
-        dout += dval
+        dout, _, _ = affine_backward(dpolicy, hidden[-1], p['policy.W'],
+                                     dw=grads['policy.W'], db=grads['policy.b'])
+        # adds the value head gradient into dout
+        value_head_backward(dbaseline, hidden[-1], p['value.W'], dout,
+                            dw=grads['value.W'], db=grads['value.b'])
 
         for i in reversed(range(self.num_layers)):
-            fc_cache, relu_cache = zip(*self.cache[i])
-            fc_cache = self._cache_to_list(fc_cache)
-            relu_cache = np.concatenate(relu_cache)
-            dout, dw, db = affine_relu_backward(dout, (fc_cache, relu_cache))
-            self._set_grad('shared.W%d'%i, dw)
-            self._set_grad('shared.b%d'%i, db)
+            dout, _, _ = affine_relu_backward(dout, hidden[i], hidden[i+1], p['shared.W%d'%i],
+                                              dw=grads['shared.W%d'%i], db=grads['shared.b%d'%i])
 
         # reset cache for next backward pass
-        self.cache = {}
+        self.activations.clear()
 
 ob_n = env.observation_space.shape[0]
 ac_n = env.action_space.n
@@ -175,70 +163,55 @@ def select_action(obs):
     of dsoftmax to use to update weights
     """
     obs = np.reshape(obs, [1, -1])
-    probs, value = policy.forward(obs)
-    probs = probs[0]
-    value = value[0]
-    action = np.random.choice(policy.ac_n, p=probs)
+    with profiler.phase('forward'):
+        probs, value = policy.forward(obs)
+    value = value[0, 0]
     # I am not really sure if this signal is standard or if the math checks out,
-    # but it works and it makes sense
+    # but it works and it makes sense (dsoftmax = onehot(action) - probs)
     # 1. for actions not taken, decrease weights proportional to their probabilties
     # (if the reward is positive, this will make these less probable after updating)
-    dsoftmax = -probs 
     # 2. for the action that was chose, if the probability was loss, this will be higher
     # (if the reward is positive, this will make these more probable after updating)
-    dsoftmax[action] += 1
+    with profiler.phase('sample'):
+        actions, dsoftmax = sample_categorical(probs, rng)
+        action = actions[0]
 
-    policy.saved_neg_log_probs.append(dsoftmax)
-    policy.saved_values.append(value)
+        policy.buffer.add(neg_log_probs=dsoftmax[0], values=value)
 
     # this is what is used in other implementations that I have seen, but I couldn't
     # figure out how to make it work
     #neg_log = -np.log(probs[action])
-    #policy.saved_neg_log_probs.append(neg_log)
+    #policy.buffer.add(neg_log_probs=neg_log)
     return action
 
 def finish_episode():
     """
     At the end of the episode, calculate the discounted return for each time step
     """
-    next_return = 0
-    policy_loss = []
-    returns = []
-
-    # Calculate return and normalize it
-    for R in policy.rewards[::-1]:
-        next_return = R + next_return
-        returns.insert(0, next_return)
-    returns = np.array(returns)
-    returns = (returns - returns.mean()) / (returns.std() + np.finfo(np.float32).eps)
-    
-    values = np.stack(policy.saved_values)
-    deltas = []
+    # Calculate (undiscounted) return and normalize it
+    with profiler.phase('returns'):
+        returns = calculate_discounted_returns(policy.buffer.rewards, gamma=1.0)
+    values = policy.buffer.values
+    deltas = returns - values
 
     # TODO: if it doesn't work, follow book exactly (discounted return...)
     # Multiply the signal that makes actions taken more probable by the discounted
     # return of that action.  This will pull the weights in the direction that
     # makes *better* actions more probable.
-    steps_to_end = len(returns)
-    for neg_log_prob, G_t, value in zip(policy.saved_neg_log_probs, returns, values):
-        delta = G_t - value
-        policy_loss.append(neg_log_prob * (args.gamma**steps_to_end)*delta)
-        deltas.append(delta)
-        steps_to_end -= 1
-    assert(steps_to_end == 0)
-
-    # negate these because we want gradient ascent, not descent
-    policy.backward(-np.stack(policy_loss), -np.stack(deltas))
-
-    # run an optimization step on all of the model parameters
-    for p in policy.params:
-        next_w, policy.adam_configs[p] = adam(policy.params[p], policy.grads[p], config=policy.adam_configs[p])
-        policy.params[p] = next_w
-    policy.zero_grads() # required every call to adam
-
-    del policy.rewards[:]
-    del policy.saved_neg_log_probs[:]
-    del policy.saved_values[:]
+    steps_to_end = np.arange(len(returns), 0, -1)
+    policy_loss = policy.buffer.neg_log_probs * ((args.gamma**steps_to_end) * deltas)[:, None]
+
+    with profiler.phase('backward'):
+        # negate these because we want gradient ascent, not descent
+        policy.backward(-policy_loss, -deltas[:, None])
+
+    with profiler.phase('optimizer'):
+        # run an optimization step on all of the model parameters
+        policy.optimizer.step()
+        policy.zero_grads() # required every call to adam
+    profiler.update()
+
+    policy.buffer.clear()
 
 def main():
     """Run REINFORCE algorithm to train on the environment"""
@@ -248,21 +221,25 @@ def main():
         obs = env.reset()
         for t in range(10000):  # Don't infinite loop while learning
             action = select_action(obs)
-            obs, reward, done, _ = env.step(action)
+            with profiler.phase('env_step'):
+                obs, reward, done, _ = env.step(action)
+            profiler.step()
             ep_reward += reward
-            policy.rewards.append(reward)
+            policy.buffer.set_last(rewards=reward)
 
             if done:
                 break
 
         finish_episode()
+        profiler.end_episode()
 
         if i_episode % args.log_interval == 0:
             print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+            profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
             avg_reward = []
 
         else:
             avg_reward.append(ep_reward)
 
 if __name__ == '__main__':
-    main()
+    profiler.run(main)
@@ -0,0 +1,194 @@
+import numpy as np
+
+"""
+Storage for the trajectories collected by the RL agents.
+
+Instead of appending every step to python lists and converting them with
+np.array at the end of the episode, steps are written straight into
+preallocated, typed numpy columns.  Several episodes can be stored back to
+back, so an agent can collect a batch of episodes and then do all of its
+return calculations, backward pass and optimizer step once for the whole batch.
+"""
+
+
+class TrajectoryBuffer(object):
+    """
+    Preallocated column storage for the steps of one or more episodes.
+
+    Every column is its own numpy array with a leading time axis (so each one
+    is contiguous and can go straight into vectorized math).  Episodes are laid
+    out back to back and `dones` marks the last step of each one.  Reading a
+    column as an attribute (e.g. buffer.rewards) gives a view of the stored
+    steps in time order, never a copy.
+
+    Two storage modes:
+    - growing (default): capacity doubles when full, so add() is amortized O(1)
+    - ring (ring=True): capacity is fixed and the oldest steps are overwritten.
+      Every step is written twice, at i and i + capacity, so the most recent
+      `capacity` steps are always one contiguous window (zero-copy views)
+
+    Inputs:
+    - capacity: number of steps to preallocate
+    - dtype: default datatype of the columns
+    - ring: use a fixed size ring instead of growing
+    - columns: name=shape of a single step, or name=(shape, dtype)
+      e.g. action_gradients=(ac_n,), rewards=(), actions=((), np.int64)
+    """
+    def __init__(self, capacity=1024, dtype=np.float32, ring=False, **columns):
+        self.capacity = capacity
+        self.ring = ring
+        self.specs = {}
+        for name, spec in columns.items():
+            if len(spec) == 2 and not isinstance(spec[1], (int, np.integer)):
+                shape, col_dtype = spec
+            else:
+                shape, col_dtype = spec, dtype
+            self.specs[name] = (tuple(shape), np.dtype(col_dtype))
+        self.specs.setdefault('dones', ((), np.dtype(bool)))
+
+        rows = 2*capacity if ring else capacity
+        self._columns = {name: np.zeros((rows,) + shape, dtype=col_dtype)
+                         for name, (shape, col_dtype) in self.specs.items()}
+        self.clear()
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('_columns', {})
+        if name in columns:
+            return columns[name][self._start:self._start + self.size]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def num_episodes(self):
+        """Number of finished episodes in the buffer"""
+        if self.ring:
+            oldest = self.total_steps - self.size
+            while self._ep_ends and self._ep_ends[0] < oldest:
+                self._ep_ends.pop(0)
+        return len(self._ep_ends)
+
+    @property
+    def ep_starts(self):
+        """Offset of the start of each finished episode (plus the end of the last one)"""
+        first = self.total_steps - self.size
+        return [0] + [end + 1 - first for end in self._ep_ends[:self.num_episodes]]
+
+    def _grow(self):
+        self.capacity *= 2
+        for name, col in self._columns.items():
+            new_col = np.zeros((self.capacity,) + col.shape[1:], dtype=col.dtype)
+            new_col[:self.size] = col[:self.size]
+            self._columns[name] = new_col
+
+    def _row(self):
+        """Row (or rows, in ring mode) holding the most recent step"""
+        i = self._start + self.size - 1
+        if self.ring:
+            i %= self.capacity
+            return [i, i + self.capacity]
+        return i
+
+    def add(self, **values):
+        """Start a new step and write the given column values for it"""
+        if self.ring:
+            if self.size == self.capacity:
+                # drop the oldest step
+                self._start = (self._start + 1) % self.capacity
+                self.size -= 1
+        elif self.size == self.capacity:
+            self._grow()
+        self.size += 1
+        self.total_steps += 1
+        row = self._row()
+        self._columns['dones'][row] = False
+        for name, val in values.items():
+            self._columns[name][row] = val
+
+    def reserve(self, n=1):
+        """
+        Start n new steps without writing anything and return the slice of the
+        column views that holds them, so values can be computed straight into
+        the storage (e.g. np.dot(..., out=buffer.h0[rows])).  Growing mode only,
+        since a ring buffer writes every step to two places
+        """
+        if self.ring:
+            raise ValueError('reserve() is not supported for ring buffers')
+        while self.size + n > self.capacity:
+            self._grow()
+        self._columns['dones'][self.size:self.size + n] = False
+        self.size += n
+        self.total_steps += n
+        return slice(self.size - n, self.size)
+
+    def set_last(self, **values):
+        """Write column values for the most recent step (e.g. the reward that came after the action)"""
+        row = self._row()
+        for name, val in values.items():
+            self._columns[name][row] = val
+
+    def end_episode(self):
+        """Mark the most recent step as the end of an episode"""
+        last = self.total_steps - 1
+        if self.size > 0 and (not self._ep_ends or self._ep_ends[-1] != last):
+            self._columns['dones'][self._row()] = True
+            self._ep_ends.append(last)
+
+    def clear(self):
+        """Forget all stored steps (storage is kept for reuse)"""
+        self._start = 0
+        self.size = 0
+        self.total_steps = 0
+        self._ep_ends = []
+
+
+def make_trajectory_buffer(ob_n, ac_shape=(), ac_dtype=np.int64, obs_dtype=np.float32,
+                           capacity=1024, ring=False, **extra_columns):
+    """
+    TrajectoryBuffer with the standard columns used by the agents:
+    obs, actions, rewards, dones, values and logps (log-prob of the taken action).
+
+    obs_dtype=np.float16 halves the memory of the largest column for long
+    episodes.  Any extra columns (e.g. action_gradients=(ac_n,)) are passed on.
+    """
+    return TrajectoryBuffer(capacity=capacity, ring=ring,
+                            obs=((ob_n,), obs_dtype),
+                            actions=(tuple(ac_shape), ac_dtype),
+                            rewards=(), values=(), logps=(),
+                            **extra_columns)
+
+
+def iterate_minibatches(columns, minibatch_size, rng, scratch=None):
+    """
+    One epoch of shuffled minibatches over a batch of steps, for doing several
+    epochs of updates on the same collected data.
+
+    The rows of every column are permuted once per epoch into a scratch array
+    (reused from call to call), and the minibatches are then contiguous slices
+    of it: plain views, so no fancy-indexing copy per minibatch.
+
+    Inputs:
+    - columns: dict of name -> array, all with the same number of rows
+      (e.g. dict(obs=buffer.obs, actions=buffer.actions, ...))
+    - minibatch_size: rows per minibatch (<= 0 for the whole batch at once)
+    - rng: numpy.random.Generator used for the shuffle
+    - scratch: dict to keep the scratch arrays in between calls
+
+    Yields dicts of name -> minibatch view
+    """
+    if scratch is None:
+        scratch = {}
+    n = len(next(iter(columns.values())))
+    if minibatch_size <= 0:
+        minibatch_size = n
+    perm = rng.permutation(n)
+    shuffled = {}
+    for name, col in columns.items():
+        buf = scratch.get(name)
+        if buf is None or len(buf) < n or buf.shape[1:] != col.shape[1:] or buf.dtype != col.dtype:
+            buf = scratch[name] = np.empty((n,) + col.shape[1:], dtype=col.dtype)
+        np.take(col, perm, axis=0, out=buf[:n])
+        shuffled[name] = buf
+    for start in range(0, n, minibatch_size):
+        yield {name: buf[start:start + minibatch_size] for name, buf in shuffled.items()}
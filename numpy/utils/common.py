@@ -1,40 +1,178 @@
-class CacheDict(dict):
-    def __init__(self, *args):
-        dict.__init__(self, args)
-
-    def __getitem__(self, key):
-        if dict.__contains__(self, key):
-            val = dict.__getitem__(self, key)
-        else:
-            val = [] 
-            dict.__setitem__(self, key, val)
-        return val
-
-    def __setitem__(self, key, val):
-        dict.__setitem__(self, key, val)
-
-class GradDict(dict):
-    def __init__(self, *args):
-        dict.__init__(self, args)
-
-    def __getitem__(self, key):
-        if dict.__contains__(self, key):
-            val = dict.__getitem__(self, key)
-        else:
-            val = 0
-            dict.__setitem__(self, key, val)
-        return val
-
-    def __setitem__(self, key, val):
-        dict.__setitem__(self, key, val)
-
-
-def softmax(x):
-    shifted_logits = x - np.max(x, axis=1, keepdims=True)
-    Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-    log_probs = shifted_logits - np.log(Z)
-    probs = np.exp(log_probs)
-    return probs
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
+
+
+def shared_zeros(size, dtype=np.float32):
+    """
+    Flat zeroed array backed by shared memory. Worker processes that are forked
+    after it is created see (and write to) the same values.
+    """
+    dtype = np.dtype(dtype)
+    buf = multiprocessing.RawArray('b', int(size) * dtype.itemsize)
+    return np.frombuffer(buf, dtype=dtype)
+
+
+class ParamStore(object):
+    """
+    Array backed storage for all of the parameters of a model and their gradients.
+
+    Storage is preallocated from the layer shapes as two flat buffers, `data`
+    for the parameter values and `grad` for the gradients.  Indexing the store
+    by name gives a view into `data` with the layer shape (`grads` holds the
+    matching views into `grad`), so the network code can keep doing
+    `params['W1']` while the optimizer and gradient checker work on the flat
+    buffers directly.  Nothing is reallocated after construction: zeroing,
+    accumulation, snapshot and restore all happen in place.
+
+    Inputs:
+    - shapes: mapping (or list of pairs) from parameter name to shape
+    - dtype: datatype of the parameters and gradients
+    - shared: put the parameter values (not the gradients) in shared memory,
+      so that forked worker processes all read and update the same parameters
+    """
+    __slots__ = ('dtype', 'data', 'grad', 'params', 'grads')
+
+    def __init__(self, shapes, dtype=np.float32, shared=False):
+        shapes = OrderedDict(shapes)
+        self.dtype = dtype
+        size = sum(int(np.prod(shape)) for shape in shapes.values())
+        self.data = shared_zeros(size, dtype) if shared else np.zeros(size, dtype=dtype)
+        self.grad = np.zeros(size, dtype=dtype)
+        self.params = OrderedDict()
+        self.grads = OrderedDict()
+        offset = 0
+        for name, shape in shapes.items():
+            n = int(np.prod(shape))
+            self.params[name] = self.data[offset:offset+n].reshape(shape)
+            self.grads[name] = self.grad[offset:offset+n].reshape(shape)
+            offset += n
+
+    def __getitem__(self, name):
+        return self.params[name]
+
+    def __setitem__(self, name, val):
+        """Copy values into the existing storage (never rebinds the view)"""
+        self.params[name][...] = val
+
+    def __contains__(self, name):
+        return name in self.params
+
+    def __iter__(self):
+        return iter(self.params)
+
+    def __len__(self):
+        return len(self.params)
+
+    def keys(self):
+        return self.params.keys()
+
+    def items(self):
+        return self.params.items()
+
+    def zero_grad(self):
+        """Reset all gradients to 0 in place"""
+        self.grad.fill(0)
+
+    def accumulate(self, name, val):
+        """Add val to the gradient of a parameter in place"""
+        self.grads[name] += val
+
+    def snapshot(self, out=None):
+        """Copy of all parameter values (into out if given)"""
+        if out is None:
+            return self.data.copy()
+        np.copyto(out, self.data)
+        return out
+
+    def restore(self, snapshot):
+        """Overwrite all parameter values with a snapshot"""
+        np.copyto(self.data, snapshot)
+
+
+# Softmax kernels shared by the agents.  They work on (N, C) batches of logits,
+# row by row, and go through exp only once: the only temporaries are (N, 1)
+# row maxes / sums, everything else is written into out (which can be x itself).
+
+def softmax(x, out=None):
+    """
+    Row-wise softmax.
+
+    Inputs:
+    - x: logits, of shape (N, C)
+    - out: optional buffer of shape (N, C) to write into (can be x)
+
+    Returns:
+    - out: probabilities, of shape (N, C)
+    """
+    out = np.subtract(x, np.max(x, axis=1, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= np.sum(out, axis=1, keepdims=True)
+    return out
+
+
+def log_softmax(x, out=None):
+    """
+    Row-wise log of the softmax, shifted_logits - log(sum(exp(shifted_logits))).
+    (the exp here is only summed, so it still needs one (N, C) temporary)
+
+    Inputs:
+    - x: logits, of shape (N, C)
+    - out: optional buffer of shape (N, C) to write into (can be x)
+
+    Returns:
+    - out: log probabilities, of shape (N, C)
+    """
+    out = np.subtract(x, np.max(x, axis=1, keepdims=True), out=out)
+    out -= np.log(np.sum(np.exp(out), axis=1, keepdims=True))
+    return out
+
+
+def softmax_log_softmax(x, probs=None, log_probs=None):
+    """
+    Probabilities and log probabilities from one pass over the logits.
+
+    Inputs:
+    - x: logits, of shape (N, C)
+    - probs, log_probs: optional (separate) buffers of shape (N, C) to write
+      into, either one can be x
+
+    Returns a tuple of:
+    - probs: of shape (N, C)
+    - log_probs: of shape (N, C)
+    """
+    log_probs = np.subtract(x, np.max(x, axis=1, keepdims=True), out=log_probs)
+    probs = np.exp(log_probs, out=probs)
+    Z = np.sum(probs, axis=1, keepdims=True)
+    probs /= Z
+    log_probs -= np.log(Z)
+    return probs, log_probs
+
+
+def policy_gradient_logits(probs, actions, weights=None, out=None):
+    """
+    Gradient of sum_i weights[i] * log(pi(actions[i] | s_i)) w.r.t. the logits,
+    weights[:, None] * (onehot(actions) - probs), without building the onehot.
+    Negate it for the backward pass of a loss to minimize.
+
+    Inputs:
+    - probs: softmax probabilities, of shape (N, C)
+    - actions: taken actions, of shape (N,)
+    - weights: returns / advantages of the actions, of shape (N,).  None means
+      all ones (just onehot(actions) - probs)
+    - out: optional buffer of shape (N, C) to write into (can be probs)
+
+    Returns:
+    - out: of shape (N, C)
+    """
+    rows = np.arange(len(actions))
+    if weights is None:
+        out = np.negative(probs, out=out)
+        out[rows, actions] += 1
+    else:
+        out = np.multiply(probs, -weights[:, None], out=out)
+        out[rows, actions] += weights
+    return out
 
 
 def mse_loss(pred, label):
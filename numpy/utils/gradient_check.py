@@ -2,7 +2,9 @@ from __future__ import print_function
 from builtins import range
 from past.builtins import xrange
 
+import os
 import numpy as np
+from multiprocessing import Pool
 from random import randrange
 
 
@@ -113,6 +115,127 @@ def eval_numerical_gradient_net(net, inputs, output, h=1e-5):
                 inputs, output, h=h)
 
 
+def eval_numerical_gradient_params(f, params, h=1e-5):
+    """
+    Numerical gradient of a scalar function w.r.t. every parameter in a
+    utils.common.ParamStore.
+
+    - f takes no arguments and reads the current values out of params
+    - returns a flat array laid out like params.grad, so it can be compared
+      directly against the analytic gradient with rel_error
+
+    The parameter values are perturbed in place and restored from a snapshot
+    at the end.
+    """
+    x = params.data
+    saved = params.snapshot()
+    grad = np.zeros_like(x)
+    for i in range(x.size):
+        oldval = x[i]
+        x[i] = oldval + h
+        fxph = f()
+        x[i] = oldval - h
+        fxmh = f()
+        x[i] = oldval
+        grad[i] = (fxph - fxmh) / (2 * h)
+    params.restore(saved)
+    return grad
+
+
+def eval_numerical_gradient_batched(f, x, df=None, h=1e-5, chunk_size=None, max_bytes=2**22):
+    """
+    Same centered differences as eval_numerical_gradient (or
+    eval_numerical_gradient_array with df), but many perturbed copies of x are
+    evaluated with one call of f instead of two calls per coordinate.
+
+    Inputs:
+    - f: function that takes a batch of points xs, shape (B,) + x.shape, and
+      returns the B outputs stacked, shape (B,) for a scalar f or (B,) + out_shape
+    - x: point (numpy array) to evaluate the gradient at, not modified
+    - df: upstream gradient of shape out_shape, or None for a scalar f
+    - h: step size
+    - chunk_size: coordinates perturbed per call of f (2 * chunk_size copies
+      of x per batch).  Defaults to what fits in max_bytes
+    - max_bytes: memory bound for the batch of perturbed copies (small batches
+      that stay in cache tend to be faster than one huge one)
+
+    Returns:
+    - grad: numerical gradient, shape of x
+    """
+    x = np.asarray(x)
+    flat_x = x.ravel()
+    n = flat_x.size
+    if chunk_size is None:
+        chunk_size = max(1, max_bytes // (2 * max(x.nbytes, 1)))
+    chunk_size = min(chunk_size, n)
+
+    grad = np.zeros(n, dtype=x.dtype)
+    # reused for every chunk: rows [0, C) get +h, rows [C, 2C) get -h
+    xs = np.empty((2 * chunk_size, n), dtype=x.dtype)
+    for start in range(0, n, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, n))
+        C = len(idx)
+        batch = xs[:2 * C]
+        batch[...] = flat_x
+        rows = np.arange(C)
+        batch[rows, idx] = flat_x[idx] + h
+        batch[C + rows, idx] = flat_x[idx] - h
+
+        out = np.asarray(f(batch.reshape((2 * C,) + x.shape)))
+        diff = out[:C] - out[C:]
+        if df is not None:
+            diff = np.sum((diff * df).reshape(C, -1), axis=1)
+        grad[idx] = diff / (2 * h)
+    return grad.reshape(x.shape)
+
+
+def _centered_differences(job):
+    """Pool worker of eval_numerical_gradient_pool: centered differences of f over some coordinates of x"""
+    f, x, df, h, idx = job
+    x = x.copy()
+    flat_x = x.reshape(-1)
+    grad = np.zeros(len(idx), dtype=x.dtype)
+    for j, i in enumerate(idx):
+        oldval = flat_x[i]
+        flat_x[i] = oldval + h
+        pos = np.copy(f(x))
+        flat_x[i] = oldval - h
+        neg = np.copy(f(x))
+        flat_x[i] = oldval
+        grad[j] = (pos - neg) / (2 * h) if df is None else np.sum((pos - neg) * df) / (2 * h)
+    return grad
+
+
+def eval_numerical_gradient_pool(f, x, df=None, h=1e-5, processes=None, chunk_size=None):
+    """
+    eval_numerical_gradient / eval_numerical_gradient_array for a black box f
+    that can't take a batch: the coordinates are split into chunks that are
+    worked through by a pool of processes.
+
+    Inputs:
+    - f: function of a single point, returning a scalar (or an array with df).
+      It is sent to the worker processes, so it has to be picklable (a module
+      level function or a functools.partial of one, not a lambda)
+    - x: point (numpy array) to evaluate the gradient at, not modified
+    - df: upstream gradient for an array valued f, or None for a scalar f
+    - h: step size
+    - processes: number of worker processes (default: os.cpu_count())
+    - chunk_size: coordinates per job (default: about 4 jobs per process)
+
+    Returns:
+    - grad: numerical gradient, shape of x
+    """
+    x = np.asarray(x)
+    n = x.size
+    processes = processes or os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, -(-n // (4 * processes)))
+    jobs = [(f, x, df, h, np.arange(start, min(start + chunk_size, n))) for start in range(0, n, chunk_size)]
+    with Pool(processes) as pool:
+        grads = pool.map(_centered_differences, jobs)
+    return np.concatenate(grads).reshape(x.shape)
+
+
 def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
     """
     sample a few random elements and only return numerical
@@ -137,6 +260,88 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
               %(grad_numerical, grad_analytic, rel_error))
 
 
+def grad_check_directions(f, x, analytic_grad, num_directions=10, h=1e-5, rng=None, distribution='gaussian'):
+    """
+    Check an analytic gradient against directional derivatives along random
+    unit directions u:
+
+        (f(x + h*u) - f(x - h*u)) / (2h)  vs  analytic_grad . u
+
+    This takes 2 * num_directions evaluations of f no matter how big x is, and
+    every direction moves all of the coordinates at once, so an error anywhere
+    in the gradient shows up (unlike grad_check_sparse, which only looks at a
+    few coordinates).  With distribution='rademacher' the directions are random
+    +-1 per coordinate (normalized), like the perturbations of SPSA.
+
+    Inputs:
+    - f: scalar function that takes a single argument
+    - x: point (numpy array) to check the gradient at.  It is perturbed in
+      place (so f can also read it from somewhere else, e.g. a ParamStore) and
+      restored afterwards, so it has to be C contiguous (a ValueError is raised
+      otherwise, since the flat view would be a copy and f would never see the
+      perturbations)
+    - analytic_grad: gradient of f at x, same shape as x
+    - num_directions: number of random directions
+    - h: step size
+    - rng: np.random.Generator (default: a new unseeded one)
+    - distribution: 'gaussian' or 'rademacher'
+
+    Returns a dict of:
+    - rel_errors: relative error along every direction, shape (num_directions,)
+    - max_rel_error, mean_rel_error, median_rel_error: stats of rel_errors
+    - numerical, analytic: the directional derivatives, shape (num_directions,)
+    - num_evals: calls of f that were made
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    analytic_grad = np.asarray(analytic_grad).ravel()
+    flat_x = x.reshape(-1)  # a view, so perturbing it perturbs x
+    if not np.shares_memory(flat_x, x):
+        raise ValueError('x has to be C contiguous to be perturbed in place, use np.ascontiguousarray(x)')
+    saved = flat_x.copy()
+    numerical = np.zeros(num_directions)
+    analytic = np.zeros(num_directions)
+    for k in range(num_directions):
+        if distribution == 'gaussian':
+            u = rng.standard_normal(flat_x.size)
+        elif distribution == 'rademacher':
+            u = rng.choice([-1.0, 1.0], size=flat_x.size)
+        else:
+            raise ValueError('unknown distribution {}'.format(distribution))
+        u /= np.linalg.norm(u)
+
+        flat_x[:] = saved + h * u
+        fxph = f(x)
+        flat_x[:] = saved - h * u
+        fxmh = f(x)
+        flat_x[:] = saved
+
+        numerical[k] = (fxph - fxmh) / (2 * h)
+        analytic[k] = analytic_grad.dot(u)
+
+    rel_errors = np.abs(numerical - analytic) / np.maximum(1e-8, np.abs(numerical) + np.abs(analytic))
+    return dict(rel_errors=rel_errors,
+                max_rel_error=rel_errors.max(),
+                mean_rel_error=rel_errors.mean(),
+                median_rel_error=np.median(rel_errors),
+                numerical=numerical,
+                analytic=analytic,
+                num_evals=2 * num_directions)
+
+
+def grad_check_directions_params(f, params, analytic_grad, num_directions=10, h=1e-5, rng=None, distribution='gaussian'):
+    """
+    grad_check_directions for every parameter in a utils.common.ParamStore at
+    once (f takes no arguments and reads the current values out of params,
+    like eval_numerical_gradient_params).  analytic_grad is laid out like
+    params.grad, e.g. a copy of it after backward()
+    """
+    saved = params.snapshot()
+    stats = grad_check_directions(lambda _: f(), params.data, analytic_grad, num_directions=num_directions,
+                                  h=h, rng=rng, distribution=distribution)
+    params.restore(saved)
+    return stats
+
+
 def rel_error(x, y):
   """ returns relative error """
   return np.max(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
@@ -0,0 +1,165 @@
+import numpy as np
+
+from .common import softmax
+
+"""
+Forward and backward kernels for the fully connected layers of the policies.
+
+Same idea as the CS231N layers (http://cs231n.github.io/), with a few changes
+to make them cheap to call every environment step:
+- nothing but the activations needs to be kept for the backward pass (no
+  (x, w, b) cache tuples, the weights are passed in again at backward time)
+- every kernel can write into caller provided buffers (out=, dx=, dw=, db=),
+  e.g. rows of a preallocated activation buffer or the views of a ParamStore
+- the bias add and the ReLU (and its mask in the backward pass) are done in
+  place on the affine output instead of making new arrays
+
+Gradients are written into dw and db, not accumulated.
+"""
+
+
+def affine_forward(x, w, b, out=None):
+    """
+    Computes the forward pass for an affine (fully-connected) layer.
+
+    Inputs:
+    - x: Input data, of shape (N, D)
+    - w: Weights, of shape (D, M)
+    - b: Biases, of shape (M,)
+    - out: Optional buffer of shape (N, M) (same dtype as x and w) to write into
+
+    Returns:
+    - out: output, of shape (N, M)
+    """
+    out = np.dot(x, w, out=out)
+    out += b
+    return out
+
+
+def affine_backward(dout, x, w, dx=None, dw=None, db=None):
+    """
+    Computes the backward pass for an affine layer.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M)
+    - x: Input data of the forward pass, of shape (N, D)
+    - w: Weights, of shape (D, M)
+    - dx, dw, db: Optional buffers to write the gradients into
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, D)
+    - dw: Gradient with respect to w, of shape (D, M)
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    dx = np.dot(dout, w.T, out=dx)
+    dw = np.dot(x.T, dout, out=dw)
+    db = np.sum(dout, axis=0, out=db)
+    return dx, dw, db
+
+
+def affine_relu_forward(x, w, b, out=None):
+    """
+    Affine transform followed by a ReLU, with the bias add and the ReLU done
+    in place on the output buffer.
+
+    Inputs:
+    - x: Input to the affine layer, of shape (N, D)
+    - w, b: Weights for the affine layer
+    - out: Optional buffer of shape (N, M) to write into
+
+    Returns:
+    - out: Output from the ReLU, of shape (N, M).  This is also all the
+      backward pass needs (out > 0 exactly where the ReLU was active)
+    """
+    out = affine_forward(x, w, b, out=out)
+    np.maximum(out, 0, out=out)
+    return out
+
+
+def affine_relu_backward(dout, x, out, w, dx=None, dw=None, db=None):
+    """
+    Backward pass for the affine-relu convenience layer.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M).  The ReLU mask is applied to
+      it in place, so it is overwritten
+    - x: Input of the forward pass, of shape (N, D)
+    - out: Output of the forward pass, of shape (N, M)
+    - w: Weights, of shape (D, M)
+    - dx, dw, db: Optional buffers to write the gradients into
+
+    Returns a tuple of:
+    - dx, dw, db: Gradients with respect to x, w and b
+    """
+    dout *= out > 0
+    return affine_backward(dout, x, w, dx=dx, dw=dw, db=db)
+
+
+def softmax_forward(x, out=None):
+    """
+    Row-wise softmax, computed in place in out (which can be x itself).
+
+    Inputs:
+    - x: Logits, of shape (N, C)
+    - out: Optional buffer of shape (N, C) to write into
+
+    Returns:
+    - out: probabilities, of shape (N, C)
+    """
+    return softmax(x, out=out)
+
+
+def softmax_backward(dout, probs, dx=None):
+    """
+    Backward pass for the softmax.
+
+    Inputs:
+    - dout: Upstream derivative w.r.t. the probabilities, of shape (N, C)
+    - probs: Output of the forward pass, of shape (N, C)
+    - dx: Optional buffer to write the gradient into
+
+    Returns:
+    - dx: Gradient with respect to the logits, of shape (N, C)
+    """
+    dx = np.subtract(dout, np.sum(dout * probs, axis=1, keepdims=True), out=dx)
+    dx *= probs
+    return dx
+
+
+def value_head_forward(x, w, b, out=None):
+    """
+    Scalar state value estimate from the last hidden layer.
+
+    Inputs:
+    - x: Hidden activations, of shape (N, D)
+    - w: Weights, of shape (D, 1)
+    - b: Bias, of shape (1,)
+    - out: Optional buffer of shape (N, 1) to write into
+
+    Returns:
+    - out: values, of shape (N, 1)
+    """
+    return affine_forward(x, w, b, out=out)
+
+
+def value_head_backward(dvalue, x, w, dx, dw=None, db=None):
+    """
+    Backward pass for the value head.  The value head shares its input with
+    the policy head, so its gradient w.r.t. x is added into dx (which already
+    holds the gradient from the policy head) instead of making a new array.
+
+    Inputs:
+    - dvalue: Upstream derivative, of shape (N, 1)
+    - x: Hidden activations of the forward pass, of shape (N, D)
+    - w: Weights, of shape (D, 1)
+    - dx: Gradient buffer of shape (N, D) to accumulate into
+    - dw, db: Optional buffers to write the gradients into
+
+    Returns a tuple of:
+    - dx, dw, db: Gradients with respect to x, w and b
+    """
+    # (N, 1) x (D,) outer product, no need for a matrix multiply
+    dx += dvalue * w[:, 0]
+    dw = np.dot(x.T, dvalue, out=dw)
+    db = np.sum(dvalue, axis=0, out=db)
+    return dx, dw, db
@@ -1,4 +1,3 @@
-import numpy as np
 """
 THIS IS FROM TAKEN FROM STANFORD'S CS231N COURSE, WHICH I HIGHLY RECOMMEND 
 http://cs231n.github.io/
@@ -31,6 +30,11 @@ For efficiency, update rules may perform in-place updates, mutating w and
 setting next_w equal to w.
 """
 
+import numpy as np
+
+from .common import shared_zeros
+
+
 
 def sgd(w, dw, config=None):
     """
@@ -85,3 +89,169 @@ def adam(x, dx, config=None):
     next_x = x
 
     return next_x, config
+
+
+"""
+Fused versions of the update rules above.
+
+Instead of being called once per parameter tensor with a config dict, these
+keep every parameter, gradient and moment estimate of a model in single
+contiguous flat buffers (the `data` and `grad` arrays of a utils.common.ParamStore).
+The model indexes into per-layer views of those buffers, so one step()
+updates the whole model with a handful of in-place vectorized ops and no
+temporary allocations.
+
+Usage:
+    params = ParamStore({'W1': (ob_n, H), 'b1': (H,), ...})
+    optimizer = FusedAdam(params.data, params.grad, learning_rate=1e-3)
+    ... params.accumulate('W1', dW1) ...
+    optimizer.step()
+    params.zero_grad()
+"""
+
+
+class FusedOptimizer(object):
+    """
+    Base class for the fused update rules.
+
+    Inputs:
+    - params: flat array of parameters, updated in place by step()
+    - grads: flat array of gradients of the loss w.r.t. params (same size)
+    - shared: keep the optimizer state (moments, step count) in shared memory,
+      so that forked worker processes can all step the same (shared) params
+      without locks, Hogwild style
+    - config: hyperparameters, same names as the functional update rules
+    """
+    defaults = {'learning_rate': 1e-2}
+
+    def __init__(self, params, grads, shared=False, **config):
+        assert params.shape == grads.shape
+        self.params = params
+        self.grads = grads
+        self.shared = shared
+        self.config = dict(self.defaults, **config)
+        # scratch space so that step() never allocates
+        self._tmp = np.empty_like(params)
+
+    def _zeros(self, size=None, dtype=None):
+        """Zeroed optimizer state (in shared memory if needed)"""
+        size = self.params.size if size is None else size
+        dtype = self.params.dtype if dtype is None else dtype
+        return shared_zeros(size, dtype) if self.shared else np.zeros(size, dtype=dtype)
+
+    def step(self):
+        raise NotImplementedError
+
+
+class FusedSGD(FusedOptimizer):
+    """
+    Vanilla stochastic gradient descent.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    """
+    def step(self):
+        np.multiply(self.grads, self.config['learning_rate'], out=self._tmp)
+        self.params -= self._tmp
+
+
+class FusedMomentum(FusedOptimizer):
+    """
+    Stochastic gradient descent with momentum.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - momentum: Scalar between 0 and 1 giving the momentum value.
+    """
+    defaults = {'learning_rate': 1e-2, 'momentum': 0.9}
+
+    def __init__(self, params, grads, shared=False, **config):
+        super(FusedMomentum, self).__init__(params, grads, shared, **config)
+        self.velocity = self._zeros()
+
+    def step(self):
+        # v = momentum * v - learning_rate * dw
+        # w += v
+        v = self.velocity
+        v *= self.config['momentum']
+        np.multiply(self.grads, self.config['learning_rate'], out=self._tmp)
+        v -= self._tmp
+        self.params += v
+
+
+class FusedRMSProp(FusedOptimizer):
+    """
+    Uses the RMSProp update rule, which uses a moving average of squared
+    gradient values to set adaptive per-parameter learning rates.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - decay_rate: Scalar between 0 and 1 giving the decay rate for the squared
+      gradient cache.
+    - epsilon: Small scalar used for smoothing to avoid dividing by zero.
+    """
+    defaults = {'learning_rate': 1e-2, 'decay_rate': 0.99, 'epsilon': 1e-8}
+
+    def __init__(self, params, grads, shared=False, **config):
+        super(FusedRMSProp, self).__init__(params, grads, shared, **config)
+        self.cache = self._zeros()
+
+    def step(self):
+        # cache = decay_rate * cache + (1 - decay_rate) * dw**2
+        # w -= learning_rate * dw / (sqrt(cache) + eps)
+        c, dw, tmp = self.config, self.grads, self._tmp
+        np.multiply(dw, dw, out=tmp)
+        tmp *= (1 - c['decay_rate'])
+        self.cache *= c['decay_rate']
+        self.cache += tmp
+        np.sqrt(self.cache, out=tmp)
+        tmp += c['epsilon']
+        np.divide(dw, tmp, out=tmp)
+        tmp *= c['learning_rate']
+        self.params -= tmp
+
+
+class FusedAdam(FusedOptimizer):
+    """
+    Uses the Adam update rule (same numerics as adam() above).
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - beta1: Decay rate for moving average of first moment of gradient.
+    - beta2: Decay rate for moving average of second moment of gradient.
+    - epsilon: Small scalar used for smoothing to avoid dividing by zero.
+    """
+    defaults = {'learning_rate': 1e-3, 'beta1': 0.9, 'beta2': 0.999, 'epsilon': 1e-8}
+
+    def __init__(self, params, grads, shared=False, **config):
+        super(FusedAdam, self).__init__(params, grads, shared, **config)
+        self.m = self._zeros()
+        self.v = self._zeros()
+        # iteration number (an array so that it can live in shared memory too)
+        self._t = self._zeros(1, np.int64)
+
+    @property
+    def t(self):
+        return int(self._t[0])
+
+    def step(self):
+        c, dx, tmp, m, v = self.config, self.grads, self._tmp, self.m, self.v
+        beta1, beta2, eps = c['beta1'], c['beta2'], c['epsilon']
+        # m = beta1 * m + (1 - beta1) * dx
+        m *= beta1
+        np.multiply(dx, 1 - beta1, out=tmp)
+        m += tmp
+        # v = beta2 * v + (1 - beta2) * (dx * dx)
+        v *= beta2
+        np.multiply(dx, dx, out=tmp)
+        tmp *= (1 - beta2)
+        v += tmp
+        self._t[0] += 1
+        t = self.t
+        alpha = c['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+        # x -= alpha * (m / (sqrt(v) + eps))
+        np.sqrt(v, out=tmp)
+        tmp += eps
+        np.divide(m, tmp, out=tmp)
+        tmp *= alpha
+        self.params -= tmp
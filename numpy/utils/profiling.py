@@ -0,0 +1,246 @@
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import time
+from time import perf_counter
+
+"""
+Opt-in instrumentation for the training loops of the agent scripts.
+
+    profiler = make_profiler(args, 'reinforce')
+    ...
+    with profiler.phase('env_step'):
+        obs, reward, done, _ = env.step(action)
+    profiler.step()
+    ...
+    profiler.end_episode()
+    profiler.report(ave_reward=...)   # one JSON record per log interval
+
+Phase timers use the monotonic perf_counter and are only active with
+--profile_phases; otherwise phase() hands back one shared no-op context
+manager, so leaving the `with` blocks in the hot loop costs next to nothing.
+The steps / updates / episodes counters are always kept.
+
+Records are single JSON lines (appended to --profile_out, or printed), with
+the script name and its args, so runs can be diffed and compared later.
+
+--profile N runs the whole main() under cProfile, stops it after N episodes
+and prints the pstats summary (and dumps the raw stats to --profile_stats).
+
+--max_steps N stops main() after N env steps, and a final summary record over
+the whole run (cumulative phase times, peak RSS, time to --reward_threshold)
+is emitted.  benchmarks/reinforce_throughput.py uses this to compare backends.
+"""
+
+
+def add_profiling_args(parser):
+    """Add the profiling flags to an agent script's argparse parser"""
+    parser.add_argument('--profile_phases', action='store_true',
+                        help='time the phases of the training loop and emit JSON records every log interval')
+    parser.add_argument('--profile_out', type=str, default=None,
+                        help='file to append the JSON profiling records to (default: print them)')
+    parser.add_argument('--profile', type=int, default=0, metavar='N',
+                        help='if > 0, run under cProfile for N episodes, print pstats and stop (default: 0)')
+    parser.add_argument('--profile_stats', type=str, default=None,
+                        help='file to dump the raw cProfile stats to (for pstats / snakeviz)')
+    parser.add_argument('--max_steps', type=int, default=0, metavar='N',
+                        help='if > 0, stop training after this many env steps (default: 0)')
+    parser.add_argument('--reward_threshold', type=float, default=None, metavar='R',
+                        help='record the time and steps it takes the average reward to reach this')
+    return parser
+
+
+def make_profiler(args, script):
+    """Profiler configured from the parsed profiling flags"""
+    return Profiler(enabled=getattr(args, 'profile_phases', False),
+                    out=getattr(args, 'profile_out', None),
+                    cprofile_episodes=getattr(args, 'profile', 0),
+                    stats_file=getattr(args, 'profile_stats', None),
+                    max_steps=getattr(args, 'max_steps', 0),
+                    reward_threshold=getattr(args, 'reward_threshold', None),
+                    run_info=dict(script=script, args=vars(args)))
+
+
+class _Phase(object):
+    """Accumulating timer for one phase, used as a (reusable) context manager"""
+    __slots__ = ('total', 'calls', '_t0')
+
+    def __init__(self):
+        self.total = 0.0
+        self.calls = 0
+        self._t0 = 0.0
+
+    def __enter__(self):
+        self._t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.total += perf_counter() - self._t0
+        self.calls += 1
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+
+class _ProfileDone(Exception):
+    """Raised from step() / end_episode() to stop main() when its budget is used up"""
+
+
+class Profiler(object):
+    """
+    Phase timers plus steps / updates / episodes counters for a training loop.
+
+    Inputs:
+    - enabled: turn on the phase timers and the JSON records
+    - out: file name to append the records to (None prints them)
+    - cprofile_episodes: if > 0, run() profiles main() with cProfile for this
+      many episodes
+    - stats_file: where run() dumps the raw cProfile stats
+    - max_steps: if > 0, stop main() after this many steps
+    - reward_threshold: average reward (as passed to report()) to time
+    - run_info: dict included in every record (e.g. script name and args)
+    """
+    def __init__(self, enabled=False, out=None, cprofile_episodes=0, stats_file=None,
+                 max_steps=0, reward_threshold=None, run_info=None):
+        self.enabled = enabled
+        self.out = out
+        self.cprofile_episodes = cprofile_episodes
+        self.stats_file = stats_file
+        self.max_steps = max_steps
+        self.reward_threshold = reward_threshold
+        self.run_info = run_info or {}
+        self.phases = {}
+        # [seconds, calls] of every phase over the whole run
+        self.totals = {}
+        self.time_to_threshold = None
+        self.steps_to_threshold = None
+        self.steps = 0
+        self.updates = 0
+        self.episodes = 0
+        self._start = self._last_time = perf_counter()
+        self._last_steps = 0
+        self._last_updates = 0
+
+    def phase(self, name):
+        """Context manager that adds the time spent in its block to phase `name`"""
+        if not self.enabled:
+            return _NULL_PHASE
+        timer = self.phases.get(name)
+        if timer is None:
+            timer = self.phases[name] = _Phase()
+        return timer
+
+    def step(self, n=1):
+        self.steps += n
+        if self.max_steps and self.steps >= self.max_steps:
+            raise _ProfileDone()
+
+    def update(self, n=1):
+        self.updates += n
+
+    def end_episode(self, n=1):
+        self.episodes += n
+        if self.cprofile_episodes and self.episodes >= self.cprofile_episodes:
+            raise _ProfileDone()
+
+    def record(self, **extra):
+        """
+        Stats since the last record: throughput, and for every phase its total
+        seconds, number of calls, mean microseconds per call and fraction of the
+        wall clock time.  The phase timers are reset afterwards
+        """
+        now = perf_counter()
+        elapsed = max(now - self._last_time, 1e-12)
+        rec = dict(self.run_info)
+        rec.update(time=time.time(), wall_sec=now - self._start, interval_sec=elapsed,
+                   episodes=self.episodes, steps=self.steps, updates=self.updates,
+                   steps_per_sec=(self.steps - self._last_steps) / elapsed,
+                   updates_per_sec=(self.updates - self._last_updates) / elapsed)
+        rec['phases'] = {name: dict(sec=t.total, calls=t.calls,
+                                    mean_us=1e6 * t.total / t.calls if t.calls else 0.0,
+                                    frac=t.total / elapsed)
+                         for name, t in self.phases.items()}
+        rec.update(time_to_threshold=self.time_to_threshold, steps_to_threshold=self.steps_to_threshold)
+        rec.update(extra)
+        for name, t in self.phases.items():
+            total = self.totals.setdefault(name, [0.0, 0])
+            total[0] += t.total
+            total[1] += t.calls
+            t.total, t.calls = 0.0, 0
+        self._last_time, self._last_steps, self._last_updates = now, self.steps, self.updates
+        return rec
+
+    def summary(self, **extra):
+        """Record over the whole run (phase times are cumulative), with the peak RSS"""
+        self.record()  # fold the last interval into the totals
+        wall = perf_counter() - self._start
+        rec = dict(self.run_info)
+        rec.update(final=True, time=time.time(), wall_sec=wall,
+                   episodes=self.episodes, steps=self.steps, updates=self.updates,
+                   steps_per_sec=self.steps / wall, updates_per_sec=self.updates / wall,
+                   time_to_threshold=self.time_to_threshold, steps_to_threshold=self.steps_to_threshold,
+                   peak_rss_mb=peak_rss_mb())
+        rec['phases'] = {name: dict(sec=sec, calls=calls,
+                                    mean_us=1e6 * sec / calls if calls else 0.0,
+                                    frac=sec / wall)
+                         for name, (sec, calls) in self.totals.items()}
+        rec.update(extra)
+        return rec
+
+    def emit(self, rec):
+        line = json.dumps(rec, default=str)
+        if self.out is None:
+            print(line)
+        else:
+            with open(self.out, 'a') as f:
+                f.write(line + '\n')
+
+    def report(self, **extra):
+        """Emit a record (only when enabled).  Extra fields, e.g. ave_reward, are added to it"""
+        ave_reward = extra.get('ave_reward')
+        if (self.reward_threshold is not None and self.time_to_threshold is None
+                and ave_reward is not None and ave_reward >= self.reward_threshold):
+            self.time_to_threshold = perf_counter() - self._start
+            self.steps_to_threshold = self.steps
+        if self.enabled:
+            rec = self.record(**extra)
+            self.emit(rec)
+            return rec
+
+    def run(self, main, *args, **kwargs):
+        """
+        Run main(), under cProfile for a bounded number of episodes if asked to.
+        If it stops on one of the budgets, emit the summary record of the run
+        """
+        prof = cProfile.Profile() if self.cprofile_episodes else None
+        try:
+            if prof is None:
+                main(*args, **kwargs)
+            else:
+                prof.runcall(main, *args, **kwargs)
+        except _ProfileDone:
+            pass
+        if prof is not None:
+            if self.stats_file:
+                prof.dump_stats(self.stats_file)
+            pstats.Stats(prof, stream=sys.stdout).sort_stats('cumulative').print_stats(30)
+        if self.enabled:
+            self.emit(self.summary())
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
@@ -1,20 +1,174 @@
 import numpy as np
+from scipy.signal import lfilter
 
-def calculate_discounted_returns(rewards):
+"""
+Return and advantage calculations shared by all of the RL agents.
+
+Everything here is vectorized (no python loop over timesteps).  Time is always
+the last axis, so the same functions work on a single episode of shape (T,) or
+on a batch of padded episodes / parallel envs of shape (N, T).
+
+Episodes that are concatenated together along the time axis can be split with
+a `dones` mask (1 at the last timestep of each episode), so nothing is carried
+over from one episode into the return of the one before it.
+
+    Resources:
+        Sutton and Barto: http://incompleteideas.net/book/the-book-2nd.html (chapters 7, 12)
+        GAE paper: https://arxiv.org/abs/1506.02438
+"""
+
+EPS = np.finfo(np.float32).eps
+
+
+def discount_cumsum(x, gamma):
+    """
+    Discounted cumulative sum along the last axis, computed right to left:
+
+        y[t] = x[t] + gamma * y[t+1]
+
+    This is the recursion of a first order IIR filter run over the reversed
+    sequence, so we let lfilter do it instead of looping in python.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    return lfilter([1], [1, -gamma], x[..., ::-1], axis=-1)[..., ::-1]
+
+
+def _episode_ends(dones):
+    """For every timestep, the index of the last timestep of its episode"""
+    T = dones.shape[-1]
+    # the end of the data is always treated as the end of an episode
+    idx = np.where(dones, np.arange(T), T - 1)
+    return np.minimum.accumulate(idx[..., ::-1], axis=-1)[..., ::-1]
+
+
+def _append(x, val):
+    """Append val (scalar, or one value per row) to the end of the last axis"""
+    tail = np.broadcast_to(np.asarray(val, dtype=np.float64)[..., None], x.shape[:-1] + (1,))
+    return np.concatenate([x, tail], axis=-1)
+
+
+def masked_discount_cumsum(x, gamma, dones=None):
+    """
+    discount_cumsum that restarts at every episode boundary in dones.
+
+    Run the filter over everything at once, then subtract out the part of
+    each sum that leaked in from the following episodes:
+
+        y[t] = true[t] + gamma^(end(t)+1-t) * y[end(t)+1]
+    """
+    y = discount_cumsum(x, gamma)
+    if dones is None:
+        return y
+    dones = np.asarray(dones, dtype=bool)
+    T = y.shape[-1]
+    ends = _episode_ends(dones)
+    y_next = np.take_along_axis(_append(y, 0.0), ends + 1, axis=-1)
+    return y - gamma ** (ends + 1 - np.arange(T)) * y_next
+
+
+def episode_steps(dones, shape=None):
+    """
+    Index of every timestep within its own episode (0 at the first step of
+    each episode).  Useful for gamma^t weightings.  Without dones, the whole
+    time axis (of the given shape) is one episode.
+    """
+    if dones is None:
+        return np.broadcast_to(np.arange(shape[-1]), shape)
+    dones = np.asarray(dones, dtype=bool)
+    t = np.arange(dones.shape[-1])
+    # an episode starts at 0 and right after every done
+    starts = np.zeros(dones.shape, dtype=np.int64)
+    starts[..., 1:] = np.where(dones[..., :-1], t[1:], 0)
+    return t - np.maximum.accumulate(starts, axis=-1)
+
+
+def normalize(x, mask=None):
+    """Normalize to zero mean and unit std (only over valid entries if given a mask)"""
+    if mask is None:
+        return (x - x.mean()) / (x.std() + EPS)
+    mask = np.asarray(mask, dtype=bool)
+    valid = x[mask]
+    return np.where(mask, (x - valid.mean()) / (valid.std() + EPS), 0.0)
+
+
+def calculate_discounted_returns(rewards, gamma=0.99, normalize_returns=True, dones=None, mask=None):
     """
     Calculate discounted reward and then normalize it
-    See Sutton book for definition
+    (see Sutton book for definition)
 
     Params:
-        rewards: list of rewards for every episode
+        rewards: rewards of shape (T,) or (N, T). Can be a list for one episode
+        gamma: discount factor
+        normalize_returns: normalize for better statistical properties
+        dones: optional mask, 1 at the last step of each episode in a flat
+            concatenation of several episodes
+        mask: optional validity mask for padded (N, T) batches. Padded steps
+            get a return of 0 and are ignored when normalizing
     """
-    returns = np.zeros(len(rewards))
-
-    next_return = 0 # 0 because we start at the last timestep
-    for t in reversed(range(0, len(rewards))):
-        next_return = rewards[t] + args.gamma * next_return
-        returns[t] = next_return
-    # normalize for better statistical properties
-    returns = (returns - returns.mean()) / (returns.std() + np.finfo(np.float32).eps)
+    rewards = np.asarray(rewards, dtype=np.float64)
+    if mask is not None:
+        rewards = np.where(mask, rewards, 0.0)
+    returns = masked_discount_cumsum(rewards, gamma, dones)
+    if normalize_returns:
+        returns = normalize(returns, mask)
+    elif mask is not None:
+        returns = np.where(mask, returns, 0.0)
     return returns
 
+
+def calculate_gae(rewards, values, gamma=0.99, lam=0.95, dones=None, last_value=0.0):
+    """
+    Generalized Advantage Estimation.
+
+        delta[t] = r[t] + gamma * V[t+1] * (1 - done[t]) - V[t]
+        adv[t] = sum_k (gamma*lam)^k delta[t+k]   (within the episode)
+
+    Params:
+        rewards: (T,) or (N, T)
+        values: state values V(s_t), same shape as rewards
+        dones: optional episode end mask, same shape as rewards
+        last_value: V of the state after the last step (bootstrap for an
+            unfinished episode, scalar or one per row)
+
+    Returns:
+        advantages, lambda-returns (advantages + values, the value targets)
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(rewards.shape)
+    next_values = _append(values, last_value)[..., 1:]
+    if dones is not None:
+        next_values = np.where(dones, 0.0, next_values)
+    deltas = rewards + gamma * next_values - values
+    advantages = masked_discount_cumsum(deltas, gamma * lam, dones)
+    return advantages, advantages + values
+
+
+def calculate_nstep_returns(rewards, values, n, gamma=0.99, dones=None, last_value=0.0):
+    """
+    n-step bootstrapped returns.
+
+        G[t] = r[t] + ... + gamma^(n-1) r[t+n-1] + gamma^n V[t+n]
+
+    truncated (no bootstrap) when the episode terminates within n steps.
+    If the data ends in the middle of an episode, last_value is used as the
+    bootstrap for the steps that run off the end.
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(rewards.shape)
+    T = rewards.shape[-1]
+    if dones is None:
+        dones = np.zeros(rewards.shape, dtype=bool)
+    # put last_value in an extra slot at the end that acts like a final reward
+    ext_rewards = _append(rewards, last_value)
+    ext_values = _append(values, last_value)
+    ext_dones = np.concatenate([np.asarray(dones, dtype=bool), np.ones(rewards.shape[:-1] + (1,), dtype=bool)], axis=-1)
+
+    full = masked_discount_cumsum(ext_rewards, gamma, ext_dones)
+    ends = _episode_ends(ext_dones)[..., :T]
+    t = np.arange(T)
+    within = t + n <= ends
+    ahead = np.minimum(t + n, T)
+    ahead = np.broadcast_to(ahead, rewards.shape)
+    nstep = full[..., :T] - gamma**n * np.take_along_axis(full, ahead, axis=-1) \
+            + gamma**n * np.take_along_axis(ext_values, ahead, axis=-1)
+    return np.where(within, nstep, full[..., :T])
@@ -0,0 +1,88 @@
+import numpy as np
+
+from .common import policy_gradient_logits, softmax
+
+"""
+Vectorized action sampling for the agents.
+
+np.random.choice(ac_n, p=probs) checks the probabilities and builds a CDF on
+every call, and it can only draw for one distribution at a time.  These take a
+whole (N, ac_n) batch of action distributions (one row per env) and draw all N
+actions with a single call on a numpy.random.Generator, e.g.
+
+    rng = np.random.default_rng(seed)
+    actions, dh = sample_categorical(probs, rng)
+
+They also return dh = onehot(action) - probs, the gradient of log(pi(a|s))
+w.r.t. the logits (see README.md for derivation), which the agents save for
+the backward pass.  sample_gaussian does the same for continuous actions.
+"""
+
+
+def action_gradients(probs, actions):
+    """
+    dh = onehot(actions) - probs, the derivative that pulls in the direction
+    that makes the taken actions more probable.  Shape (N, ac_n)
+    """
+    return policy_gradient_logits(probs, actions)
+
+
+def sample_categorical(probs, rng):
+    """
+    Inverse-CDF sampling for a batch of probability vectors.
+
+    Inputs:
+    - probs: (N, ac_n) rows of action probabilities
+    - rng: numpy.random.Generator
+
+    Returns:
+    - actions: (N,) sampled action indices
+    - dh: (N, ac_n) onehot(actions) - probs
+    """
+    probs = np.atleast_2d(probs)
+    cdf = np.cumsum(probs, axis=1)
+    # scale by the total so rows that don't sum to exactly 1 are fine
+    u = rng.random((probs.shape[0], 1)) * cdf[:, -1:]
+    actions = np.minimum((u >= cdf).sum(axis=1), probs.shape[1] - 1)
+    return actions, action_gradients(probs, actions)
+
+
+def sample_categorical_logits(logits, rng):
+    """
+    Gumbel-max sampling straight from unnormalized logits:
+    argmax(logits + Gumbel noise) is distributed like softmax(logits).
+
+    Inputs:
+    - logits: (N, ac_n) numerical action preferences
+    - rng: numpy.random.Generator
+
+    Returns:
+    - actions: (N,) sampled action indices
+    - dh: (N, ac_n) onehot(actions) - softmax(logits)
+    """
+    logits = np.atleast_2d(logits)
+    gumbel = -np.log(-np.log(rng.random(logits.shape)))
+    actions = np.argmax(logits + gumbel, axis=1)
+    return actions, action_gradients(softmax(logits), actions)
+
+
+def sample_gaussian(means, stds, rng):
+    """
+    Sample a batch of (diagonal) Gaussian actions.
+
+    Inputs:
+    - means: (N, ac_n) action means
+    - stds: (N, ac_n) action standard deviations (> 0)
+    - rng: numpy.random.Generator
+
+    Returns:
+    - actions: (N, ac_n) sampled actions (not clipped to the action space)
+    - dh: (N, 2*ac_n) gradient of log(pi(a|s)) w.r.t. [means, stds]
+    """
+    noise = rng.standard_normal(means.shape)
+    actions = means + stds * noise
+    # d/dmean log N(a; mean, std) = (a - mean)/std^2 = noise/std
+    # d/dstd  log N(a; mean, std) = -1/std + (a - mean)^2/std^3 = (noise^2 - 1)/std
+    dmeans = noise / stds
+    dstds = (noise**2 - 1) / stds
+    return actions, np.concatenate([dmeans, dstds], axis=1)
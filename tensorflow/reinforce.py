@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 import argparse
-import gym
+import queue
+import threading
+import time
 import numpy as np
 import tensorflow as tf
 from itertools import count
 from collections import namedtuple
 
+# make it possible to import from ../numpy/utils/
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'numpy'))
+from utils.buffers import iterate_minibatches
+from utils.rl_common import calculate_discounted_returns
+from utils.profiling import add_profiling_args, make_profiler
+from envs import REGISTRY, make_env, make_vec_env
+
 parser = argparse.ArgumentParser(description='TensorFlow REINFORCE')
 parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
                     help='discount factor (default: 0.99)')
@@ -16,8 +26,30 @@ parser.add_argument('--log_interval', type=int, default=100, metavar='N',
 parser.add_argument('--render_interval', type=int, default=-1, metavar='N',
                     help='interval between rendering (default: -1)')
 parser.add_argument('--env_id', type=str, default='LunarLander-v2',
-                    help='gym environment to load')
+                    help='gym (or numpy/envs) environment to load')
+parser.add_argument('--epochs', type=int, default=1, metavar='N',
+                    help='epochs of minibatch updates on each episode, > 1 uses the clipped (PPO) objective (default: 1)')
+parser.add_argument('--minibatch_size', type=int, default=0, metavar='N',
+                    help='steps per minibatch for the multi-epoch updates, 0 for the whole episode (default: 0)')
+parser.add_argument('--clip', type=float, default=0.2, metavar='E',
+                    help='probability ratio clipping for the multi-epoch updates (default: 0.2)')
+parser.add_argument('--num_envs', type=int, default=1, metavar='N',
+                    help='if > 1, run that many copies of a numpy/envs env as one vec env, '
+                         'with one batched act call per step (default: 1)')
+parser.add_argument('--act_latency', type=int, default=0, metavar='N',
+                    help='if > 0, time N calls of the act path (session callable vs sess.run with a feed_dict) '
+                         'for a few batch sizes, print the per-call latency and exit (default: 0)')
+parser.add_argument('--data_pipeline', action='store_true',
+                    help='collect episodes in rollout worker threads and feed them to batched updates through tf.data')
+parser.add_argument('--num_workers', type=int, default=1, metavar='N',
+                    help='rollout worker threads for --data_pipeline (default: 1)')
+parser.add_argument('--episodes_per_batch', type=int, default=4, metavar='N',
+                    help='episodes in each --data_pipeline update (default: 4)')
+parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                    help='batches the --data_pipeline prepares ahead of the update (default: 2)')
+add_profiling_args(parser)
 args = parser.parse_args()
+profiler = make_profiler(args, 'tensorflow/reinforce.py')
 
 """
 
@@ -44,23 +76,6 @@ huge pain to learn, but once you do, it is not as bad.)
 
 
 # HELPERS
-def calculate_discounted_returns(rewards):
-    """
-    Calculate discounted reward and then normalize it
-    (see Sutton book for definition)
-    Params:
-        rewards: list of rewards for every episode
-    """
-    returns = np.zeros(len(rewards))
-
-    next_return = 0 # 0 because we start at the last timestep
-    for t in reversed(range(0, len(rewards))):
-        next_return = rewards[t] + args.gamma * next_return
-        returns[t] = next_return
-    # normalize for better statistical properties
-    returns = (returns - returns.mean()) / (returns.std() + np.finfo(np.float32).eps)
-    return returns
-
 def normc_initializer(std=1.0, axis=0):
     def _initializer(shape, dtype=None, partition_info=None):  # pylint: disable=W0613
         out = np.random.randn(*shape).astype(np.float32)
@@ -81,32 +96,54 @@ class PolicyNetwork(object):
 
         self.obs = tf.placeholder(dtype=tf.float32, shape=[None, ob_n])
 
-        x = tf.layers.dense(inputs=self.obs, units=hidden_dim, activation=tf.nn.relu, name='hidden')
-        self.logits = tf.layers.dense(inputs=x, units=self.ac_n, activation=None, kernel_initializer=normc_initializer(0.01), name='logits')
+        self.hidden_dim = hidden_dim
+        self.logits = self._logits(self.obs)
+
+        self.ac = self._sample()
+        self._act = self._run_gen(self.obs, self.ac)
+
+    def _logits(self, obs):
+        x = tf.layers.dense(inputs=obs, units=self.hidden_dim, activation=tf.nn.relu, name='hidden')
+        return tf.layers.dense(inputs=x, units=self.ac_n, activation=None, kernel_initializer=normc_initializer(0.01), name='logits')
 
-        ac = self._sample()
-        stochastic = tf.placeholder(dtype=tf.bool, shape=())
-        self._act = self._run_gen(self.obs, ac)
+    def logits_for(self, obs):
+        """Logits of the same network (shared weights) for another input tensor, e.g. from a tf.data pipeline"""
+        with tf.variable_scope(self.scope, reuse=True):
+            return self._logits(obs)
 
     def act(self, ob):
         ac1 = self._act(ob[None])
         return ac1
 
+    def act_batch(self, obs):
+        """Sample an action for every row of obs (N, ob_n), e.g. one per env of a vec env, in one call"""
+        return self._act(obs)
+
     def _sample(self):
         """Random sample an action"""
         u = tf.random_uniform(tf.shape(self.logits))
         return tf.argmax(self.logits - tf.log(-tf.log(u)), axis=-1)
 
     def _run_gen(self, ob, ac):
+        # session -> callable with the feed and fetch already bound
+        callables = {}
         def run(ob_feed):
             """Run an observation through the nn to get an action
             this will only be used to run the policy.  To train it, we
-            later feed in the observations, selected actions, and rewards all at once"""
-            results = tf.get_default_session().run(ac, feed_dict={ob:ob_feed})
-            return results
+            later feed in the observations, selected actions, and rewards all at once
+
+            sess.run re-processes the feed_dict and looks up the fetches in the
+            graph on every call, which is most of the time for a net this small.
+            make_callable does that once, so every step after the first only
+            pays for running the ops"""
+            sess = tf.get_default_session()
+            fn = callables.get(sess)
+            if fn is None:
+                fn = callables[sess] = sess.make_callable(ac, feed_list=[ob])
+            return fn(ob_feed)
         return run
 
-    def neglogp(self, x):
+    def neglogp(self, x, logits=None):
         """This computes the negative log probability of the given action.
         It is used to pass the gradient back through the network for training
         (in tf speak, this is the loss that we minimize)
@@ -114,7 +151,10 @@ class PolicyNetwork(object):
         NOTE: when we evaluate this, we are refeeding all of the observations,
         chosen actions, and rewards back through the network.  Meaning we don't worry
         about caching when we are running the env. This is just for ease in tensorflow.
+
+        (logits defaults to the ones of the obs placeholder)
         """
+        logits = self.logits if logits is None else logits
         one_hot_actions = tf.one_hot(x, self.ac_n)
         # see http://cs231n.github.io/linear-classify/#softmax
         # and http://karpathy.github.io/2016/05/31/rl/
@@ -125,7 +165,7 @@ class PolicyNetwork(object):
         # make that one more probable. since we multiply this by the return signal, that will
         # good actions more probable and bad actions less probable.
         return tf.nn.softmax_cross_entropy_with_logits(
-                logits=self.logits, 
+                logits=logits, 
                 labels=one_hot_actions)
 
 
@@ -139,39 +179,257 @@ class REINFORCE(object):
 
         self.pi = PolicyNetwork(self.ob_n, self.ac_n)
 
-        self.obs = self.pi.obs
-        self.ac = tf.placeholder(tf.int32, shape=[None], name='ac')
-        self.atarg = tf.placeholder(tf.float32, shape=[None], name='atarg')
-        self.loss = self.atarg * self.pi.neglogp(self.ac)
+        # (the --data_pipeline updates use every batch once, with the plain objective)
+        self.multi_epoch = (args.epochs > 1 or args.minibatch_size > 0) and not args.data_pipeline
+        if args.data_pipeline:
+            # the training inputs come out of the tf.data pipeline instead of feeds
+            obs, self.ac, self.atarg = self._build_pipeline()
+            self.neglogp = self.pi.neglogp(self.ac, self.pi.logits_for(obs))
+        else:
+            self.obs = self.pi.obs
+            self.ac = tf.placeholder(tf.int32, shape=[None], name='ac')
+            self.atarg = tf.placeholder(tf.float32, shape=[None], name='atarg')
+            self.neglogp = self.pi.neglogp(self.ac)
+
+        if self.multi_epoch:
+            # clipped surrogate objective (PPO) for reusing an episode for several epochs.
+            # ratio = pi(a|s) / pi_old(a|s), where pi_old is the policy that collected the data
+            self.old_neglogp = tf.placeholder(tf.float32, shape=[None], name='old_neglogp')
+            ratio = tf.exp(self.old_neglogp - self.neglogp)
+            clipped_ratio = tf.clip_by_value(ratio, 1.0 - args.clip, 1.0 + args.clip)
+            self.loss = -tf.minimum(ratio * self.atarg, clipped_ratio * self.atarg)
+        else:
+            self.loss = self.atarg * self.neglogp
 
+        # only the loss of this run's update mode is built, so there is a single
+        # optimizer update op (and one set of adam slots) for all of the modes
         self.optimizer = tf.train.AdamOptimizer(learning_rate=1e-3)
         self.train_op = self.optimizer.minimize(self.loss, global_step=tf.train.get_global_step())
+        # minibatch shuffling
+        self.rng = np.random.default_rng(args.seed)
+        self._scratch = {}
         # TODO: was updating the training pipeline to match baselines
         # TODO: i may just want to copy baselines and add in baby algorithms. fork it and call
         # it baby baselines. REINFORCE, AC, and commented like shit. A ramp up to baselines 
         # proper
 
-    def select_action(self, obs, sess=None):
+    def _build_pipeline(self):
+        """
+        Batched updates fed by a tf.data pipeline instead of feed_dicts.
+
+        The rollout workers put finished episodes (obs, actions, rewards) in
+        self.episode_queue.  tf.data pulls them out with from_generator,
+        computes the normalized returns of every episode in graph, pads
+        episodes_per_batch of them into one batch and prefetches, so the next
+        batch is being put together while the current update runs.
+
+        Returns the (flattened) obs, actions and returns of the next batch, so
+        every run of the train op pulls a batch and does one update on it.
+        """
+        self.episode_queue = queue.Queue(maxsize=2 * args.episodes_per_batch * args.num_workers)
+        self.pipeline_stop = threading.Event()
+        gamma = args.gamma
+
+        def episodes():
+            # ends the dataset once the workers are stopped, so the session can close
+            while not self.pipeline_stop.is_set():
+                try:
+                    yield self.episode_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        def episode_returns(obs, actions, rewards):
+            # y[t] = r[t] + gamma * y[t+1], scanned over the reversed episode
+            returns = tf.reverse(tf.scan(lambda running, r: r + gamma * running,
+                                         tf.reverse(rewards, [0]), initializer=0.0), [0])
+            mean, var = tf.nn.moments(returns, axes=[0])
+            returns = (returns - mean) / (tf.sqrt(var) + np.finfo(np.float32).eps)
+            return obs, actions, returns, tf.ones_like(rewards), tf.reduce_sum(rewards)
+
+        ds = tf.data.Dataset.from_generator(
+            episodes, (tf.float32, tf.int32, tf.float32),
+            (tf.TensorShape([None, self.ob_n]), tf.TensorShape([None]), tf.TensorShape([None])))
+        ds = ds.map(episode_returns)
+        # padded steps get 0 returns, so they add nothing to the loss
+        ds = ds.padded_batch(args.episodes_per_batch,
+                             padded_shapes=([None, self.ob_n], [None], [None], [None], []))
+        ds = ds.prefetch(args.prefetch)
+        obs, actions, returns, mask, ep_returns = ds.make_one_shot_iterator().get_next()
+
+        # env steps and the total reward of every episode in the batch, for logging
+        self.pipeline_stats = [tf.reduce_sum(mask), ep_returns]
+        return tf.reshape(obs, [-1, self.ob_n]), tf.reshape(actions, [-1]), tf.reshape(returns, [-1])
+
+    def select_action(self, obs):
         """
         Run observation through network and sample an action to take. Keep track
         of dh to use to update weights
         """
-        sess = sess or tf.get_default_session()
-        return self.pi.act(obs)
+        # forward pass and sampling are a single session run
+        with profiler.phase('forward_sample'):
+            return self.pi.act(obs)
+
+    def select_actions(self, obs):
+        """Sample actions for a batch of observations (N, ob_n), e.g. from a vec env"""
+        with profiler.phase('forward_sample'):
+            return self.pi.act_batch(obs)
     
-    def update(self, ep_cache, sess=None):
-        returns = calculate_discounted_returns(ep_cache.rewards)
-        obs = np.array(ep_cache.obs)
-        taken_actions = np.array(ep_cache.actions)
-
-        sess = sess or tf.get_default_session()
+    def update(self, ep_cache):
+        with profiler.phase('returns'):
+            returns = calculate_discounted_returns(ep_cache.rewards, args.gamma)
+            obs = np.array(ep_cache.obs)
+            taken_actions = np.array(ep_cache.actions)
+
+        if self.multi_epoch:
+            return self.update_epochs(obs, taken_actions, returns)
+        sess = tf.get_default_session()
         feed_dict = {self.obs: obs, self.ac: taken_actions, self.atarg: returns}
-        sess.run([self.train_op], feed_dict=feed_dict)
+        # forward, backward and the optimizer step all happen in this one run
+        with profiler.phase('train_op'):
+            sess.run([self.train_op], feed_dict=feed_dict)
+        profiler.update()
+
+    def update_epochs(self, obs, taken_actions, returns):
+        """Several epochs of shuffled minibatch updates on the clipped objective"""
+        sess = tf.get_default_session()
+        # negative log probs under the policy that collected the episode (before any updates)
+        old_neglogp = sess.run(self.neglogp, feed_dict={self.obs: obs, self.ac: taken_actions})
+        columns = dict(obs=obs, ac=taken_actions, atarg=returns, old_neglogp=old_neglogp)
+        for epoch in range(args.epochs):
+            for mb in iterate_minibatches(columns, args.minibatch_size, self.rng, self._scratch):
+                feed_dict = {self.obs: mb['obs'], self.ac: mb['ac'], self.atarg: mb['atarg'],
+                             self.old_neglogp: mb['old_neglogp']}
+                with profiler.phase('train_op'):
+                    sess.run([self.train_op], feed_dict=feed_dict)
+                profiler.update()
+
+EpCache = namedtuple("EpCache", ["obs", "actions", "rewards"])
+
+def rollout_worker(worker_env, sess):
+    """Run episodes with the current policy and put them in the pipeline's queue, until the pipeline stops"""
+    # the default session is per thread
+    with sess.as_default():
+        while not reinforce.pipeline_stop.is_set():
+            obs_list, actions, rewards = [], [], []
+            obs = worker_env.reset()
+            for t in range(10000):  # Don't infinite loop while learning
+                action = reinforce.pi.act(obs)[0]
+                obs_list.append(obs)
+                actions.append(action)
+                obs, reward, done, _ = worker_env.step(action)
+                rewards.append(reward)
+                if done or reinforce.pipeline_stop.is_set():
+                    break
+            episode = (np.array(obs_list, np.float32), np.array(actions, np.int32), np.array(rewards, np.float32))
+            while not reinforce.pipeline_stop.is_set():
+                try:
+                    reinforce.episode_queue.put(episode, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+def main_pipeline():
+    """
+    Run REINFORCE with rollout worker threads and tf.data fed batched updates.
+    The workers keep acting with the latest weights while an update runs, so a
+    batch can have episodes from a policy that is an update or two old
+    """
+    sess = tf.get_default_session()
+    envs = [env] + [make_env(args.env_id) for _ in range(args.num_workers - 1)]
+    for i, worker_env in enumerate(envs[1:], 1):
+        worker_env.seed(args.seed + i)
+    workers = [threading.Thread(target=rollout_worker, args=(worker_env, sess), daemon=True) for worker_env in envs]
+    for worker in workers:
+        worker.start()
+
+    avg_reward = []
+    try:
+        for i_update in count(1):
+            # (includes waiting on the workers if the pipeline has no batch ready)
+            with profiler.phase('train_op'):
+                _, steps, ep_returns = sess.run([reinforce.train_op] + reinforce.pipeline_stats)
+            profiler.update()
+            avg_reward.extend(ep_returns.tolist())
+            profiler.end_episode(len(ep_returns))
+
+            if len(avg_reward) >= args.log_interval:
+                print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+                profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
+                avg_reward = []
+            profiler.step(int(steps))
+    finally:
+        reinforce.pipeline_stop.set()
+        for worker in workers:
+            worker.join()
+
+def measure_act_latency(calls, batch_sizes=(1, 16, 256)):
+    """
+    Mean microseconds per call of the act path, for the session callable and
+    for the old sess.run with a feed_dict, at a few batch sizes.
+
+    Inputs:
+    - calls: number of timed calls per measurement (after a few warmup calls)
+    - batch_sizes: observations per call
+
+    Returns a list of dicts, one per batch size
+    """
+    sess = tf.get_default_session()
+    pi = reinforce.pi
+    results = []
+    for n in batch_sizes:
+        obs = np.random.randn(n, pi.ob_n).astype(np.float32)
+        timings = {}
+        for name, fn in [('callable', pi.act_batch),
+                         ('feed_dict', lambda ob: sess.run(pi.ac, feed_dict={pi.obs: ob}))]:
+            for _ in range(10):
+                fn(obs)
+            start = time.perf_counter()
+            for _ in range(calls):
+                fn(obs)
+            timings[name] = 1e6 * (time.perf_counter() - start) / calls
+        results.append(dict(batch_size=n, callable_us=timings['callable'], feed_dict_us=timings['feed_dict'],
+                            callable_us_per_ob=timings['callable'] / n))
+    return results
+
+def main_vec():
+    """
+    Run REINFORCE on --num_envs copies of a numpy env stepped as one vec env,
+    with one batched act call for all of them per step.  The vec env resets an
+    env as soon as its episode ends, and that episode is used for an update
+    right away, so the other envs finish their episodes with the new weights
+    """
+    N = vec_env.num_envs
+    ep_caches = [EpCache([], [], []) for _ in range(N)]
+    avg_reward = []
+    i_episode = 0
+    obs = vec_env.reset()
+    while True:
+        actions = reinforce.select_actions(obs)
+        with profiler.phase('env_step'):
+            next_obs, rewards, dones, _ = vec_env.step(actions)
+        profiler.step(N)
+
+        for i in range(N):
+            ep_caches[i].obs.append(obs[i])
+            ep_caches[i].actions.append(actions[i])
+            ep_caches[i].rewards.append(rewards[i])
+        obs = next_obs
+
+        for i in np.flatnonzero(dones):
+            reinforce.update(ep_caches[i])
+            profiler.end_episode()
+            i_episode += 1
+            if i_episode % args.log_interval == 0:
+                print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+                profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
+                avg_reward = []
+            else:
+                avg_reward.append(sum(ep_caches[i].rewards))
+            ep_caches[i] = EpCache([], [], [])
 
 def main():
     """Run REINFORCE algorithm to train on the environment"""
 
-    EpCache = namedtuple("EpCache", ["obs", "actions", "rewards"])
     avg_reward = []
     for i_episode in count(1):
         ep_cache = EpCache([], [], [])
@@ -182,7 +440,9 @@ def main():
             ep_cache.obs.append(obs)
             ep_cache.actions.append(action)
 
-            obs, reward, done, _ = env.step(action)
+            with profiler.phase('env_step'):
+                obs, reward, done, _ = env.step(action)
+            profiler.step()
             
             ep_cache.rewards.append(reward)
 
@@ -193,20 +453,36 @@ def main():
                 break
 
         reinforce.update(ep_cache)
+        profiler.end_episode()
 
         if i_episode % args.log_interval == 0:
             print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+            profiler.report(ave_reward=sum(avg_reward)/len(avg_reward))
             avg_reward = []
         else:
             avg_reward.append(sum(ep_cache.rewards))
 
 if __name__ == '__main__':
-    env = gym.make(args.env_id)
+    env = make_env(args.env_id)
     env.seed(args.seed)
     np.random.seed(args.seed)
+    tf.set_random_seed(args.seed)
+    if args.num_envs > 1:
+        if args.env_id not in REGISTRY:
+            parser.error('--num_envs needs a numpy/envs env id, one of {}'.format(sorted(REGISTRY)))
+        vec_env = make_vec_env(args.env_id, args.num_envs, args.seed)
     reinforce = REINFORCE(env)
 
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
-        main()
+        if args.act_latency > 0:
+            for r in measure_act_latency(args.act_latency):
+                print('batch {batch_size:>4}: callable {callable_us:8.1f} us/call ({callable_us_per_ob:.2f} us/ob), '
+                      'feed_dict {feed_dict_us:8.1f} us/call'.format(**r))
+        elif args.data_pipeline:
+            profiler.run(main_pipeline)
+        elif args.num_envs > 1:
+            profiler.run(main_vec)
+        else:
+            profiler.run(main)
 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import tensorflow as tf
+from itertools import count
+from collections import namedtuple
+
+# make it possible to import from ../numpy/utils/
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'numpy'))
+from utils.profiling import add_profiling_args, make_profiler
+from envs import make_env
+
+parser = argparse.ArgumentParser(description='TensorFlow 2 REINFORCE')
+parser.add_argument('--gamma', type=float, default=0.99, metavar='G',
+                    help='discount factor (default: 0.99)')
+parser.add_argument('--seed', type=int, default=42, metavar='N',
+                    help='random seed (default: 42)')
+parser.add_argument('--log_interval', type=int, default=100, metavar='N',
+                    help='interval between training status logs (default: 100)')
+parser.add_argument('--render_interval', type=int, default=-1, metavar='N',
+                    help='interval between rendering (default: -1)')
+parser.add_argument('--env_id', type=str, default='LunarLander-v2',
+                    help='gym (or numpy/envs) environment to load')
+parser.add_argument('--no_xla', action='store_true',
+                    help='run the tf.functions without XLA (jit_compile=False)')
+add_profiling_args(parser)
+args = parser.parse_args()
+profiler = make_profiler(args, 'tensorflow/reinforce_tf2.py')
+
+"""
+
+Same vanilla REINFORCE as reinforce.py, ported to TF2: no placeholders or
+sessions, the policy is a tf.Module and acting / training are tf.functions
+compiled with XLA (jit_compile=True).
+
+tf.function traces (and XLA compiles) again for every new input shape, and
+episode lengths are all over the place, so episodes are padded up to a power
+of two length with a mask of the real steps, and the returns are computed in
+the compiled function.  That makes it one compile per bucket length instead of
+one per episode length (the count is reported as `compiles`).
+
+"""
+
+EPS = np.finfo(np.float32).eps
+
+
+# HELPERS
+def normc_initializer(std=1.0, axis=0):
+    def _initializer(shape, dtype=None):
+        out = np.random.randn(*shape).astype(np.float32)
+        out *= std / np.sqrt(np.square(out).sum(axis=axis, keepdims=True))
+        return tf.constant(out)
+    return _initializer
+
+def bucket_length(T, min_len=32):
+    """Smallest power of two >= T (and min_len), so episodes of similar lengths share a compiled update"""
+    L = min_len
+    while L < T:
+        L *= 2
+    return L
+
+def discounted_returns(rewards, mask, gamma):
+    """
+    Normalized discounted returns of a padded episode, in graph.
+    (padded steps have 0 reward and come after the real ones, so they don't
+    change the returns of the real steps, and they are left out of the mean/std)
+    """
+    returns = tf.scan(lambda running, r: r + gamma * running, rewards, initializer=0.0, reverse=True)
+    n = tf.reduce_sum(mask)
+    mean = tf.reduce_sum(returns * mask) / n
+    std = tf.sqrt(tf.reduce_sum(mask * tf.square(returns - mean)) / n)
+    return mask * (returns - mean) / (std + EPS)
+
+
+class PolicyNetwork(tf.Module):
+    def __init__(self, ob_n, ac_n, hidden_dim=200, name='policy_network'):
+        super(PolicyNetwork, self).__init__(name=name)
+        self.ob_n = ob_n
+        self.ac_n = ac_n
+        with self.name_scope:
+            self.hidden = tf.keras.layers.Dense(hidden_dim, activation=tf.nn.relu, name='hidden')
+            self.logits = tf.keras.layers.Dense(ac_n, activation=None, kernel_initializer=normc_initializer(0.01), name='logits')
+            # build the variables now, so the tf.functions don't create them while tracing
+            self.logits(self.hidden(tf.zeros([1, ob_n])))
+        self.rng = tf.random.Generator.from_seed(args.seed)
+
+    def __call__(self, obs):
+        """Logits for a batch of observations (N, ob_n)"""
+        return self.logits(self.hidden(obs))
+
+    def sample(self, logits):
+        """Random sample an action (gumbel max, like reinforce.py)"""
+        u = self.rng.uniform(tf.shape(logits))
+        return tf.argmax(logits - tf.math.log(-tf.math.log(u)), axis=-1, output_type=tf.int32)
+
+    def neglogp(self, logits, x):
+        """Negative log probability of the actions x under the logits"""
+        return tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=tf.one_hot(x, self.ac_n))
+
+
+class REINFORCE(object):
+    """
+    Object to handle running the algorithm. Uses a PolicyNetwork
+    """
+    def __init__(self, env):
+        self.ob_n = env.observation_space.shape[0]
+        self.ac_n = env.action_space.n
+
+        self.pi = PolicyNetwork(self.ob_n, self.ac_n)
+        self.optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
+        if hasattr(self.optimizer, 'build'):
+            # make the adam slots up front too
+            self.optimizer.build(self.pi.trainable_variables)
+        # number of times the train step has been traced (and compiled), should
+        # stay at the number of different bucket lengths seen
+        self.compile_count = 0
+
+        jit_compile = not args.no_xla
+        # the None batch dim keeps the act function at a single trace (XLA still
+        # compiles once per batch size, but that is fixed by the number of envs)
+        self._act = tf.function(self._act_fn, jit_compile=jit_compile,
+                                input_signature=[tf.TensorSpec([None, self.ob_n], tf.float32)])
+        self._train_step = tf.function(self._train_step_fn, jit_compile=jit_compile)
+
+    def _act_fn(self, obs):
+        return self.pi.sample(self.pi(obs))
+
+    def _train_step_fn(self, obs, actions, rewards, mask):
+        # python side effects only run while tracing, so this counts compiles
+        self.compile_count += 1
+        returns = discounted_returns(rewards, mask, args.gamma)
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(returns * self.pi.neglogp(self.pi(obs), actions))
+        grads = tape.gradient(loss, self.pi.trainable_variables)
+        self.optimizer.apply_gradients(zip(grads, self.pi.trainable_variables))
+        return loss
+
+    def select_actions(self, obs):
+        """Sample an action for every row of obs (N, ob_n), e.g. one per env of a vec env, in one call"""
+        with profiler.phase('forward_sample'):
+            return self._act(np.asarray(obs, dtype=np.float32)).numpy()
+
+    def select_action(self, obs):
+        return self.select_actions(np.reshape(obs, (1, -1)))[0]
+
+    def pad(self, ep_cache):
+        """Pad the episode up to its bucket length, with a mask of the real steps"""
+        T = len(ep_cache.rewards)
+        L = bucket_length(T)
+        obs = np.zeros((L, self.ob_n), np.float32)
+        actions = np.zeros(L, np.int32)
+        rewards = np.zeros(L, np.float32)
+        mask = np.zeros(L, np.float32)
+        obs[:T] = ep_cache.obs
+        actions[:T] = ep_cache.actions
+        rewards[:T] = ep_cache.rewards
+        mask[:T] = 1
+        return obs, actions, rewards, mask
+
+    def update(self, ep_cache):
+        with profiler.phase('pad'):
+            batch = self.pad(ep_cache)
+        # forward, returns, backward and the optimizer step are all one compiled call
+        with profiler.phase('train_op'):
+            self._train_step(*batch)
+        profiler.update()
+
+def main():
+    """Run REINFORCE algorithm to train on the environment"""
+
+    EpCache = namedtuple("EpCache", ["obs", "actions", "rewards"])
+    avg_reward = []
+    for i_episode in count(1):
+        ep_cache = EpCache([], [], [])
+        obs = env.reset()
+        for t in range(10000):  # Don't infinite loop while learning
+            action = reinforce.select_action(obs)
+
+            ep_cache.obs.append(obs)
+            ep_cache.actions.append(action)
+
+            with profiler.phase('env_step'):
+                obs, reward, done, _ = env.step(action)
+            profiler.step()
+
+            ep_cache.rewards.append(reward)
+
+            if args.render_interval != -1 and i_episode % args.render_interval == 0:
+                env.render()
+
+            if done:
+                break
+
+        reinforce.update(ep_cache)
+        profiler.end_episode()
+
+        if i_episode % args.log_interval == 0:
+            print("Ave reward: {}".format(sum(avg_reward)/len(avg_reward)))
+            profiler.report(ave_reward=sum(avg_reward)/len(avg_reward), compiles=reinforce.compile_count)
+            avg_reward = []
+        else:
+            avg_reward.append(sum(ep_cache.rewards))
+
+if __name__ == '__main__':
+    env = make_env(args.env_id)
+    env.seed(args.seed)
+    np.random.seed(args.seed)
+    tf.random.set_seed(args.seed)
+    reinforce = REINFORCE(env)
+    profiler.run(main)